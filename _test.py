@@ -20,8 +20,21 @@ import animation
 import body
 import model
 import data
+import gravity
+import integrators
+import history
+import store
+import collisions
+import ensemble
+import sweep
+import events
+import branch
+import query
+import diagnostics
 import pytest
 import numpy as np
+import weakref
+import gc
 
 # Analysis Module Tests
 ##############################
@@ -29,6 +42,13 @@ import numpy as np
 def test_temp():
     pass
 
+def test_get_times():
+    a = analysis.Analysis()
+    a.add_runs("uniform", [[], [], []], 0, 0, 0, 0, 10)
+    a.add_runs("adaptive", [[], [], []], 0, 0, 0, 0, 10, times=[5, 25, 30])
+    assert np.array_equal(a.get_times("uniform", 3), [10, 20, 30])
+    assert np.array_equal(a.get_times("adaptive", 3), [5, 25, 30])
+
 # Animation Module Tests
 ##############################
 
@@ -93,15 +113,698 @@ def test_runge_kutta():
     test_model = model.Model()
     test_model.dt = 1
     test_model.bodies = [data.EARTH, data.SUN]
-    test_model.planets = [data.EARTH, data.SUN]
-    test_model.asteroids.clear()
     b = test_model.bodies[0]
     for t in range(100):
         b.runge_kutta(dt=60)
         print(t, b.position, b.velocity)
 
+
+def test_assigned_bodies_are_copied():
+    test_model = model.Model(duration=3600*24, dt=3600)
+    earth_position = data.EARTH.position.copy()
+    test_model.bodies = [data.EARTH, data.SUN]
+    assert data.EARTH.state is None and data.EARTH.model is None
+    assert test_model.earth is test_model.bodies[0] and test_model.sun is test_model.bodies[1]
+    assert test_model.planets == test_model.bodies and test_model.asteroids == []
+    test_model.run()
+    assert np.array_equal(data.EARTH.position, earth_position)
+    assert not np.allclose(test_model.earth.position, earth_position)
+
+    test_model.bodies = [test_model.sun]
+    with pytest.raises(ValueError):
+        test_model.run()
+
+def test_body_state_view():
+    test_model = model.Model(num_small=0, num_medium=0, num_large=0)
+    earth = test_model.earth
+    earth.position = np.array([1.0, 2.0, 3.0])
+    assert np.array_equal(test_model.state.position[earth.index], [1, 2, 3])
+    test_model.state.velocity[earth.index] = [4, 5, 6]
+    assert np.array_equal(earth.velocity, [4, 5, 6])
+
+    snap = earth.snapshot()
+    earth.position = np.zeros(3)
+    assert snap.state is None
+    assert np.array_equal(snap.position, [1, 2, 3])
+
+    test_model.remove_body(test_model.planets[1])
+    assert len(test_model.state.position) == 8
+    assert test_model.bodies[earth.index] is earth
+
+def test_body_ids_survive_removal(tmp_path):
+    m = model.Model(seed=2, num_small=3, num_medium=0, num_large=0, duration=4*60*60*24)
+    assert np.array_equal(m.state.ids, np.arange(12))
+    m.run()
+    gone, last = m.asteroids[0], m.asteroids[2]
+    m.remove_body(gone)
+    m.step()
+
+    assert gone.id == 9 and last.id == 11 and last.index == 10
+    assert np.array_equal(m.state.alive, [True] * 9 + [False, True, True])
+    assert np.array_equal(m.state.row_of([3, 9, 11]), [3, -1, 10])
+    assert m.find_by_id(9) is gone and m.find_by_id(11) is last
+
+    q = query.TrajectoryQuery(m.history)
+    assert np.array_equal(q.present([9, 11])[:, 0], [True] * 4 + [False])
+    assert np.array_equal(q.positions(11)[-1], last.position)
+
+    m.save_checkpoint(str(tmp_path / "ids"))
+    resumed = model.Model.resume(str(tmp_path / "ids"))
+    assert [b.id for b in resumed.state.registry] == list(range(12))
+    assert np.array_equal(resumed.state.alive, m.state.alive)
+    resumed.add_body(body.Body(np.zeros(3), np.zeros(3), 1.0, 1.0))
+    assert resumed.state.ids[-1] == 12
+
+# Diagnostics Module Tests
+##############################
+
+def test_diagnostics_sampled_during_run():
+    kwargs = dict(seed=4, num_small=3, num_medium=0, num_large=0, duration=32*60*60*24)
+    m = model.Model(diagnostics_every=5, **kwargs)
+    e0 = total_energy(m)
+    p0 = m.state.mass @ m.state.velocity
+    m.run(record_final_only=True)
+
+    diag = m.diagnostics
+    assert np.array_equal(diag.times / m.dt, [0, 5, 10, 15, 20, 25, 30, 32])
+    assert np.isclose(diag.energy[0], e0, rtol=1e-12) and np.isclose(diag.energy[-1], total_energy(m), rtol=1e-12)
+    assert np.allclose(diag.momentum[0], p0, rtol=1e-12)
+    drift = diag.relative_drift()
+    assert drift["energy"] < 1e-6 and drift["angular_momentum"] < 1e-6
+
+    a = analysis.Analysis()
+    a.add_runs("run", m.all_timestep_bodies, 0, 0, 0, 0, m.dt, m.times, diag)
+    assert np.array_equal(a.check_conservation_of_energy("run"), diag.energy)
+    assert np.array_equal(a.get_conservation_times("run", 8), diag.times)
+    assert np.isclose(a.calculate_total_energy(m.all_timestep_bodies[-1]), diag.energy[-1], rtol=1e-12)
+
+    off = model.Model(diagnostics_every=0, **kwargs)
+    off.run(record_final_only=True)
+    assert len(off.diagnostics.times) == 0
+
+def test_potential_energy_of_test_particles():
+    rng = np.random.default_rng(6)
+    pos = rng.normal(0, 1e9, (20, 3))
+    mass = rng.uniform(1e20, 1e24, 20)
+    sources = np.arange(5) # the other bodies only feel the sources
+    i, j = np.triu_indices(20, 1)
+    counted = (i < 5) | (j < 5)
+    expected = -gravity.G * np.sum((mass[i] * mass[j] / np.linalg.norm(pos[i] - pos[j], axis=1))[counted])
+    assert np.isclose(gravity.potential_energy(pos, mass, sources, max_pairs=7), expected, rtol=1e-12)
+
+    assert diagnostics.default_every(10_000, 9) == diagnostics.DIAGNOSTICS_EVERY
+    assert diagnostics.default_every(10_000, 10_000) == 0
+
+# Gravity Module Tests
+##############################
+
+def test_accelerations_match_pairwise_loop():
+    rng = np.random.default_rng(3)
+    pos = rng.normal(0, 1e9, (12, 3))
+    pos[5] = pos[4] # coincident pair is skipped
+    mass = rng.uniform(1e20, 1e24, 12)
+
+    expected = np.zeros((12, 3))
+    for i in range(12):
+        for j in range(12):
+            r = pos[j] - pos[i]
+            dist = np.linalg.norm(r)
+            if dist == 0: continue
+            expected[i] += gravity.G * mass[j] * r / dist**3
+
+    assert np.allclose(gravity.accelerations(pos, mass), expected, rtol=1e-12)
+    # chunked evaluation gives the same answer
+    assert np.allclose(gravity.accelerations(pos, mass, max_pairs=5), expected, rtol=1e-12)
+
+def test_accelerations_from_sources_only():
+    rng = np.random.default_rng(4)
+    pos = rng.normal(0, 1e9, (10, 3))
+    mass = rng.uniform(1e20, 1e24, 10)
+    sources = np.array([0, 3, 7])
+    massless = np.zeros(10)
+    massless[sources] = mass[sources]
+    assert np.allclose(gravity.accelerations(pos, mass, sources=sources), gravity.accelerations(pos, massless), rtol=1e-12)
+
+def clustered_bodies(n, seed=5):
+    """Two Gaussian clusters of different widths, returns (pos, mass)"""
+    rng = np.random.default_rng(seed)
+    pos = np.vstack((rng.normal(0, 1e9, (n // 2, 3)), rng.normal(5e10, 1e8, (n - n // 2, 3))))
+    return pos, rng.uniform(1e18, 1e22, n)
+
+def test_barnes_hut_matches_direct_sum():
+    pos, mass = clustered_bodies(500)
+    direct = gravity.accelerations(pos, mass)
+    assert np.allclose(gravity.barnes_hut_accelerations(pos, mass, theta=0), direct, rtol=1e-10, atol=0)
+    error = np.linalg.norm(gravity.barnes_hut_accelerations(pos, mass, theta=0.5) - direct, axis=1) / np.linalg.norm(direct, axis=1)
+    assert np.median(error) < 1e-2 and np.percentile(error, 99) < 1e-1
+
+    # exclude and sources follow the direct kernel
+    sources = np.arange(0, 500, 3)
+    exclude = np.arange(500)
+    exact = gravity.barnes_hut_accelerations(pos, mass, points=pos + 1e6, exclude=exclude, sources=sources, theta=0)
+    assert np.allclose(exact, gravity.accelerations(pos, mass, points=pos + 1e6, exclude=exclude, sources=sources), rtol=1e-10, atol=0)
+
+def test_barnes_hut_model_run():
+    kwargs = dict(num_small=10, num_medium=5, num_large=5, seed=3, duration=60*60*24*5)
+    direct = model.Model(**kwargs)
+    tree = model.Model(force_solver="barnes_hut", opening_angle=0, **kwargs)
+    direct.run()
+    tree.run()
+    assert np.allclose(tree.state.position, direct.state.position, rtol=1e-9)
+    with pytest.raises(ValueError):
+        model.Model(force_solver="fmm")
+
+# History Module Tests
+##############################
+
+def test_history_buffer_keeps_columns_after_removal():
+    m = model.Model(num_small=0, num_medium=0, num_large=0, duration=3*60*60*24)
+    m.run()
+    assert m.history.length == 3 and m.history.data.shape[1] == 9
+    venus = m.planets[2]
+    m.remove_body(venus)
+    m.step()
+
+    frames = m.all_timestep_bodies
+    assert len(frames) == 4
+    assert len(frames[0]) == 9 and len(frames[-1]) == 8
+    assert np.all(np.isnan(m.history.data[3, 2]))
+    assert np.array_equal(frames[2][2].position, m.history.data[2, 2, :3])
+    assert frames[-1][2].label == 'earth'
+    assert frames[-1][2].state is None
+    assert np.array_equal(m.times, [1, 2, 3, 4] * np.array(m.dt))
+
+def test_history_retention_policies():
+    days = 10
+    def run(**policy):
+        m = model.Model(num_small=0, num_medium=0, num_large=0, duration=days*60*60*24)
+        m.run(**policy)
+        return m
+    full = run()
+
+    every = run(record_every=3)
+    assert np.array_equal(every.times / every.dt, [3, 6, 9, 10])
+    assert np.array_equal(every.history.trajectory()[1], full.history.trajectory()[5])
+
+    subset = run(record_bodies=['sun', 'earth'])
+    assert subset.history.data.shape[1] == 2
+    assert [b.label for b in subset.all_timestep_bodies[-1]] == ['sun', 'earth']
+
+    ring = run(record_last=4)
+    assert ring.history.data.shape[0] == 4
+    assert np.array_equal(ring.times / ring.dt, [7, 8, 9, 10])
+    assert np.array_equal(ring.history.trajectory(), full.history.trajectory()[-4:])
+    order = ring.history._order()
+    assert ring.history._order() is order # cached until the next recorded step
+    ring.step()
+    assert np.array_equal(ring.times / ring.dt, [8, 9, 10, 11])
+    assert np.array_equal(ring.all_timestep_bodies[0][3].position, full.history.trajectory()[7, 3, :3])
+
+    final = run(record_final_only=True)
+    assert len(final.all_timestep_bodies) == 1
+    assert np.array_equal(final.history.trajectory()[0], full.history.trajectory()[-1])
+
+# Query Module Tests
+##############################
+
+def test_queries_match_frame_scans():
+    m = model.Model(seed=5, num_small=4, num_medium=1, num_large=0, duration=6*60*60*24)
+    m.run(record_last=8)
+    m.remove_body(m.asteroids[1])
+    for _ in range(4):
+        m.step()
+    frames = list(m.all_timestep_bodies)
+    q = query.TrajectoryQuery(m.history)
+    assert m.history.total > m.history.length # rolling window has wrapped
+
+    def position(frame, label):
+        return analysis.Analysis().find_by_label(frame, label).position
+    expected = [np.linalg.norm(position(f, 'earth') - position(f, 'mars')) for f in frames]
+    assert np.allclose(q.distances('earth', 'mars'), expected, rtol=1e-14)
+    assert q.min_separation('earth', 'mars') == (min(expected), int(np.argmin(expected)))
+    assert q.first_contact('earth', 'mars') is None
+    assert np.array_equal(q.find('earth', 2).position, position(frames[2], 'earth'))
+
+    counts = [sum(isinstance(b, store.BODY_CLASSES["Asteroid"]) for b in f) for f in frames]
+    assert np.array_equal(q.counts("Asteroid"), counts) and counts[0] == 5 and counts[-1] == 4
+    assert np.array_equal(q.counts(store.BODY_CLASSES["Planet"]), [9] * len(frames))
+    with pytest.raises(ValueError):
+        q.counts("Comet")
+
+# Store Module Tests
+##############################
+
+def test_store_round_trip(tmp_path):
+    path = str(tmp_path / "run.npy")
+    kwargs = dict(seed=2, num_small=3, num_medium=0, num_large=0, duration=20*60*60*24)
+    m = model.Model(history_path=path, **kwargs)
+    m.history.flush_every = 4
+    m.run()
+    ref = model.Model(**kwargs)
+    ref.run()
+
+    opened = store.TrajectoryStore.open(path)
+    assert isinstance(opened.data, np.memmap)
+    assert np.array_equal(opened.trajectory(), ref.history.trajectory())
+    assert np.array_equal(opened.timestamps(), ref.times)
+    assert [type(b).__name__ for b in opened.bodies][8:10] == ['Planet', 'Asteroid']
+
+    a = analysis.Analysis()
+    a.load_run("disk", path)
+    assert a.runs["disk"]["num_asteroids"] == 3
+    assert a.runs["disk"]["history"][-1][3].label == 'earth'
+    ani = animation.Animation(opened)
+    assert ani.set_size == 20
+
+def test_store_grows_for_adaptive_run(tmp_path):
+    path = str(tmp_path / "adaptive.npy")
+    m = model.Model(num_small=0, num_medium=0, num_large=0, integrator="dopri5", tolerance=1e-8,
+                    duration=60*60*24*30, history_path=path)
+    m.run()
+    opened = store.TrajectoryStore.open(path)
+    assert opened.length == len(m.times) > 1
+    assert np.array_equal(opened.trajectory(), m.history.trajectory())
+
+# Integrators Module Tests
+##############################
+
+def circular_orbit():
+    """Sun-mass body with a light body on a 1 AU circular orbit, returns (pos, vel, mass, period)"""
+    mass = np.array([2e30, 1.0])
+    r = 1.5e11
+    speed = np.sqrt(gravity.G * mass[0] / r)
+    pos = np.array([[0.0, 0, 0], [r, 0, 0]])
+    vel = np.array([[0.0, 0, 0], [0, speed, 0]])
+    return pos, vel, mass, 2 * np.pi * r / speed
+
+def test_rk4_closes_circular_orbit():
+    pos, vel, mass, period = circular_orbit()
+    steps = 200
+    x, v = pos, vel
+    for _ in range(steps):
+        x, v = integrators.rk4(x, v, period / steps, lambda p: gravity.accelerations(p, mass))
+    assert np.linalg.norm(x[1] - pos[1]) / np.linalg.norm(pos[1]) < 1e-4
+
+@pytest.mark.parametrize("name", integrators.INTEGRATORS)
+def test_integrators_close_circular_orbit(name):
+    pos, vel, mass, period = circular_orbit()
+    step = integrators.get_integrator(name)
+    x, v = pos, vel
+    for _ in range(400):
+        x, v = step(x, v, period / 400, lambda p: gravity.accelerations(p, mass))
+    assert np.linalg.norm(x[1] - pos[1]) / np.linalg.norm(pos[1]) < 1e-2
+
+def test_adaptive_step_meets_tolerance():
+    pos, vel, mass, period = circular_orbit()
+    x, v, dt, next_dt = integrators.adaptive_step(
+        integrators.dopri5, pos, vel, period / 4, lambda p: gravity.accelerations(p, mass), 1e-9)
+    assert dt < period / 4 # a quarter orbit is far too coarse and gets rejected
+    assert next_dt > 0
+    angle = 2 * np.pi * dt / period
+    expected = pos[1, 0] * np.array([np.cos(angle), np.sin(angle), 0])
+    assert np.linalg.norm(x[1] - expected) < 1e-6 * pos[1, 0]
+
+def test_adaptive_step_raises_instead_of_looping():
+    pos, vel, mass, period = circular_orbit()
+    with pytest.raises(ValueError):
+        integrators.adaptive_step(integrators.dopri5, pos, vel, period / 4,
+                                  lambda p: np.full_like(p, np.nan), 1e-9)
+    with pytest.raises(ValueError):
+        integrators.adaptive_step(integrators.dopri5, pos, vel, period / 4,
+                                  lambda p: gravity.accelerations(p, mass), 1e-9, min_dt=period / 8)
+
+def test_adaptive_model_run_reaches_duration():
+    m = model.Model(num_small=0, num_medium=0, num_large=0, integrator="dopri5",
+                    tolerance=1e-8, duration=3600*24*30)
+    history = m.run()
+    assert len(history) == len(m.times)
+    assert m.times[-1] == m.duration
+    assert np.all(np.diff(m.times) > 0)
+
+def test_block_timesteps_match_fine_global_step():
+    # fast inner orbit around the heavy body and a slow outer one
+    mass = np.array([2e30, 1e20, 1e20])
+    pos = np.array([[0.0, 0, 0], [5e10, 0, 0], [4e12, 0, 0]])
+    vel = np.array([[0.0, 0, 0], [0, np.sqrt(gravity.G * mass[0] / 5e10), 0], [0, np.sqrt(gravity.G * mass[0] / 4e12), 0]])
+    evaluated = np.zeros(3)
+    def acc(p, targets=None):
+        evaluated[np.arange(3) if targets is None else targets] += 1
+        return gravity.accelerations(p, mass, points=None if targets is None else p[targets])
+    timescale = lambda p, targets: gravity.dynamical_times(p, mass, targets=targets)
+
+    dt = 3600*24*16
+    x, v = pos, vel
+    for _ in range(4):
+        x, v = integrators.block_leapfrog(x, v, dt, acc, timescale)
+    # the outer body is stepped far less often than the inner one
+    assert evaluated[2] * 8 < evaluated[1]
+
+    ref_x, ref_v = pos, vel
+    for _ in range(4 * 256):
+        ref_x, ref_v = integrators.yoshida4(ref_x, ref_v, dt / 256, acc)
+    assert np.all(np.linalg.norm(x - ref_x, axis=1) < 1e-3 * np.linalg.norm(pos[1]))
+
+def test_kepler_drift_matches_fine_rk4():
+    mu = gravity.G * 2e30
+    # ellipse, hyperbola, inclined ellipse, parabola
+    pos = np.array([[1.5e11, 0, 0], [1.5e11, 0, 0], [1e11, 2e10, 3e9], [1.5e11, 0, 0]])
+    vel = np.array([[0, 29000, 0], [0, 60000, 0], [-3e3, 20000, 500], [0, np.sqrt(2 * mu / 1.5e11), 0]])
+    dt = 40 * 60*60*24
+    x, v = integrators.kepler_drift(pos, vel, mu, dt)
+    ref_x, ref_v = pos, vel
+    acc = lambda p: -mu * p / np.linalg.norm(p, axis=1)[:, None]**3
+    for _ in range(4000):
+        ref_x, ref_v = integrators.rk4(ref_x, ref_v, dt / 4000, acc)
+    assert np.all(np.linalg.norm(x - ref_x, axis=1) < 1.0)
+    assert np.all(np.linalg.norm(v - ref_v, axis=1) < 1e-6)
+
+def total_energy(m):
+    """Kinetic plus potential energy of a Model's state"""
+    x, v, mass = m.state.position, m.state.velocity, m.state.mass
+    i, j = np.triu_indices(len(mass), 1)
+    return 0.5 * mass @ np.einsum('ij,ij->i', v, v) - gravity.G * np.sum(mass[i] * mass[j] / np.linalg.norm(x[i] - x[j], axis=1))
+
+def test_wisdom_holman_long_steps():
+    kwargs = dict(num_small=0, num_medium=0, num_large=0, duration=2*365*60*60*24)
+    wh = model.Model(integrator="wh", dt=5*60*60*24, **kwargs)
+    rk4 = model.Model(integrator="rk4", dt=5*60*60*24, **kwargs)
+    reference = model.Model(integrator="rk4", dt=3*60*60, **kwargs)
+    e0 = total_energy(wh)
+    for m in (wh, rk4, reference):
+        m.run(record_final_only=True)
+    assert abs(total_energy(wh) / e0 - 1) < 1e-7 < 1e-5 < abs(total_energy(rk4) / e0 - 1)
+    # Mercury, Venus and Earth, relative to their distance from the Sun
+    distance = np.linalg.norm(reference.state.position - reference.sun.position, axis=1)[1:4]
+    wh_error = np.linalg.norm(wh.state.position - reference.state.position, axis=1)[1:4] / distance
+    rk4_error = np.linalg.norm(rk4.state.position - reference.state.position, axis=1)[1:4] / distance
+    assert np.all(wh_error < 1e-3) and np.all(wh_error < rk4_error)
+
+    # test particle asteroids drift around the Sun without moving the planets
+    particles = model.Model(integrator="wh", dt=5*60*60*24, test_particles=True, seed=4, **{**kwargs, "num_small": 10})
+    particles.run(record_final_only=True)
+    assert np.allclose(particles.state.position[:9], wh.state.position, rtol=0, atol=1.0)
+    with pytest.raises(ValueError):
+        model.Model(integrator="wh", ephemeris=True)
+
+def test_unknown_integrator():
+    with pytest.raises(ValueError):
+        model.Model(integrator="euler")
+
+# Collisions Module Tests
+##############################
+
+def test_colliding_pairs_match_brute_force():
+    rng = np.random.default_rng(5)
+    pos = rng.uniform(0, 100, (300, 3))
+    radius = rng.uniform(0.5, 3, 300)
+    expected = [(i, j) for i in range(300) for j in range(i + 1, 300)
+                if np.linalg.norm(pos[i] - pos[j]) < radius[i] + radius[j]]
+    assert len(expected) > 0
+    assert [tuple(p) for p in collisions.colliding_pairs(pos, radius)] == expected
+    assert len(collisions.candidate_pairs(pos, radius)) < 300 * 299 / 20
+    # building the candidates in small blocks gives the same pairs
+    margin = rng.uniform(0, 10, 300)
+    assert np.array_equal(collisions.candidate_pairs(pos, radius, margin, max_candidates=50),
+                          collisions.candidate_pairs(pos, radius, margin))
+
+# Ephemeris Module Tests
+##############################
+
+def test_ephemeris_run_matches_integrated_planets(tmp_path):
+    kwargs = dict(seed=3, duration=30*60*60*24, num_small=0, num_medium=0, num_large=5,
+                  small_detection=0, medium_detection=0, large_detection=0)
+    integrated = model.Model(test_particles=True, **kwargs)
+    integrated.run()
+    cached = model.Model(ephemeris=True, ephemeris_dir=str(tmp_path), **kwargs)
+    cached.run()
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+    # planets come straight from the ephemeris, asteroids only see interpolation error,
+    # apart from one that grazes the Sun where any difference is amplified
+    assert np.allclose(cached.state.position[:9], integrated.state.position[:9], rtol=0, atol=1.0)
+    error = np.linalg.norm(cached.state.position[9:] - integrated.state.position[9:], axis=1)
+    assert np.median(error) < 1.0
+
+    again = model.Model(ephemeris=True, ephemeris_dir=str(tmp_path), **kwargs)
+    assert again.ephemeris is cached.ephemeris
+    position, velocity = cached.ephemeris.at(cached.ephemeris.times[4])
+    assert np.array_equal(position, cached.ephemeris.position[4])
+    with pytest.raises(ValueError):
+        cached.ephemeris.at(cached.ephemeris.times[-1] + cached.dt)
+
+    # the process cache does not keep ephemerides that no Model uses any more
+    unused = weakref.ref(cached.ephemeris)
+    del cached, again
+    gc.collect()
+    assert unused() is None
+
+def test_ephemeris_follows_setup(tmp_path):
+    kwargs = dict(seed=1, duration=5*60*60*24, num_small=2, num_medium=0, num_large=0,
+                  small_detection=0, medium_detection=0, large_detection=0)
+    integrated = model.Model(test_particles=True, **kwargs)
+    analysis.scale_earth_velocity(integrated, 0.0)
+    integrated.run()
+
+    # setups of a plain run, a sweep and a branch all see their changed planets
+    cached = model.Model(ephemeris=True, ephemeris_dir=str(tmp_path), **kwargs)
+    analysis.scale_earth_velocity(cached, 0.0)
+    cached.run()
+    assert np.allclose(cached.state.position[:9], integrated.state.position[:9], rtol=0, atol=1.0)
+    rows = sweep.sweep([{"earth_vel_multi": 0.0}, {"earth_vel_multi": 1.0}], [1], ["earth_sun_distance"], workers=1,
+                       base=dict(kwargs, ephemeris=True, ephemeris_dir=str(tmp_path)), setup=analysis.scale_earth_velocity)
+    assert np.isclose(rows[0]["earth_sun_distance"], integrated.earth.distance_to(integrated.sun), rtol=1e-12)
+    assert rows[1]["earth_sun_distance"] > rows[0]["earth_sun_distance"]
+
+    prefix = branch.Branch(model.Model(ephemeris=True, ephemeris_dir=str(tmp_path), **kwargs))
+    with pytest.raises(ValueError): # the prefix already followed the unchanged planets
+        prefix.fork(setup=lambda m: analysis.scale_earth_velocity(m, 0.0))
+
+# Ensemble Module Tests
+##############################
+
+def test_batched_accelerations_match_each_system():
+    rng = np.random.default_rng(2)
+    pos = rng.normal(0, 1e11, (4, 30, 3))
+    mass = rng.uniform(1e20, 1e25, (4, 30))
+    mass[1, 20:] = 0 # padding
+    acc = gravity.batched_accelerations(pos, mass, max_pairs=100)
+    for k in range(4):
+        expected = gravity.accelerations(pos[k], mass[k])
+        assert np.allclose(acc[k], expected, rtol=1e-12, atol=0)
+
+@pytest.mark.parametrize("kwargs", [{}, {'integrator': 'leapfrog'}, {'test_particles': True}, {'ephemeris': True}])
+def test_ensemble_matches_separate_runs(kwargs, tmp_path):
+    if kwargs.get('ephemeris'):
+        kwargs = {**kwargs, 'ephemeris_dir': str(tmp_path)}
+    def members():
+        return [model.Model(seed=seed, duration=20*60*60*24, dart_distance=3e10, num_small=n, **kwargs)
+                for seed, n in [(1, 10), (2, 4), (3, 7)]]
+    separate = members()
+    for m in separate:
+        m.run()
+    together = members()
+    ensemble.Ensemble(together).run()
+    assert sum(m.num_intercepted for m in separate) > 0
+    for a, b in zip(separate, together):
+        assert (a.num_intercepted, a.num_asteroids_collided) == (b.num_intercepted, b.num_asteroids_collided)
+        assert np.array_equal(a.history.trajectory(), b.history.trajectory(), equal_nan=True)
+
+def test_ensemble_rejects_mismatched_members():
+    with pytest.raises(ValueError):
+        ensemble.Ensemble([model.Model(), model.Model(dt=3600)])
+
+# Sweep Module Tests
+##############################
+
+def test_sweep_is_independent_of_worker_count():
+    grid = {"dart_speed": [3000, 20000], "num_small": [3, 6]}
+    base = dict(duration=10*60*60*24, dart_distance=3e10, num_medium=1, num_large=1)
+    metrics = ["num_asteroids", "num_intercepted", "protection_rate"]
+    serial = sweep.sweep(grid, [1, 2], metrics, base=base, workers=1)
+    parallel = sweep.sweep(grid, [1, 2], metrics, base=base, workers=3, batch=1)
+    assert serial == parallel
+    assert [(r["dart_speed"], r["num_small"], r["seed"]) for r in serial][:3] == [(3000, 3, 1), (3000, 3, 2), (3000, 6, 1)]
+    assert list(sweep.mean_over_seeds(serial, "num_asteroids", [1, 2])) == [5, 8, 5, 8]
+
+def test_sweep_setup_and_parameter_checks():
+    rows = sweep.sweep([{"earth_vel_multi": 0.0}], [1], ["earth_sun_distance"], workers=1,
+                       base=dict(duration=5*60*60*24, num_small=0, num_medium=0, num_large=0),
+                       setup=analysis.scale_earth_velocity)
+    assert rows[0]["earth_sun_distance"] < data.EARTH.distance_to(data.SUN) # Earth at rest falls inwards
+    with pytest.raises(ValueError):
+        sweep.sweep({"earth_vel_multi": [1.0]}, [1])
+    with pytest.raises(ValueError):
+        sweep.sweep({"dart_speed": [1.0]}, [0])
+
+# Events Module Tests
+##############################
+
+def test_threshold_crossings_of_straight_lines():
+    r0 = np.array([[-10.0, 3, 0], [-10.0, 30, 0], [1.0, 0, 0], [-10.0, 4.9, 0]])
+    v = np.array([[20.0, 0, 0]] * 4)
+    r1 = r0 + v
+    crossing = events.threshold_crossings(r0, v, r1, v, 1.0, 5.0)
+    assert abs(crossing[0] - (10 - 4) / 20) < 1e-9 # enters at x = -4
+    assert np.isnan(crossing[1]) and crossing[2] == 0
+    assert abs(crossing[3] - (10 - np.sqrt(25 - 4.9**2)) / 20) < 1e-9 # grazes inside between samples
+
+# Checkpoint Module Tests
+##############################
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_resumed_run_matches_uninterrupted_run(on_disk, tmp_path):
+    kwargs = dict(seed=3, num_small=20, num_medium=5, num_large=2, asteroid_distance_mean=0.3*model.AU,
+                  dart_distance=5e9, dart_speed=1e5, duration=40*60*60*24)
+    history_path = str(tmp_path / "run.npy") if on_disk else None
+    path = str(tmp_path / "run.ckpt")
+    full = model.Model(history_path=history_path, **kwargs)
+    full.run(record_every=3, checkpoint_path=path, checkpoint_every=6) # last checkpoint at day 36
+
+    resumed = model.Model.resume(path)
+    assert resumed.time == 36*60*60*24 and len(resumed.dart_launches) == 5 and not resumed.impacts
+    resumed.run(record_every=3)
+    assert len(resumed.impacts) == len(full.impacts) == 1 and resumed.summary() == full.summary()
+    assert np.array_equal(resumed.state.position, full.state.position)
+    assert np.array_equal(resumed.history.trajectory(), full.history.trajectory(), equal_nan=True)
+    assert np.array_equal(resumed.times, full.times)
+    assert [b.label for b in resumed.history.bodies] == [b.label for b in full.history.bodies]
+    assert resumed.rng.random() == full.rng.random()
+
+# Branch Module Tests
+##############################
+
+def test_forks_match_full_runs():
+    kwargs = dict(seed=1, num_small=20, num_medium=5, num_large=2, asteroid_distance_mean=0.4*model.AU,
+                  dart_distance=5e9, duration=30*60*60*24)
+    prefix = branch.Branch(model.Model(**kwargs), record_final_only=True)
+    assert prefix.launched and 0 < prefix.model.time < kwargs["duration"] and not prefix.model.dart_launches
+    for speed in (6600, 1e5):
+        fork = prefix.run(dart_speed=speed)
+        full = model.Model(dart_speed=speed, **kwargs)
+        full.run(record_final_only=True)
+        assert fork.summary() == full.summary() and len(fork.dart_launches) > 0
+        assert np.array_equal(fork.state.position, full.state.position)
+        assert np.array_equal(fork.history.trajectory(), full.history.trajectory(), equal_nan=True)
+
+    baseline = prefix.run(setup=analysis.cancel_darts)
+    no_darts = model.Model(**{**kwargs, "small_detection": 0, "medium_detection": 0, "large_detection": 0})
+    no_darts.run(record_final_only=True)
+    assert not baseline.dart_launches and np.array_equal(baseline.state.position, no_darts.state.position)
+    with pytest.raises(ValueError):
+        prefix.fork(dart_sped=1e5)
+
 # Model Module Tests
 ##############################
 
+def test_test_particle_asteroids_do_not_perturb_planets():
+    kwargs = dict(seed=3, duration=30*60*60*24, asteroid_mass_large=1e28, num_small=0, num_medium=0, num_large=5)
+    planets_only = model.Model(**{**kwargs, 'num_large': 0})
+    planets_only.run()
+    particles = model.Model(test_particles=True, **kwargs)
+    particles.run()
+    assert np.array_equal(particles.history.trajectory()[:, :9], planets_only.history.trajectory())
+    assert not np.any(np.isnan(particles.history.trajectory()[-1]))
+
+def test_asteroid_population_uses_model_rng():
+    kwargs = dict(num_small=2000, num_medium=1000, num_large=0, small_detection=0.25, medium_detection=1.0)
+    np.random.seed(7)
+    expected = np.random.random()
+    np.random.seed(7)
+    a, b = model.Model(seed=4, **kwargs), model.Model(seed=4, **kwargs)
+    assert np.random.random() == expected # the global stream is left alone
+    assert np.array_equal(a.state.position, b.state.position)
+    flags = np.array([x.will_be_intercepted for x in a.asteroids])
+    assert np.all(flags[2000:]) and 0.2 < np.mean(flags[:2000]) < 0.3
+
+    children = np.random.SeedSequence(4).spawn(2)
+    c, d = model.Model(seed=children[0], **kwargs), model.Model(seed=children[1], **kwargs)
+    assert not np.allclose(c.state.position[9:], d.state.position[9:])
+    assert np.array_equal(c.state.position, model.Model(seed=np.random.SeedSequence(4).spawn(2)[0], **kwargs).state.position)
+
+def test_dart_launch_time_does_not_depend_on_dt():
+    from asteroid import Asteroid
+    launches = []
+    for dt in (3600, 600):
+        m = model.Model(num_small=0, num_medium=0, num_large=0, dt=dt, dart_distance=1e9, dart_speed=1e5)
+        a = Asteroid(m.earth.position + [-2e9, 5e8, 0], m.earth.velocity + [20000.0, 0, 0],
+                     m.asteroid_mass_small, m.asteroid_radius_small, m, will_be_intercepted=True)
+        m.asteroids.append(a)
+        m.add_body(a)
+        for _ in range(86400 // dt):
+            m.step()
+        assert a.intercepted and len(m.dart_launches) == 1
+        launches.append((m.dart_launches[0][0], a.position.copy()))
+    (t1, p1), (t2, p2) = launches
+    assert abs(t1 - t2) < 1e-3 and t1 % 3600 > 1
+    assert np.linalg.norm(p1 - p2) < 1e3
+
+def test_close_encounter_substeps_resolve_flyby():
+    from asteroid import Asteroid
+    def flyby(dt, encounter_radius):
+        m = model.Model(num_small=0, num_medium=0, num_large=0, dt=dt, encounter_radius=encounter_radius)
+        a = Asteroid(m.earth.position + [-8e8, 2e7, 0], m.earth.velocity + [1e4, 0, 0],
+                     m.asteroid_mass_small, m.asteroid_radius_small, m, will_be_intercepted=False)
+        m.asteroids.append(a)
+        m.add_body(a)
+        for _ in range(2 * 86400 // dt):
+            m.step()
+        return m, a.position - m.earth.position
+    _, reference = flyby(60, 0)
+    refined, position = flyby(86400, 1)
+    _, coarse = flyby(86400, 0)
+    assert np.linalg.norm(position - reference) < 1e4
+    assert np.linalg.norm(coarse - reference) > 1e7
+    assert [e[2] > 1 for e in refined.encounters] == [True, True]
+
+def tunnelling_asteroid(test_model, time_to_center=None):
+    """Asteroid aimed at Earth's center, which it would reach halfway through a step without gravity"""
+    from asteroid import Asteroid
+    earth = test_model.earth
+    rel_vel = np.array([0.0, 21000, 0])
+    pos = earth.position - rel_vel * (test_model.dt / 2 if time_to_center is None else time_to_center)
+    return Asteroid(pos, earth.velocity + rel_vel, test_model.asteroid_mass_small,
+                    test_model.asteroid_radius_small, test_model)
+
+def test_swept_collision_catches_tunnelling():
+    def impact(dt, **kwargs):
+        m = model.Model(num_small=0, num_medium=0, num_large=0, dt=dt, **kwargs)
+        asteroid = tunnelling_asteroid(m, time_to_center=86400 / 2)
+        asteroid.will_be_intercepted = False
+        m.asteroids.append(asteroid)
+        m.add_body(asteroid)
+        for _ in range(86400 // dt):
+            m.step()
+        assert m.num_asteroids_collided == 1
+        time, body1, body2 = m.impacts[0]
+        assert body1 is m.earth and body2 is asteroid
+        return time
+    # the path curves into Earth within the step, the impact is found along the encounter substeps
+    reference = impact(60)
+    assert abs(impact(86400) - reference) < 60
+    assert impact(86400, swept_collisions=False) == 86400
+
+def test_swept_collisions_same_step_with_bystander():
+    from asteroid import Asteroid
+    def setup(*offsets):
+        m = model.Model(num_small=0, num_medium=0, num_large=0, encounter_radius=0)
+        m.earth.mass = 1e16 # negligible gravity, still far heavier than the asteroids
+        bodies = [tunnelling_asteroid(m) for _ in offsets]
+        for a, offset in zip(bodies, offsets):
+            a.position = a.position + offset
+            a.will_be_intercepted = False
+            m.asteroids.append(a)
+            m.add_body(a)
+        return m, bodies
+    far = [3e10, 0, 0]
+    # the first row hits first, removing it shifts the rows of the others
+    m, (first, second, bystander) = setup([0, 0.2 * 21000 * 86400, 1e6], [0, 0, 0], far)
+    m.step()
+    assert m.num_asteroids_collided == 2
+    assert [(b1, b2) for _, b1, b2 in m.impacts] == [(m.earth, first), (m.earth, second)]
+    assert first.state is None and second.state is None and bystander.state is m.state
+
+    alone, (reference,) = setup(far)
+    alone.step()
+    assert np.allclose(bystander.position, reference.position, rtol=0, atol=1.0)
+
 def test_temp():
     pass
\ No newline at end of file
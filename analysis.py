@@ -16,12 +16,38 @@ Assumptions about Model
     - .mass (number in kg)
     - .radius (number in meters)
 """
-import body
+import diagnostics
 import numpy as np
 import matplotlib.pyplot as plt
 from model import Model
+from sweep import sweep, mean_over_seeds
+from branch import Branch, branch_sweep
 import animation
 import data
+from history import HistoryView
+from store import TrajectoryStore
+from query import TrajectoryQuery
+from asteroid import Asteroid
+
+
+def scale_earth_velocity(m, earth_vel_multi):
+    """Sweep setup that scales Earth's starting velocity.
+
+    Args:
+        m (Model): Model before it is run
+        earth_vel_multi (float): Multiplier on Earth's velocity from data.py
+    """
+    m.earth.velocity = data.EARTH.velocity * earth_vel_multi
+
+
+def cancel_darts(m):
+    """Branch setup that stops any further DART launches, used as the no DART baseline.
+
+    Args:
+        m (Model): Forked Model before its launch
+    """
+    for a in m.asteroids:
+        a.will_be_intercepted = False
 
 
 #========================================Data Storage methods=============================================
@@ -33,11 +59,14 @@ class Analysis:
 
 
 
-    def add_runs(self, name, history, num_asteroids, num_intercepted, num_asteroids_collided, num_intercepted_collided, dt):
+    def add_runs(self, name, history, num_asteroids, num_intercepted, num_asteroids_collided, num_intercepted_collided, dt, times=None, diagnostics=None):
 
         """
         Takes one run adds its information into the dictionary to be used later.
         Needs to be updated to be automated with a loop once model is completed
+        times is the simulation time of each history entry (Model.times), needed for adaptive runs
+        where the timesteps are not uniform
+        diagnostics is the Model's Diagnostics, energy and momentum sampled during the run
         """
         self.runs[name] = {
             "history" : history,
@@ -45,12 +74,54 @@ class Analysis:
             "num_intercepted": num_intercepted, 
             "num_asteroids_collided": num_asteroids_collided,
             "num_intercepted_collided": num_intercepted_collided,
-            "dt": dt} 
+            "dt": dt,
+            "times": times,
+            "diagnostics": diagnostics} 
+
+
+    def load_run(self, name, path):
+        """
+        Adds a run recorded to disk with Model(history_path=...) without re-simulating it.
+        The trajectory stays memory-mapped, only the steps that are looked at are read
+        """
+        store = TrajectoryStore.open(path)
+        info = store.info
+        self.add_runs(name,
+                      HistoryView(store),
+                      info.get("num_asteroids", 0),
+                      info.get("num_intercepted", 0),
+                      info.get("num_asteroids_collided", 0),
+                      info.get("num_intercepted_collided", 0),
+                      info.get("dt"),
+                      store.timestamps())
+
+
+    def get_times(self, run_name, length):
+        """
+        Time in seconds of the first length history entries of a run.
+        Uses the recorded timestamps when available, otherwise assumes uniform steps of dt
+        """
+        times = self.runs[run_name].get("times")
+        if times is not None and len(times) >= length:
+            return np.asarray(times[:length])
+        return np.arange(1, length + 1) * self.runs[run_name]["dt"]
 
     
+    def query(self, run_name):
+        """
+        Whole-run queries of a run whose history is array-backed (Model.all_timestep_bodies
+        or load_run), None for a plain list of frames. See query.py
+        """
+        history = self.runs[run_name]["history"]
+        if isinstance(history, HistoryView):
+            return TrajectoryQuery(history.buffer)
+        return None
+
+
     def find_by_label(self, bodies, label):
         """
         Find bodies by their labels
+        Use query(run_name).find to look a label up in an array-backed run
         """
         for i in range(len(bodies)):
             if bodies[i].label == label: 
@@ -64,7 +135,15 @@ class Analysis:
         """
         Checks to see if collision has happened. 
         If it has then collects the time step it happened on
+        Bodies are labels, array-backed runs also take permanent body IDs (Body.id)
         """
+        query = self.query(run_name)
+        if query is not None:
+            try:
+                return query.first_contact(body_1, body_2)
+            except ValueError: # body not in the run
+                return None
+
         history = self.runs[run_name]["history"]
         collision_time_step = 0
 
@@ -104,49 +183,36 @@ class Analysis:
         Calculates the sum of kinetic energy  and potential energy for all bodies
         at certain timestep when collision happens 
         KE Formula = 0.5 * mass * speed^2
-        Speed: sqrt of velocity vector 
-        PE Formula = -G * mass1 * mass2 / distance
-        G = gravitation constant 
-        distance = distance between two bodies 
+        PE Formula = -G * mass1 * mass2 / distance, summed over every pair
         Total energy = KE + PE
         """
-        kinetic_energy = 0
-        potential_energy = 0
-        
-        for b in bodies:
-            mass = b.mass
-            velocity = b.velocity 
-            speed = np.linalg.norm(velocity)
-            kinetic_energy += 0.5 * mass * (speed ** 2)
-
-        for i in range (len(bodies)):
-            for j in range(i+1, len(bodies)):
-                body_1 = bodies[i]
-                body_2 = bodies[j]
-                mass_1 = body_1.mass
-                mass_2 = body_2.mass
-                distance = body_1.distance_to(body_2)
-                if distance == 0:
-                    continue 
-                potential_energy += -body.G * mass_1 * mass_2 / distance
-      
-
-        return kinetic_energy + potential_energy
+        position, velocity, mass = self.body_arrays(bodies)
+        return diagnostics.total_energy(position, velocity, mass)
+
+
+    def body_arrays(self, bodies):
+        """
+        Positions, velocities and masses of a list of bodies as arrays
+        """
+        position = np.array([b.position for b in bodies], dtype=float).reshape(-1, 3)
+        velocity = np.array([b.velocity for b in bodies], dtype=float).reshape(-1, 3)
+        mass = np.array([b.mass for b in bodies], dtype=float)
+        return position, velocity, mass
             
     
     def check_conservation_of_energy(self, run_name):
         """
         Checks for conservation of energy and results will be used for plotting 
         to show verification of the model. Tracks total energy between all bodies
+        Uses the energy sampled during the run when the run has diagnostics,
+        otherwise every step of the history
         """
-        history = self.runs[run_name]["history"]
-        energy = []
+        diag = self.runs[run_name].get("diagnostics")
+        if diag is not None and len(diag.times):
+            return list(diag.energy)
 
-        for time_step in history:
-            bodies = time_step
-            energy.append(self.calculate_total_energy(bodies))
-        
-        return energy
+        history = self.runs[run_name]["history"]
+        return [self.calculate_total_energy(bodies) for bodies in history]
 
 
     def calculate_total_momentum(self, bodies):
@@ -155,41 +221,34 @@ class Analysis:
         Used later to check conservation of momentum to verify the system
         Returns both directional momentum and magnitude to be anaylized later
         """
-
-        momentum_x = 0
-        momentum_y = 0
-
-        for b in bodies:
-            mass = b.mass
-            velocity_x = b.velocity[0]
-            velocity_y = b.velocity[1]
-
-            momentum_x += mass * velocity_x
-            momentum_y += mass * velocity_y
-
-        total_momentum = np.array([momentum_x, momentum_y])
-        magnitude  = np.linalg.norm(total_momentum)
-
-        return total_momentum, magnitude
-
-
-
+        _, velocity, mass = self.body_arrays(bodies)
+        total_momentum = diagnostics.linear_momentum(velocity, mass)
+        return total_momentum, np.linalg.norm(total_momentum)
 
 
     def check_conservation_of_momentum(self, run_name):
         """
         Checks to see if the momentum is conserved
+        Uses the momentum sampled during the run when the run has diagnostics,
+        otherwise every step of the history
         """
+        diag = self.runs[run_name].get("diagnostics")
+        if diag is not None and len(diag.times):
+            return list(diag.momentum)
 
         history = self.runs[run_name]["history"]
-        momentums = []
+        return [self.calculate_total_momentum(bodies)[0] for bodies in history]
 
-        for time_step in history:
-            bodies = time_step
-            momentum, magnitude = self.calculate_total_momentum(bodies)
-            momentums.append(momentum)
 
-        return momentums
+    def get_conservation_times(self, run_name, length):
+        """
+        Time in seconds of the energy and momentum values of a run, the sample times
+        of its diagnostics when it has them, otherwise those of its history
+        """
+        diag = self.runs[run_name].get("diagnostics")
+        if diag is not None and len(diag.times):
+            return diag.times[:length]
+        return self.get_times(run_name, length)
 
 #=========================================================================================
 
@@ -201,9 +260,7 @@ class Analysis:
         Plot of energy over time 
         """
         energy = self.check_conservation_of_energy(run_name)
-        length = len(energy)
-        dt = self.runs[run_name]["dt"]
-        time_step = np.array(range(length)) * dt
+        time_step = self.get_conservation_times(run_name, len(energy))
         
         err = self.relative_error(energy[0], energy[-1])
         print(f'Energy Relative Error: {err}')
@@ -220,9 +277,7 @@ class Analysis:
         Plots the magnitude of momentum vector against the timesteps
         """
         momentum = self.check_conservation_of_momentum(run_name)
-        length = len(momentum)
-        dt = self.runs[run_name]["dt"]
-        time_step = np.array(range(length)) * dt
+        time_step = self.get_conservation_times(run_name, len(momentum))
         magnitudes = [np.linalg.norm(m) for m in momentum]
 
         err = self.relative_error(magnitudes[0], magnitudes[-1])
@@ -241,25 +296,23 @@ class Analysis:
         WITHOUT modifying Body or Model.
         """
         history = self.runs[run_name]["history"]
-        dt = self.runs[run_name]["dt"]
         total_asteroids = self.runs[run_name]["num_asteroids"]
 
-        success_rates = []
-
-        for timestep in history:
-            # Identify asteroids
-            asteroids_remaining = len([b for b in timestep if "asteroid" in b.label])
-            
+        # Asteroids remaining at each timestep
+        query = self.query(run_name)
+        if query is not None:
+            asteroids_remaining = query.counts(Asteroid)
+        else:
+            asteroids_remaining = np.array([sum(isinstance(b, Asteroid) for b in timestep) for timestep in history])
 
-            if total_asteroids == 0:
-                success_rates.append(100)
-            else:
-                # Success rate = % of asteroids that did NOT collide
-                success = (asteroids_remaining / total_asteroids) * 100
-                success_rates.append(success)
+        if total_asteroids == 0:
+            success_rates = np.full(len(history), 100.0)
+        else:
+            # Success rate = % of asteroids that did NOT collide
+            success_rates = asteroids_remaining / total_asteroids * 100
 
         # Time array
-        time_array = np.arange(len(history)) * dt
+        time_array = self.get_times(run_name, len(history))
         plt.plot(time_array, success_rates)
         plt.title("Protection Rate over Time")
         plt.xlabel("Time (seconds)")
@@ -343,39 +396,23 @@ class Analysis:
 
 #========================================Sensitivity Analysis=============================================
 
-    def dart_speed_analysis(self, speed_values):
+    def dart_speed_analysis(self, speed_values, seeds=(1,), workers=None):
         """
         Calls the Model seperatetly to anaylize different speeds for darts 
-        and see how it affects trackable data, aka num_intercepted, num_failed_interception and num_collided
+        and see how it affects trackable data, aka num_intercepted, num_failed_interception and num_collided.
+        Each seed simulates the approach up to the first launch once and forks every speed from there.
+        Seeds are spread over a process pool and every rate is averaged over the seeds.
         """
  
-        interception_rates = []
-        failed_interception_rates = []
-        protection_rates = []
-
-        for speed in speed_values:
-            m = Model(
-            dart_speed=speed, 
+        rows = branch_sweep({"dart_speed": speed_values}, seeds, workers=workers, base=dict(
             collision_elasticity=1, 
             duration=3600*24*7,  
             dt=300,
-            #store_history=True
-        )
-            history = m.run()
-
-            run_name = f"speed_{speed}"
-            self.add_runs(run_name, 
-                    history, 
-                    m.num_asteroids,
-                    m.num_intercepted, 
-                    m.num_asteroids_collided, 
-                    m.num_intercepted_collided, 
-                    m.dt)
-
-            #calculate Metrics 
-            interception_rates.append(self.calculate_interception_rate(run_name))
-            failed_interception_rates.append(self.calculate_failed_interception_rate(run_name))
-            protection_rates.append(self.calculate_success_rate(run_name))
+            ephemeris=True,
+        ))
+        interception_rates = mean_over_seeds(rows, "interception_rate", seeds)
+        failed_interception_rates = mean_over_seeds(rows, "failed_interception_rate", seeds)
+        protection_rates = mean_over_seeds(rows, "protection_rate", seeds)
 
             # Plot results
         plt.figure(figsize=(12, 5))
@@ -407,33 +444,16 @@ class Analysis:
         plt.show()
 
 
-    def dart_mass_analysis(self, mass_values):
+    def dart_mass_analysis(self, mass_values, seeds=(1,), workers=None):
 
         """
         Similar to speed analysis but analyzes the results with different dart masses
         """
-        interception_rates = []
-        failed_interception_rates = []
-        protection_rates = []
-
-        for mass in mass_values:
-            m = Model(dart_mass=mass, collision_elasticity=1, 
-                  duration=3600*2, dt=300)
-
-            history = m.run()
-
-            run_name = f"mass{mass}"
-            self.add_runs(run_name, 
-                    history, 
-                    m.num_asteroids,
-                    m.num_intercepted, 
-                    m.num_asteroids_collided, 
-                    m.num_intercepted_collided, 
-                    m.dt)
-        
-            interception_rates.append(self.calculate_interception_rate(run_name))
-            failed_interception_rates.append(self.calculate_failed_interception_rate(run_name))
-            protection_rates.append(self.calculate_success_rate(run_name))
+        rows = branch_sweep({"dart_mass": mass_values}, seeds, workers=workers, base=dict(
+            collision_elasticity=1, duration=3600*2, dt=300, ephemeris=True))
+        interception_rates = mean_over_seeds(rows, "interception_rate", seeds)
+        failed_interception_rates = mean_over_seeds(rows, "failed_interception_rate", seeds)
+        protection_rates = mean_over_seeds(rows, "protection_rate", seeds)
 
             # Plot results
         plt.figure(figsize=(12, 5))
@@ -460,26 +480,24 @@ class Analysis:
 
 
     def body_offset_analysis(self, seed=12):
-        """Compares Body ending positions in two different models with the same seed
+        """Compares Body ending positions in two different models with the same seed.
+        The run is simulated once up to the DART launch, and the baseline without DARTs and
+        every DART mass are forked from there.
 
         Args:
             seed (float): random seed
         """
-        from asteroid import Asteroid
+        branch = Branch(Model(seed=seed, duration=3600*24*60, dt=60*60*24, dart_distance=1e20, small_detection=1.0, medium_detection=1.0, large_detection=1.0), # Add parameters here
+                        record_final_only=True)
         # Model with no DARTs
-        m_base = Model(seed=seed, dart_mass=610, duration=3600*24*60, dt=60*60*24, dart_distance=1e20, small_detection=0, medium_detection=0, large_detection=0) # Add parameters here
-        h = m_base.run()
-        end_base = h[-1][9:] # Ignore planets (first 9)
+        end_base = branch.run(setup=cancel_darts).all_timestep_bodies[-1][9:] # Ignore planets (first 9)
         num_asteroids = len(end_base)
         masses = [300, 600, 900, 1200, 1500, 1800]
         # masses = [300, 600, 900]
         all_distances = np.zeros((len(masses),))
         for im, mass in enumerate(masses):
             print(f"Testing Mass: {mass}")
-            m = Model(seed=seed, duration=3600*24*60, dt=60*60*24, dart_mass=mass, dart_distance=1e20, small_detection=1.0, medium_detection=1.0, large_detection=1.0) # Add different parameters here
-            for ast in m.asteroids: # somehow this wasnt being set??
-                ast.model = m
-            end = m.run()[-1][9:]
+            end = branch.run(dart_mass=mass).all_timestep_bodies[-1][9:] # Add different parameters here
         
             distances = np.zeros((num_asteroids,))
             # Get distance of all bodies
@@ -507,29 +525,17 @@ class Analysis:
         plt.show()
         
 # Testing Earth's velocity at different percentages. Doesn't Run. 
-    def stability_test(self):
+    def stability_test(self, seeds=(1,), workers=None):
 
         velocities = [0.3, 0.7, ] # at 70, 100, 150 %
-        results = []
         AU = 149_597_900_000
 
         print("Testing Velocity")
 
-        for multiplier in velocities:
-            m = Model(duration = 3600 * 24 * 365 * 5, dt = 60 * 60 * 24,num_small=0, num_medium=0, num_large=0)
-            m.earth.velocity = data.EARTH.velocity * multiplier
-            history = m.run()
-
-            last_timestep = history[-1]
-
-            earth = self.find_by_label(last_timestep, "earth")
-            sun = self.find_by_label(last_timestep, "sun")
-
-            distance_meters = earth.distance_to(sun)
-            
-            distance_au = distance_meters / AU
-
-            results.append(distance_au)
+        rows = sweep({"earth_vel_multi": velocities}, seeds, metrics=["earth_sun_distance"], workers=workers,
+                     base=dict(duration = 3600 * 24 * 365 * 5, dt = 60 * 60 * 24 * 5, integrator="wh", num_small=0, num_medium=0, num_large=0),
+                     setup=scale_earth_velocity)
+        results = mean_over_seeds(rows, "earth_sun_distance", seeds) / AU
 #
 
         print("Final Distance")
@@ -546,17 +552,13 @@ class Analysis:
         plt.show()
 
 
-    def asteroids_within_range(self, range=149_597_900_000*.01):
+    def asteroids_within_range(self, range=149_597_900_000*.01, seeds=(1,), workers=None):
         AU = 149_597_900_000
         asteriod_spawn_dists = [.1*AU, .2*AU, .3*AU, .4*AU, .5*AU, AU, 2*AU, 3*AU]
-        nums = np.zeros(len(asteriod_spawn_dists))
-        for x, dist in enumerate(asteriod_spawn_dists):
-            print(x, dist)
-            m = Model(dart_distance=range, asteroid_distance_mean=dist, asteroid_distance_SD=.3*dist, dart_speed=0, small_detection=1, medium_detection=1, num_small=100, num_medium=0, num_large=0, duration=3600*24*20, seed=x)
-            history = m.run()
-            nums[x] = m.num_intercepted
-            del m          
-
+        spawns = [{"asteroid_distance_mean": dist, "asteroid_distance_SD": .3*dist} for dist in asteriod_spawn_dists]
+        rows = sweep(spawns, seeds, metrics=["num_intercepted"], workers=workers,
+                     base=dict(dart_distance=range, dart_speed=0, small_detection=1, medium_detection=1, num_small=100, num_medium=0, num_large=0, duration=3600*24*20, ephemeris=True))
+        nums = mean_over_seeds(rows, "num_intercepted", seeds)
         
         plt.plot(asteriod_spawn_dists, nums)
         plt.title("Asteroid Spawn Distance vs Percent within 0.01AU")
@@ -594,7 +596,9 @@ class Analysis:
             m.num_intercepted,
             m.num_asteroids_collided,
             m.num_intercepted_collided,
-            m.dt
+            m.dt,
+            m.times,
+            m.diagnostics
         )
         
         # Generate plots
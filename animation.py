@@ -28,6 +28,7 @@ Future Development:
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import numpy as np
+from history import TrajectoryBuffer, HistoryView
 
 # Global Variables
 VALID_CENTERS = ["sun", "earth", "asteroid"]
@@ -73,9 +74,17 @@ class Animation(object):
         [earth, mars, ...],
         ...
         ]
+        May also be a HistoryView or TrajectoryBuffer (e.g. an opened
+        TrajectoryStore), in which case time steps are read lazily as they
+        are drawn.
         * AU: Astronomical Unit in meters
         '''
-        self.data_set = np.array(bodies, dtype=object)
+        if isinstance(bodies, TrajectoryBuffer):
+            bodies = HistoryView(bodies)
+        if isinstance(bodies, HistoryView):
+            self.data_set = bodies
+        else:
+            self.data_set = np.array(bodies, dtype=object)
         self.set_size = len(bodies)
         self.AU = AU
     
@@ -162,16 +171,6 @@ class Animation(object):
         Returns a FuncAnimation complete with all time steps from
         data_set class attribute.
         '''
-        # List of center corrected body positions.
-        all_centered = []
-        for frame in range(self.set_size):
-            xs, ys = self.__get_centered_positions(frame)
-            all_centered.append((xs, ys))
-
-        # Updated x and y values for center corrected body positions.
-        xs = np.array([x for frame in all_centered for x in frame[0]])
-        ys = np.array([y for frame in all_centered for y in frame[1]])
-
         xlim = (-self.AU * self.multiplier, self.AU * self.multiplier)
         ylim = (-self.AU * self.multiplier, self.AU * self.multiplier)
 
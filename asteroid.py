@@ -7,24 +7,54 @@ class Asteroid(Body):
     intercepted = False # whether or not this asteroid has been intercepted by a DART before
     will_be_intercepted = False
     
-    def __init__(self, pos, vel, mass, radius, model):
+    def __init__(self, pos, vel, mass, radius, model, will_be_intercepted=None):
         super().__init__(pos, vel, mass, radius, model)
         
+        if will_be_intercepted is not None: # drawn for the whole population by Model.init_asteroids
+            self.will_be_intercepted = bool(will_be_intercepted)
+            return
         match radius:
             case model.asteroid_radius_small:
-                self.will_be_intercepted = np.random.uniform() < model.small_detection
+                self.will_be_intercepted = model.rng.random() < model.small_detection
             case model.asteroid_radius_medium:
-                self.will_be_intercepted = np.random.uniform() < model.medium_detection
+                self.will_be_intercepted = model.rng.random() < model.medium_detection
             case model.asteroid_radius_large:
-                self.will_be_intercepted = np.random.uniform() < model.large_detection
+                self.will_be_intercepted = model.rng.random() < model.large_detection
+
+    @classmethod
+    def population(cls, positions, velocities, masses, radii, model, will_be_intercepted):
+        """Creates many detached asteroids at once from arrays, skipping the per-value checks
+        and copies of __init__. Each asteroid keeps a row view of the given arrays until it is
+        added to a SystemState.
+
+        Args:
+            positions (np.ndarray): (n, 3) positions
+            velocities (np.ndarray): (n, 3) velocities
+            masses (np.ndarray): (n,) masses
+            radii (np.ndarray): (n,) radii
+            model (Model): Model the asteroids belong to
+            will_be_intercepted (np.ndarray): (n,) whether a DART will be launched at each asteroid
+
+        Returns:
+            list: the new asteroids
+        """
+        asteroids = []
+        for pos, vel, mass, radius, hit in zip(np.asarray(positions, dtype=float), np.asarray(velocities, dtype=float),
+                                               np.asarray(masses).tolist(), np.asarray(radii).tolist(),
+                                               np.asarray(will_be_intercepted).tolist()):
+            a = cls.__new__(cls)
+            a.__dict__.update(_position=pos, _velocity=vel, _mass=mass, _radius=radius,
+                              model=model, label="", will_be_intercepted=hit)
+            asteroids.append(a)
+        return asteroids
 
     
     def update_collision_data(self, other):
-        if other is Dart:
+        if isinstance(other, Dart):
             self.intercepted = True
         if other == self.model.earth:
             print("EARTH COLLISION")
             self.model.num_asteroids_collided += 1
-            self.model.bodies.remove(self)
+            self.model.remove_body(self)
             if self.intercepted:
                 self.model.num_intercepted_collided += 1 # increment how many asteroids still hit earth after being intercepted
\ No newline at end of file
@@ -1,25 +1,97 @@
+import copy
 import numpy as np
+import gravity
+from gravity import G
+
+
+class StateField:
+    """Descriptor for a Body value that lives in the Model's SystemState.
+    A detached Body keeps the value itself, an attached Body reads and writes its row.
+    """
+    def __init__(self, vector=False):
+        self.vector = vector
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.private = "_" + name
+
+    def __get__(self, body, owner=None):
+        if body is None:
+            return self
+        if body.state is None:
+            return body.__dict__[self.private]
+        return getattr(body.state, self.name)[body.index]
+
+    def __set__(self, body, value):
+        if body.state is None:
+            body.__dict__[self.private] = np.array(value, dtype=float) if self.vector else value
+        else:
+            getattr(body.state, self.name)[body.index] = value
 
-G = 6.674*(10**(-11)) # Gravitational Constant
 
 class Body:
-    """Body class, stores position, velocity, mass, and radius
+    """Body class, stores position, velocity, mass, and radius.
+    Once added to a Model the values are stored in the Model's SystemState and the Body is a view onto its row.
     """
-    position = np.array([0, 0, 0])
-    velocity = np.array([0, 0, 0])
-    mass: int = 0 # kg
-    radius: int = 0 # meters
+    position = StateField(vector=True)
+    velocity = StateField(vector=True)
+    mass = StateField() # kg
+    radius = StateField() # meters
     kinetic_energy = 0
     
     model = None
+    state = None # SystemState this body is a view into, None when detached
+    index = None # row in state
+    id = None # permanent ID in the registry of the state, kept after removal
     
     def __init__(self, pos, vel, mass, radius, model=None, label=""):
-        self.position = np.copy(pos)
-        self.velocity = np.copy(vel)
+        self.position = pos
+        self.velocity = vel
         self.mass = mass
         self.radius = radius
         self.model = model
         self.label = label
+
+
+    def attach(self, state, index):
+        """Makes this Body a view onto a row of a SystemState. The row must already hold the Body's values.
+
+        Args:
+            state (SystemState): State to attach to
+            index (int): Row of this body in the state
+        """
+        self.state = state
+        self.index = index
+
+
+    def detach(self):
+        """Copies the Body's values out of its SystemState row and stops being a view.
+        """
+        if self.state is None: return
+        values = (np.copy(self.position), np.copy(self.velocity), self.mass, self.radius)
+        self.state = None
+        self.index = None
+        self.position, self.velocity, self.mass, self.radius = values
+
+
+    def snapshot(self, position=None, velocity=None):
+        """Returns a detached copy of this Body holding its current values.
+
+        Args:
+            position (np.ndarray, optional): Position to give the copy instead of the current one
+            velocity (np.ndarray, optional): Velocity to give the copy instead of the current one
+
+        Returns:
+            Body: copy of the same class that is not tied to any SystemState
+        """
+        snap = copy.copy(self)
+        snap.state = None
+        snap.index = None
+        snap.position = self.position if position is None else position
+        snap.velocity = self.velocity if velocity is None else velocity
+        snap.mass = self.mass
+        snap.radius = self.radius
+        return snap
         
     
     def step(self):
@@ -44,18 +116,9 @@ class Body:
         Returns:
             np.ndarray: acceleration vector at the given position
         """        
-        acc = np.zeros(3)
-        for other in self.model.bodies:
-            if other is self: continue
-            
-            r = other.position - position
-            dist = np.linalg.norm(r)
-            
-            if dist == 0: continue
-            
-            
-            acc += G * other.mass * r / dist**3 # derived formula from gravitational formula, F=ma, and unit vector
-        return acc
+        state = self.model.state
+        exclude = [self.index] if self.state is state else None # no self-attraction
+        return gravity.accelerations(state.position, state.mass, points=np.reshape(position, (1, 3)), exclude=exclude)[0]
     
     
     def state_deriv(self, state):
@@ -154,7 +217,7 @@ class Body:
 
 
     def set_pos(self, pos_arr):
-        self.position = np.array(pos_arr)
+        self.position = pos_arr
 
     def set_vel(self, vel_arr):
-        self.velocity = np.array(vel_arr)
\ No newline at end of file
+        self.velocity = vel_arr
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+Scenario branching at the first DART launch.
+
+DART studies vary parameters such as dart_mass or dart_speed that only matter once a
+DART is launched. Every run of such a study repeats the same approach phase up to the
+first launch. A Branch simulates that shared prefix once, stops inside the step of the
+first launch right before the launch happens, and forks one copy of the Model per
+scenario from there. Each fork finishes the launch step with its own parameters and
+runs to the end, giving the same result as a full run with those parameters.
+
+Scenario parameters must not change anything before the first launch. Parameters that
+do, like dart_distance or the detection probabilities, need separate full runs.
+"""
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+from model import Model
+from sweep import METRICS, expand_grid
+from store import TrajectoryStore
+
+
+class Branch:
+    """A Model run up to its first DART launch, ready to be forked.
+
+    Attributes:
+        model (Model): The shared prefix, stopped before its first launch or at the end of the run
+        run_options (dict): Recording options of Model.run, used again by every fork
+    """
+    def __init__(self, model, **run_options):
+        if isinstance(model.history, TrajectoryStore):
+            raise ValueError("Forks would share the files of a TrajectoryStore, branch Models with an in-memory history.")
+        self.model = model
+        self.run_options = run_options
+        model.halt_before_launch = True
+        model.run(**run_options)
+
+
+    @property
+    def launched(self):
+        """bool: whether the prefix stopped at a launch, False if no DART was due before the end."""
+        return self.model.halted_step is not None
+
+
+    def fork(self, setup=None, **overrides):
+        """Copies the prefix and applies a scenario to the copy.
+
+        Args:
+            setup (callable, optional): setup(model) applied to the copy after the overrides
+            **overrides: Model attributes to change, e.g. dart_mass=900
+
+        Returns:
+            Model: the copy, ready to finish its run
+        """
+        unknown = [name for name in overrides if not hasattr(self.model, name)]
+        if unknown:
+            raise ValueError(f"Unknown Model attributes {unknown}.")
+        memo = {id(self.model.ephemeris): self.model.ephemeris} # the ephemeris is shared, not copied
+        m = copy.deepcopy(self.model, memo)
+        for name, value in overrides.items():
+            setattr(m, name, value)
+        if setup is not None:
+            setup(m)
+            m._pending_rows = (None, None, None, None) # setup may change which asteroids wait for a dart
+            m.sync_ephemeris() # planets cannot change once the prefix has run
+        return m
+
+
+    def run(self, setup=None, **overrides):
+        """Forks a scenario and runs it to the end of the run.
+
+        Args:
+            setup (callable, optional): setup(model) applied to the fork, see fork
+            **overrides: Model attributes to change, see fork
+
+        Returns:
+            Model: the finished fork
+        """
+        m = self.fork(setup, **overrides)
+        if m.halted_step is not None:
+            m.finish_halted_step()
+        else: # nothing was launched, the prefix is the whole run
+            m.halt_before_launch = False
+        m.run(**self.run_options)
+        return m
+
+
+def run_branches(task):
+    """Runs one prefix and all scenarios of a branch sweep task.
+
+    Args:
+        task (tuple): (scenarios, seed, base, metrics), see branch_sweep
+
+    Returns:
+        list: dicts of metric name -> value, in scenario order
+    """
+    scenarios, seed, base, metrics = task
+    branch = Branch(Model(**{**base, "seed": seed}), record_final_only=True)
+    return [{name: metric(m) for name, metric in metrics} for m in (branch.run(**s) for s in scenarios)]
+
+
+def branch_sweep(grid, seeds, metrics=("interception_rate", "failed_interception_rate", "protection_rate"),
+                 base=None, workers=None):
+    """Like sweep.sweep for parameters that only matter from the first DART launch on.
+    Every seed simulates its approach phase once and forks every grid combination from it.
+    Seeds are spread over a process pool.
+
+    Args:
+        grid (dict or list): parameter name -> list of values, or a list of parameter dicts
+        seeds (list): Seeds to run every combination with, non-zero
+        metrics (list, optional): Names in sweep.METRICS or module level functions of a finished Model
+        base (dict, optional): Model parameters shared by every run
+        workers (int, optional): Number of worker processes. Defaults to the CPU count.
+
+    Returns:
+        list: one dict per run with its parameters, seed and metrics, in grid-then-seed order
+    """
+    if any(seed == 0 for seed in seeds):
+        raise ValueError("Sweep seeds must be non-zero, seed 0 leaves the Model unseeded.")
+    combinations = expand_grid(grid) if isinstance(grid, dict) else [dict(p) for p in grid]
+    metrics = [(m, METRICS[m]) if isinstance(m, str) else (m.__name__, m) for m in metrics]
+    tasks = [(combinations, seed, base or {}, metrics) for seed in seeds]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        results = [run_branches(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_branches, tasks))
+    return [{**params, "seed": seed, **results[j][i]}
+            for i, params in enumerate(combinations) for j, seed in enumerate(seeds)]
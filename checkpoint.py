@@ -0,0 +1,210 @@
+"""
+Checkpoints of a running Model.
+
+A checkpoint is a single .npz file holding everything a Model needs to carry on exactly
+where it stopped: the body arrays of the SystemState, every Body object the Model still
+refers to (removed asteroids included) with its class, label and flags, the random
+generator state, the counters, event logs and conservation diagnostics, and the history
+with its write position.
+Bodies are numbered in the file and every reference to a body is stored as its number.
+
+The history of a TrajectoryStore stays in its own files, which are flushed when the
+checkpoint is written, only its counters go into the checkpoint. A rolling window
+store and an in-memory TrajectoryBuffer are stored in the checkpoint.
+
+Files are written whole to a temporary file and then renamed over the previous
+checkpoint, so a run that dies while writing keeps the last complete one.
+"""
+import json
+import os
+import numpy as np
+from history import TrajectoryBuffer
+from store import TrajectoryStore, BODY_CLASSES
+
+COUNTERS = ("num_asteroids", "num_intercepted", "num_asteroids_collided", "num_intercepted_collided",
+            "time", "next_dt", "steps_taken")
+SCALARS = (bool, int, float, str, type(None))
+
+
+def body_values(body):
+    """Plain attributes of a Body that are not kept in a SystemState, e.g. its label and flags.
+
+    Args:
+        body (Body): Body to describe
+
+    Returns:
+        dict: attribute name -> value
+    """
+    skip = {"state", "index", "model", "_position", "_velocity", "_mass", "_radius"}
+    return {k: v for k, v in vars(body).items() if k not in skip and isinstance(v, SCALARS)}
+
+
+def parameters(model):
+    """Constructor arguments that rebuild a Model with the current settings.
+    Settings changed on the Model after construction, e.g. dt, are taken over.
+
+    Args:
+        model (Model): Model to describe
+
+    Returns:
+        dict: keyword arguments of Model
+    """
+    params = {}
+    for name, value in model.parameters.items():
+        current = getattr(model, name, value)
+        params[name] = current if isinstance(current, SCALARS) else value
+    params["ephemeris"] = model.ephemeris is not None
+    params["seed"] = None # the generator state is restored separately
+    params["history_path"] = None # reopened, not recreated, by restore
+    return params
+
+
+def save(model, path):
+    """Writes a checkpoint of a Model.
+
+    Args:
+        model (Model): Model to save
+        path (str): Checkpoint file, .npz is appended if missing
+    """
+    path = path if path.endswith(".npz") else path + ".npz"
+    history = model.history
+    on_disk = isinstance(history, TrajectoryStore) and history.keep_last is None
+
+    # number every body the Model refers to
+    ids = {}
+    def number(body):
+        if body not in ids:
+            ids[body] = len(ids)
+        return ids[body]
+    rows = [number(b) for b in model.bodies]
+    registry = [number(b) for b in model.state.registry]
+    planets = [number(b) for b in model.planets]
+    asteroids = [number(b) for b in model.asteroids]
+    columns = [number(b) for b in history.bodies]
+    selection = None if history.selection is None else [number(b) for b in history.selection]
+    launches = [(t, number(a)) for t, a in model.dart_launches]
+    impacts = [(t, number(a), number(b)) for t, a, b in model.impacts]
+    encounters = [(t, number(a), n) for t, a, n in model.encounters]
+    bodies = list(ids)
+
+    detached = np.full((len(bodies), 8), np.nan) # position, velocity, mass, radius of bodies outside the state
+    for i, body in enumerate(bodies):
+        if body.state is not model.state:
+            detached[i] = np.concatenate((body.position, body.velocity, [body.mass, body.radius]))
+
+    if isinstance(history, TrajectoryStore):
+        history.flush(model.summary())
+    meta = {
+        "parameters": parameters(model),
+        "seed_entropy": model.seed_sequence.entropy,
+        "seed_spawn_key": list(model.seed_sequence.spawn_key),
+        "rng": model.rng.bit_generator.state,
+        "counters": {name: getattr(model, name) for name in COUNTERS},
+        "classes": [type(b).__name__ for b in bodies],
+        "values": [body_values(b) for b in bodies],
+        "rows": rows,
+        "registry": registry,
+        "planets": planets,
+        "asteroids": asteroids,
+        "sun": ids[model.sun],
+        "earth": ids[model.earth],
+        "dart_launches": launches,
+        "impacts": impacts,
+        "encounters": encounters,
+        "history": {
+            "path": history.path if isinstance(history, TrajectoryStore) else None,
+            "on_disk": on_disk,
+            "columns": columns,
+            "selection": selection,
+            "every": history.every,
+            "keep_last": history.keep_last,
+            "final_only": history.final_only,
+            "length": history.length,
+            "total": history.total,
+            "steps_seen": history.steps_seen,
+        },
+    }
+    arrays = {name: getattr(model.state, name) for name in model.state.COLUMNS}
+    arrays.update(model.diagnostics.arrays())
+    if not on_disk:
+        arrays["trajectory"] = history.trajectory()
+        arrays["timestamps"] = history.timestamps()
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), detached=detached, **arrays)
+    os.replace(tmp, path)
+
+
+def read(path):
+    """Reads a checkpoint file.
+
+    Args:
+        path (str): Checkpoint file
+
+    Returns:
+        tuple: (metadata dict, dict of arrays)
+    """
+    with np.load(path) as f:
+        arrays = {name: f[name] for name in f.files if name != "meta"}
+        meta = json.loads(str(f["meta"]))
+    return meta, arrays
+
+
+def restore(model, meta, arrays):
+    """Puts a Model built from the checkpoint's parameters into the checkpointed state.
+
+    Args:
+        model (Model): Freshly constructed Model
+        meta (dict): Checkpoint metadata, see read
+        arrays (dict): Checkpoint arrays, see read
+    """
+    bodies = []
+    for cls_name, values, fixed in zip(meta["classes"], meta["values"], arrays["detached"]):
+        body = BODY_CLASSES[cls_name].__new__(BODY_CLASSES[cls_name])
+        body.__dict__.update(values)
+        body.model = model
+        if not np.isnan(fixed[0]):
+            body.__dict__.update(_position=fixed[:3].copy(), _velocity=fixed[3:6].copy(),
+                                 _mass=float(fixed[6]), _radius=float(fixed[7]))
+        bodies.append(body)
+
+    state = type(model.state)()
+    for name in state.COLUMNS:
+        setattr(state, name, arrays[name].copy())
+    state.bodies = [bodies[i] for i in meta["rows"]]
+    state.ids = np.array([body.id for body in state.bodies], dtype=int)
+    state.registry = [bodies[i] for i in meta["registry"]]
+    for i, body in enumerate(state.bodies):
+        body.attach(state, i)
+    model.state = state
+    model.planets = [bodies[i] for i in meta["planets"]]
+    model.asteroids = [bodies[i] for i in meta["asteroids"]]
+    model.sun, model.earth = bodies[meta["sun"]], bodies[meta["earth"]]
+    model.dart_launches = [(t, bodies[i]) for t, i in meta["dart_launches"]]
+    model.impacts = [(t, bodies[i], bodies[j]) for t, i, j in meta["impacts"]]
+    model.encounters = [(t, bodies[i], n) for t, i, n in meta["encounters"]]
+    for name, value in meta["counters"].items():
+        setattr(model, name, value)
+    model.seed_sequence = np.random.SeedSequence(meta["seed_entropy"], spawn_key=meta["seed_spawn_key"])
+    model.rng.bit_generator.state = meta["rng"]
+    model.diagnostics.load(arrays)
+
+    saved = meta["history"]
+    selection = None if saved["selection"] is None else [bodies[i] for i in saved["selection"]]
+    policy = dict(every=saved["every"], bodies=selection, keep_last=saved["keep_last"], final_only=saved["final_only"])
+    if saved["on_disk"]:
+        history = TrajectoryStore.open(saved["path"], mode="r+")
+        history.set_policy(**policy)
+        history.length, history.total = saved["length"], saved["total"] # later steps are overwritten
+    else:
+        history = TrajectoryStore(saved["path"], **policy) if saved["path"] else TrajectoryBuffer(**policy)
+        frames, columns, _ = arrays["trajectory"].shape
+        history.reserve(frames, columns)
+        history.data[:frames, :columns] = arrays["trajectory"]
+        history.times[:frames] = arrays["timestamps"]
+        history.length = history.total = frames # stored in time order
+    history.steps_seen = saved["steps_seen"]
+    history.bodies = [bodies[i] for i in saved["columns"]]
+    history.column_of = {body: c for c, body in enumerate(history.bodies)}
+    model.history = history
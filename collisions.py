@@ -0,0 +1,135 @@
+"""
+Collision detection between spherical bodies.
+
+The broad phase is a vectorized sort-and-sweep: every body becomes an interval along
+the axis with the largest spread, the intervals are sorted once and each body is only
+paired with the bodies whose intervals start before its own ends. The candidate pairs
+are then checked against the other two axes and finally against the exact
+sphere-sphere test, so almost no work is spent on the many pairs that are far apart.
+
+The continuous test sweeps each body along its path over a step so fast bodies cannot
+tunnel through each other between the end-of-step checks.
+"""
+import numpy as np
+
+MAX_CANDIDATES = 2**20 # sorted-axis candidate pairs checked at once, bounds the broad phase memory
+
+
+def candidate_pairs(position, radius, margin=0.0, max_candidates=MAX_CANDIDATES):
+    """Broad phase. Finds pairs of bodies whose bounding boxes overlap.
+    Pairs overlapping on the sorted axis are built and checked against the other two axes in
+    blocks of sorted rows, so memory follows the output rather than the overlaps on one axis.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        radius (np.ndarray): (N,) radii
+        margin (float or np.ndarray, optional): Extra padding added to every box, or (N,) per body,
+                                                e.g. the distance travelled during a step. Defaults to 0.
+        max_candidates (int, optional): Candidate pairs built at once, a single row may exceed it.
+
+    Returns:
+        np.ndarray: (P, 2) row pairs (i, j) with i < j, sorted by i then j
+    """
+    position = np.asarray(position, dtype=float)
+    n = len(position)
+    if n < 2:
+        return np.zeros((0, 2), dtype=int)
+    half = np.broadcast_to(np.asarray(radius, dtype=float) + margin, (n,))
+
+    axis = np.argmax(np.ptp(position, axis=0))
+    lo = position[:, axis] - half
+    hi = position[:, axis] + half
+    order = np.argsort(lo, kind="stable")
+    lo_sorted = lo[order]
+    hi_sorted = hi[order]
+
+    # every body after i in sorted order whose interval starts before i's ends overlaps it
+    ends = np.searchsorted(lo_sorted, hi_sorted, side="right")
+    counts = np.maximum(ends - np.arange(1, n + 1), 0)
+    total = np.cumsum(counts)
+
+    found = []
+    block = 0
+    while block < n:
+        # sorted rows [block, stop) hold at most max_candidates pairs, at least one row
+        stop = max(int(np.searchsorted(total, total[block] - counts[block] + max_candidates, side="right")), block + 1)
+        rows = np.arange(block, stop)
+        c = counts[block:stop]
+        first = np.repeat(rows, c)
+        starts = np.cumsum(c) - c
+        second = first + 1 + np.arange(c.sum()) - np.repeat(starts, c)
+        i, j = order[first], order[second]
+
+        # check the remaining axes
+        reach = half[i] + half[j]
+        overlap = np.all(np.abs(position[i] - position[j]) <= reach[:, None], axis=1)
+        found.append(np.column_stack((i[overlap], j[overlap])))
+        block = stop
+    pairs = np.sort(np.concatenate(found), axis=1)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def colliding_pairs(position, radius):
+    """Finds all pairs of overlapping spheres, broad phase followed by the exact test.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        radius (np.ndarray): (N,) radii
+
+    Returns:
+        np.ndarray: (P, 2) row pairs (i, j) with i < j, sorted by i then j
+    """
+    pairs = candidate_pairs(position, radius)
+    i, j = pairs[:, 0], pairs[:, 1]
+    dist = np.linalg.norm(position[i] - position[j], axis=1)
+    return pairs[dist < radius[i] + radius[j]]
+
+
+def swept_pairs(start, end, radius):
+    """Continuous collision detection. Every body is swept linearly from its start to its end
+    position over the step and pairs that touch at any point are reported with the time of impact.
+
+    Args:
+        start (np.ndarray): (N, 3) positions at the start of the step
+        end (np.ndarray): (N, 3) positions at the end of the step
+        radius (np.ndarray): (N,) radii
+
+    Returns:
+        tuple: (P, 2) row pairs (i, j) with i < j, and (P,) time of impact of each pair
+               as a fraction of the step in [0, 1], both sorted by time of impact
+    """
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    radius = np.asarray(radius, dtype=float)
+    travel = np.linalg.norm(end - start, axis=1)
+    pairs = candidate_pairs((start + end) / 2, radius, margin=travel / 2)
+    i, j = pairs[:, 0], pairs[:, 1]
+    s = contact_times(start[i] - start[j], end[i] - end[j], radius[i] + radius[j])
+    hit = ~np.isnan(s)
+
+    order = np.argsort(s[hit], kind="stable")
+    return pairs[hit][order], s[hit][order]
+
+
+def contact_times(d0, d1, reach):
+    """First time two bodies moving linearly relative to each other come within reach.
+    Solves |d0 + s (d1 - d0)| = reach for the first s in [0, 1].
+
+    Args:
+        d0 (np.ndarray): (..., 3) separations at the start of the interval
+        d1 (np.ndarray): (..., 3) separations at the end of the interval
+        reach (np.ndarray): (...) sum of the radii of each pair
+
+    Returns:
+        np.ndarray: (...) time of contact as a fraction of the interval, nan for none
+    """
+    dd = d1 - d0
+    a = np.einsum('...k,...k->...', dd, dd)
+    b = 2 * np.einsum('...k,...k->...', d0, dd)
+    c = np.einsum('...k,...k->...', d0, d0) - reach**2
+    disc = b**2 - 4*a*c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (-b - np.sqrt(np.maximum(disc, 0))) / (2*a)
+    s = np.where(c < 0, 0.0, s) # already touching at the start of the interval
+    hit = (c < 0) | ((a > 0) & (disc >= 0) & (s >= 0) & (s <= 1))
+    return np.where(hit, s, np.nan)
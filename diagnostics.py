@@ -0,0 +1,207 @@
+"""
+Conservation diagnostics recorded during a run.
+
+Checking energy and momentum conservation from the history needs every step to be kept
+and a pass over all of them afterwards. Instead, a Model evaluates the total energy,
+linear momentum and angular momentum of its state every k steps while it runs, with the
+vectorized kernels below, and keeps them as small time series independent of the
+history's retention policy. The first and the final state of a run are always included.
+
+Angular momentum is taken about the origin of the coordinates. With test particles or a
+planetary ephemeris the asteroids do not pull on the planets, so the totals are only
+conserved to the order of the asteroids' masses. Their potential energy then only counts
+pairs with an attracting body, which keeps a sample as cheap as a force evaluation. With
+every body attracting a sample costs O(N^2), so by default diagnostics are only on while
+that stays below DIAGNOSTICS_MAX_PAIRS.
+"""
+import numpy as np
+import gravity
+
+DIAGNOSTICS_EVERY = 10 # steps between samples, 0 turns the diagnostics off
+DIAGNOSTICS_MAX_PAIRS = 2**24 # largest number of potential energy pairs sampled by default
+
+
+def default_every(bodies, sources):
+    """Sampling interval used when none is given, off for systems where a sample is expensive.
+
+    Args:
+        bodies (int): Number of bodies
+        sources (int): Number of attracting bodies
+
+    Returns:
+        int: steps between samples, 0 for off
+    """
+    return DIAGNOSTICS_EVERY if bodies * sources <= DIAGNOSTICS_MAX_PAIRS else 0
+
+
+def kinetic_energy(velocity, mass):
+    """Total kinetic energy, sum of 0.5 m |v|^2.
+
+    Args:
+        velocity (np.ndarray): (N, 3) velocities
+        mass (np.ndarray): (N,) masses
+
+    Returns:
+        float: kinetic energy in joules
+    """
+    return 0.5 * np.asarray(mass, dtype=float) @ np.einsum('ij,ij->i', velocity, velocity)
+
+
+def total_energy(position, velocity, mass, sources=None):
+    """Kinetic plus gravitational potential energy of a system.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        mass (np.ndarray): (N,) masses
+        sources (np.ndarray, optional): Rows that attract. Defaults to every body.
+
+    Returns:
+        float: total energy in joules
+    """
+    return kinetic_energy(velocity, mass) + gravity.potential_energy(position, mass, sources)
+
+
+def linear_momentum(velocity, mass):
+    """Total linear momentum, sum of m v.
+
+    Args:
+        velocity (np.ndarray): (N, 3) velocities
+        mass (np.ndarray): (N,) masses
+
+    Returns:
+        np.ndarray: (3,) momentum in kg m/s
+    """
+    return np.asarray(mass, dtype=float) @ np.asarray(velocity, dtype=float).reshape(-1, 3)
+
+
+def angular_momentum(position, velocity, mass):
+    """Total angular momentum about the origin, sum of m r x v.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        mass (np.ndarray): (N,) masses
+
+    Returns:
+        np.ndarray: (3,) angular momentum in kg m^2/s
+    """
+    position = np.asarray(position, dtype=float).reshape(-1, 3)
+    velocity = np.asarray(velocity, dtype=float).reshape(-1, 3)
+    return np.asarray(mass, dtype=float) @ np.cross(position, velocity)
+
+
+class Diagnostics:
+    """Time series of the conserved quantities of a Model run.
+
+    Attributes:
+        every (int): Sample every k-th step, 0 for never
+        times (np.ndarray): (K,) simulation time of each sample
+        energy (np.ndarray): (K,) total energy
+        momentum (np.ndarray): (K, 3) total linear momentum
+        angular_momentum (np.ndarray): (K, 3) total angular momentum
+    """
+    def __init__(self, every=DIAGNOSTICS_EVERY):
+        if every < 0:
+            raise ValueError("Diagnostics every must be at least 0.")
+        self.every = every
+        self._times, self._energy, self._momentum, self._angular = [], [], [], []
+
+
+    def offer(self, state, time, step, sources=None):
+        """Samples the state if the step is one of every k-th.
+
+        Args:
+            state (SystemState): State at the end of the step
+            time (float): Simulation time of the state
+            step (int): Number of steps taken so far
+            sources (np.ndarray, optional): Rows that attract, see record
+        """
+        if self.every and step % self.every == 0:
+            self.record(state, time, sources)
+
+
+    def finish(self, state, time, sources=None):
+        """Samples the final state of a run.
+
+        Args:
+            state (SystemState): Final state
+            time (float): Simulation time of the state
+            sources (np.ndarray, optional): Rows that attract, see record
+        """
+        if self.every:
+            self.record(state, time, sources)
+
+
+    def record(self, state, time, sources=None):
+        """Samples a state, unless it was already sampled at this time.
+
+        Args:
+            state (SystemState): State to sample
+            time (float): Simulation time of the state
+            sources (np.ndarray, optional): Rows that attract, e.g. Model.massive_rows() for test particles.
+                                            Defaults to every body.
+        """
+        if self._times and self._times[-1] == time:
+            return
+        self._times.append(time)
+        self._energy.append(total_energy(state.position, state.velocity, state.mass, sources))
+        self._momentum.append(linear_momentum(state.velocity, state.mass))
+        self._angular.append(angular_momentum(state.position, state.velocity, state.mass))
+
+
+    @property
+    def times(self):
+        return np.array(self._times)
+
+    @property
+    def energy(self):
+        return np.array(self._energy)
+
+    @property
+    def momentum(self):
+        return np.array(self._momentum).reshape(-1, 3)
+
+    @property
+    def angular_momentum(self):
+        return np.array(self._angular).reshape(-1, 3)
+
+
+    def relative_drift(self):
+        """Largest change of each quantity from its first sample, relative to the first sample.
+        Momentum changes are taken relative to the magnitude of the first sample.
+
+        Returns:
+            dict: quantity name -> relative drift, nan without samples
+        """
+        if not self._times:
+            return {"energy": np.nan, "momentum": np.nan, "angular_momentum": np.nan}
+        energy, momentum, angular = self.energy, self.momentum, self.angular_momentum
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {
+                "energy": np.max(np.abs(energy - energy[0])) / abs(energy[0]),
+                "momentum": np.max(np.linalg.norm(momentum - momentum[0], axis=1)) / np.linalg.norm(momentum[0]),
+                "angular_momentum": np.max(np.linalg.norm(angular - angular[0], axis=1)) / np.linalg.norm(angular[0]),
+            }
+
+
+    def arrays(self):
+        """The time series as arrays, used by checkpoints.
+
+        Returns:
+            dict: name -> array
+        """
+        return {"diagnostics_times": self.times, "diagnostics_energy": self.energy,
+                "diagnostics_momentum": self.momentum, "diagnostics_angular_momentum": self.angular_momentum}
+
+
+    def load(self, arrays):
+        """Replaces the time series with ones written by arrays.
+
+        Args:
+            arrays (dict): name -> array, see arrays
+        """
+        self._times = arrays["diagnostics_times"].tolist()
+        self._energy = arrays["diagnostics_energy"].tolist()
+        self._momentum = list(arrays["diagnostics_momentum"])
+        self._angular = list(arrays["diagnostics_angular_momentum"])
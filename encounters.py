@@ -0,0 +1,140 @@
+"""
+Close encounters with Earth.
+
+A fixed global step is least accurate where the results matter most, an asteroid passing
+close to Earth. After every global step, asteroids whose path over the step entered a
+multiple of Earth's Hill radius are integrated over that step again with RK4 substeps
+sized from their closest approach. Every other body keeps its global step, and the
+refined asteroids see the attracting bodies moving along the cubic Hermite interpolation
+of that step. Flybys and impacts are then resolved without shrinking the global dt.
+Contacts with the attracting bodies are found on the substeps, the straight chord of the
+whole step can miss a body the curved path runs into.
+
+The substep integration uses the clock row of ephemeris.with_clock to tell the
+acceleration function where in the step each stage is.
+"""
+import numpy as np
+import gravity
+import integrators
+import collisions
+from ephemeris import with_clock
+from events import EVENT_SAMPLES
+
+ENCOUNTER_HILL_RADII = 1.0 # encounter zone radius in Hill radii of Earth
+ENCOUNTER_ETA = 0.05 # substep as a fraction of the encounter timescale at closest approach
+MAX_SUBSTEPS = 2**12 # most substeps a single global step is split into
+
+
+def hill_radius(distance, mass, central_mass):
+    """Radius within which a body's gravity dominates the tides of the body it orbits.
+
+    Args:
+        distance (float): Distance between the body and the central body in meters
+        mass (float): Mass of the body in kg
+        central_mass (float): Mass of the central body in kg
+
+    Returns:
+        float: Hill radius in meters
+    """
+    return distance * np.cbrt(mass / (3 * central_mass))
+
+
+def substeps(r0, v0, r1, v1, dt, mass, min_distance=0.0, eta=ENCOUNTER_ETA, max_substeps=MAX_SUBSTEPS):
+    """Number of substeps needed to resolve encounters with a body over one step.
+    The relative path is sampled along its Hermite interpolation, and the shorter of the
+    free fall time and the crossing time at the closest sample sets the substep length.
+
+    Args:
+        r0 (np.ndarray): (n, 3) positions relative to the body at the start of the step
+        v0 (np.ndarray): (n, 3) velocities relative to the body at the start of the step
+        r1 (np.ndarray): (n, 3) positions relative to the body at the end of the step
+        v1 (np.ndarray): (n, 3) velocities relative to the body at the end of the step
+        dt (float): Length of the step in seconds
+        mass (float): Mass of the body in kg
+        min_distance (float, optional): Closest approach used for paths passing nearer, e.g. the body's radius
+        eta (float, optional): Substep as a fraction of the encounter timescale
+        max_substeps (int, optional): Upper limit of the result
+
+    Returns:
+        int: number of substeps, at least 1
+    """
+    s = np.linspace(0, 1, EVENT_SAMPLES + 1)[:, None, None]
+    r, v = integrators.hermite(r0, v0, r1, v1, dt, s)
+    distance = np.maximum(np.linalg.norm(r, axis=2), min_distance)
+    speed = np.maximum(np.linalg.norm(v, axis=2), np.finfo(float).tiny)
+    timescale = np.minimum(np.sqrt(distance**3 / (gravity.G * mass)), distance / speed).min()
+    return int(np.clip(np.ceil(dt / (eta * timescale)), 1, max_substeps))
+
+
+def refine(start_position, start_velocity, end_position, end_velocity, mass, radius, rows, sources, dt, n):
+    """Integrates some rows over a step again with n RK4 substeps. The source rows attract
+    them from their positions interpolated between the start and end of the step, the
+    refined rows do not attract each other.
+
+    Every substep is also checked for contact between the refined rows and the sources,
+    a curved path through a body can miss it on the straight chord of the whole step.
+    A row that touches a source stops being integrated and keeps its velocity at contact,
+    its end position is its contact point carried along with the source to the end of the step.
+
+    Args:
+        start_position (np.ndarray): (N, 3) positions at the start of the step
+        start_velocity (np.ndarray): (N, 3) velocities at the start of the step
+        end_position (np.ndarray): (N, 3) positions at the end of the step
+        end_velocity (np.ndarray): (N, 3) velocities at the end of the step
+        mass (np.ndarray): (N,) masses
+        radius (np.ndarray): (N,) radii
+        rows (np.ndarray): Rows to integrate again
+        sources (np.ndarray): Rows that attract the refined rows
+        dt (float): Length of the step in seconds
+        n (int): Number of substeps
+
+    Returns:
+        tuple: (len(rows), 3) positions and velocities of the rows at the end of the step,
+               (len(rows),) source row each row touched, -1 for none, and the time of contact
+               as a fraction of the step, nan for none
+    """
+    p0, v0 = start_position[sources], start_velocity[sources]
+    p1, v1 = end_position[sources], end_velocity[sources]
+    source_mass = mass[sources]
+    reach = radius[rows][:, None] + radius[sources][None, :]
+
+    def acceleration(position):
+        acc = np.zeros(position.shape)
+        attractors, _ = integrators.hermite(p0, v0, p1, v1, dt, position[-1, 0] / dt)
+        acc[:-1] = gravity.accelerations(attractors, source_mass, points=position[:-1])
+        return acc
+
+    position, velocity = start_position[rows].copy(), start_velocity[rows].copy()
+    hit = np.full(len(rows), -1) # index into sources
+    when = np.full(len(rows), np.nan)
+    active = np.arange(len(rows))
+    h = dt / n
+    before, _ = integrators.hermite(p0, v0, p1, v1, dt, 0.0)
+    for k in range(n):
+        q, u = with_clock(position[active], velocity[active], k * h)
+        q, u = integrators.rk4(q, u, h, acceleration)
+        after, _ = integrators.hermite(p0, v0, p1, v1, dt, (k + 1) / n)
+
+        # contact of the chord of this substep with any source
+        s = collisions.contact_times(position[active, None] - before[None], q[:-1, None] - after[None], reach[active])
+        touched = ~np.all(np.isnan(s), axis=1)
+        if np.any(touched):
+            first = np.nanargmin(s[touched], axis=1)
+            local = s[touched, first]
+            t = active[touched]
+            hit[t] = first
+            when[t] = (k + local) / n
+            position[t] += local[:, None] * (q[:-1][touched] - position[t])
+            velocity[t] += local[:, None] * (u[:-1][touched] - velocity[t])
+        position[active[~touched]], velocity[active[~touched]] = q[:-1][~touched], u[:-1][~touched]
+        active = active[~touched]
+        before = after
+        if len(active) == 0:
+            break
+
+    # ride along with the touched source to the end of the step
+    touched = np.nonzero(hit >= 0)[0]
+    j = hit[touched]
+    at_contact, _ = integrators.hermite(p0[j], v0[j], p1[j], v1[j], dt, when[touched][:, None])
+    position[touched] += p1[j] - at_contact
+    return position, velocity, np.where(hit >= 0, np.asarray(sources)[hit], -1), when
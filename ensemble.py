@@ -0,0 +1,149 @@
+"""
+Batched ensemble integration of many Model realizations.
+
+Monte Carlo studies run many Models that differ only in their seed or one parameter.
+An Ensemble advances all of them with a single vectorized integrator step per timestep
+instead of paying the Python overhead of every member separately. After each step the
+new positions and velocities are scattered back into the members' own states and every
+member does its own DART, collision, removal and history bookkeeping, so each member
+ends with its own counters and history exactly as if it had been run on its own.
+
+Members integrated with direct gravity are stacked into (M, N, 3) arrays, padded with
+zero mass rows up to the largest member. Members that share a planetary ephemeris only
+integrate their test particles, which do not interact, so the particles of all members
+are stacked into one array and advanced together against the ephemeris.
+"""
+import numpy as np
+import gravity
+import integrators
+from ephemeris import with_clock
+
+
+class Ensemble:
+    """Runs several Models in lockstep.
+
+    Attributes:
+        models (list): Member Models, each keeps its own state, counters and history
+        dt (float): Shared timestep length in seconds
+        ephemeris (PlanetEphemeris): Shared ephemeris of the members, None for direct gravity
+    """
+    def __init__(self, models):
+        self.models = list(models)
+        if not self.models:
+            raise ValueError("An Ensemble needs at least one Model.")
+        for m in self.models:
+            m.sync_ephemeris()
+        first = self.models[0]
+        for m in self.models:
+            if m.integrator not in integrators.INTEGRATORS:
+                raise ValueError(f"Ensembles need a fixed step integrator, '{m.integrator}' is not one. "
+                                 f"Valid integrators: {', '.join(integrators.INTEGRATORS)}.")
+            if (m.integrator, m.dt, m.duration) != (first.integrator, first.dt, first.duration):
+                raise ValueError("Ensemble members must share integrator, dt and duration.")
+            if m.force_solver != "direct" and m.ephemeris is None:
+                raise ValueError("Ensembles integrate mutual gravity with direct summation, use force_solver='direct'.")
+            if m.ephemeris is not first.ephemeris:
+                raise ValueError("Ensemble members must all use the same ephemeris or none.")
+        self.integrate = first.integrate
+        self.dt = first.dt
+        self.duration = first.duration
+        self.ephemeris = first.ephemeris
+        self._acc_cache = None # (position, mass, acceleration) of the last force evaluation
+
+
+    def run(self, record_every=1, record_bodies=None, record_last=None, record_final_only=False):
+        """Runs every member for the shared duration, see Model.run for the recording options.
+
+        Returns:
+            list: HistoryView of every member
+        """
+        steps = int(self.duration / self.dt)
+        for m in self.models:
+            bodies = None
+            if record_bodies is not None:
+                bodies = [m.find_body(b) if isinstance(b, str) else b for b in record_bodies]
+            m.history.set_policy(record_every, bodies, record_last, record_final_only)
+            m.history.reserve_steps(steps, len(m.state))
+            if m.steps_taken == 0:
+                m.diagnostics.offer(m.state, m.time, 0, m.attracting_rows())
+
+        for _ in range(steps):
+            self.step()
+        for m in self.models:
+            m.history.finish(m.state, m.time)
+            m.history.flush(m.summary())
+            m.diagnostics.finish(m.state, m.time, m.attracting_rows())
+        return [m.all_timestep_bodies for m in self.models]
+
+
+    def step(self):
+        """Runs one timestep of every member.
+        """
+        starts = [(m.state.position.copy(), m.state.velocity.copy()) for m in self.models]
+        if self.ephemeris is None:
+            self.step_direct()
+        else:
+            self.step_ephemeris()
+        for m, (start_position, start_velocity) in zip(self.models, starts):
+            m.complete_step(start_position, start_velocity, self.dt)
+
+
+    def step_direct(self):
+        """Moves the bodies of every member by one step with direct gravity, all members at once.
+        """
+        n = max(len(m.state) for m in self.models)
+        position = np.zeros((len(self.models), n, 3))
+        velocity = np.zeros((len(self.models), n, 3))
+        mass = np.zeros((len(self.models), n)) # attracting mass, zero for padding and test particles
+        for k, m in enumerate(self.models):
+            count = len(m.state)
+            position[k, :count] = m.state.position
+            velocity[k, :count] = m.state.velocity
+            rows = m.massive_rows() if m.test_particles else slice(0, count)
+            mass[k, rows] = m.state.mass[rows]
+
+        position, velocity = self.integrate(position, velocity, self.dt, lambda p: self.accelerations(p, mass))
+        for k, m in enumerate(self.models):
+            count = len(m.state)
+            m.state.position, m.state.velocity = position[k, :count].copy(), velocity[k, :count].copy()
+
+
+    def step_ephemeris(self):
+        """Moves the test particles of every member by one step against the shared ephemeris,
+        with the particles of all members stacked into one array, and places the planets.
+        """
+        planet_rows, free_rows = zip(*[m.ephemeris_rows() for m in self.models])
+        bounds = np.cumsum([0] + [len(rows) for rows in free_rows])
+        time = self.models[0].time
+        position, velocity = with_clock(
+            np.concatenate([m.state.position[rows] for m, rows in zip(self.models, free_rows)]).reshape(-1, 3),
+            np.concatenate([m.state.velocity[rows] for m, rows in zip(self.models, free_rows)]).reshape(-1, 3),
+            time)
+
+        position, velocity = self.integrate(position, velocity, self.dt, self.ephemeris.accelerations)
+        planet_position, planet_velocity = self.ephemeris.at(time + self.dt)
+        for k, m in enumerate(self.models):
+            rows = free_rows[k]
+            m.state.position[rows] = position[bounds[k]:bounds[k + 1]]
+            m.state.velocity[rows] = velocity[bounds[k]:bounds[k + 1]]
+            m.state.position[planet_rows[k]], m.state.velocity[planet_rows[k]] = planet_position, planet_velocity
+
+
+    def accelerations(self, position, mass):
+        """Gravitational acceleration of every body of every member.
+
+        Args:
+            position (np.ndarray): (M, N, 3) positions
+            mass (np.ndarray): (M, N) attracting masses
+
+        Returns:
+            np.ndarray: (M, N, 3) acceleration vectors
+        """
+        # Reuse the last evaluation when nothing changed, e.g. the closing kick of a leapfrog step
+        if self._acc_cache is not None:
+            cached_pos, cached_mass, cached_acc = self._acc_cache
+            if np.array_equal(cached_pos, position) and np.array_equal(cached_mass, mass):
+                return cached_acc.copy()
+        acc = gravity.batched_accelerations(position, mass)
+        self._acc_cache = (np.copy(position), np.copy(mass), acc.copy())
+        return acc
@@ -0,0 +1,237 @@
+"""
+Cached planetary ephemeris shared across runs.
+
+The planets do not depend on the asteroids when asteroids are test particles, so every
+run with the same planetary initial conditions, multipliers, dt and duration integrates
+the exact same planet trajectories. A PlanetEphemeris integrates them once, stores the
+positions and velocities at every step in <cache_dir>/<key>.npz and is reused by every
+later Model, in the same process or not. Within a process Models share one copy while any of
+them still uses it, later ones read the file again. Runs then only integrate the asteroids.
+
+Planet positions between grid points, needed by the inner stages of an integrator, come
+from cubic Hermite interpolation of the stored positions and velocities.
+
+The integrators are autonomous, acceleration(position) has no time argument, so the time
+is carried by an extra clock row appended to the integrated arrays. It starts at
+(t, 0, 0) with velocity (1, 0, 0) and zero acceleration, which every integrator advances
+exactly, so each stage reads its own time from the clock row.
+"""
+import hashlib
+import os
+import weakref
+import numpy as np
+import gravity
+import integrators
+
+CACHE_DIR = ".ephemeris_cache" # default directory of cached ephemerides
+FOLLOW_RTOL = 1e-12 # relative difference up to which planets count as being on an ephemeris
+_loaded = weakref.WeakValueDictionary() # cache path -> PlanetEphemeris still used by a Model in this process
+
+
+def ephemeris_key(position, velocity, mass, mass_multi, vel_multi, dt, duration, integrator):
+    """Hash identifying a planetary ephemeris.
+
+    Args:
+        position (np.ndarray): (P, 3) initial planet positions
+        velocity (np.ndarray): (P, 3) initial planet velocities
+        mass (np.ndarray): (P,) planet masses
+        mass_multi (float): Planet mass multiplier of the Model
+        vel_multi (float): Planet velocity multiplier of the Model
+        dt (float): Grid spacing in seconds
+        duration (float): Length of the run in seconds
+        integrator (str): Name of the integrator used to build it
+
+    Returns:
+        str: hexadecimal key
+    """
+    h = hashlib.sha256()
+    for a in (position, velocity, mass):
+        h.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    h.update(repr((float(mass_multi), float(vel_multi), float(dt), float(duration), integrator)).encode())
+    return h.hexdigest()[:24]
+
+
+def with_clock(position, velocity, time):
+    """Appends the clock row to position and velocity arrays.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        time (float): Current simulation time in seconds
+
+    Returns:
+        tuple: (N + 1, 3) position and velocity arrays
+    """
+    return np.vstack((position, [time, 0.0, 0.0])), np.vstack((velocity, [1.0, 0.0, 0.0]))
+
+
+class PlanetEphemeris:
+    """Planet trajectories on a uniform time grid.
+
+    Attributes:
+        times (np.ndarray): (T,) grid times in seconds, times[k] = k * dt
+        position (np.ndarray): (T, P, 3) planet positions at the grid times
+        velocity (np.ndarray): (T, P, 3) planet velocities at the grid times
+        mass (np.ndarray): (P,) planet masses
+        key (str): Cache key the ephemeris was stored under
+    """
+    def __init__(self, times, position, velocity, mass, key=None):
+        self.times = np.asarray(times, dtype=float)
+        self.position = np.asarray(position, dtype=float)
+        self.velocity = np.asarray(velocity, dtype=float)
+        self.mass = np.asarray(mass, dtype=float)
+        self.key = key
+        self.dt = self.times[1] - self.times[0] if len(self.times) > 1 else 0.0
+        self._acc_cache = None # (position, acceleration) of the last force evaluation
+
+
+    @classmethod
+    def build(cls, position, velocity, mass, dt, duration, integrator="rk4", key=None):
+        """Integrates the planets on their own over the whole run.
+
+        Args:
+            position (np.ndarray): (P, 3) initial planet positions
+            velocity (np.ndarray): (P, 3) initial planet velocities
+            mass (np.ndarray): (P,) planet masses
+            dt (float): Grid spacing in seconds
+            duration (float): Length of the run in seconds, the grid covers at least this
+            integrator (str, optional): Fixed step integrator from integrators.INTEGRATORS
+
+        Returns:
+            PlanetEphemeris: the new ephemeris
+        """
+        step = integrators.INTEGRATORS[integrator]
+        steps = int(np.ceil(duration / dt))
+        mass = np.asarray(mass, dtype=float)
+        positions = np.empty((steps + 1,) + np.shape(position))
+        velocities = np.empty_like(positions)
+        positions[0], velocities[0] = position, velocity
+        acceleration = lambda p: gravity.accelerations(p, mass)
+        for k in range(steps):
+            positions[k + 1], velocities[k + 1] = step(positions[k], velocities[k], dt, acceleration)
+        return cls(np.arange(steps + 1) * dt, positions, velocities, mass, key=key)
+
+
+    @classmethod
+    def load_or_build(cls, planets, dt, duration, mass_multi=1, vel_multi=1, integrator="rk4", cache_dir=CACHE_DIR):
+        """Returns the cached ephemeris of the planets, integrating and storing it on a miss.
+
+        Args:
+            planets (list): Planet bodies holding their initial values, in row order
+            dt (float): Grid spacing in seconds
+            duration (float): Length of the run in seconds
+            mass_multi (float, optional): Planet mass multiplier, part of the key
+            vel_multi (float, optional): Planet velocity multiplier, part of the key
+            integrator (str, optional): Fixed step integrator used on a miss
+            cache_dir (str, optional): Directory of the .npz cache files
+
+        Returns:
+            PlanetEphemeris: the ephemeris
+        """
+        position = np.array([p.position for p in planets], dtype=float)
+        velocity = np.array([p.velocity for p in planets], dtype=float)
+        mass = np.array([p.mass for p in planets], dtype=float)
+        key = ephemeris_key(position, velocity, mass, mass_multi, vel_multi, dt, duration, integrator)
+        path = os.path.join(cache_dir, key + ".npz")
+        if path in _loaded:
+            return _loaded[path]
+
+        if os.path.exists(path):
+            with np.load(path) as f:
+                ephemeris = cls(f["times"], f["position"], f["velocity"], f["mass"], key=key)
+        else:
+            ephemeris = cls.build(position, velocity, mass, dt, duration, integrator, key=key)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp" # written whole then renamed, parallel runs never see half a file
+            with open(tmp, "wb") as f:
+                np.savez(f, times=ephemeris.times, position=ephemeris.position,
+                         velocity=ephemeris.velocity, mass=ephemeris.mass)
+            os.replace(tmp, path)
+        _loaded[path] = ephemeris
+        return ephemeris
+
+
+    def at(self, t):
+        """Planet positions and velocities at time t, interpolated between grid points
+        with cubic Hermite polynomials.
+
+        Args:
+            t (float): Time in seconds within the grid
+
+        Returns:
+            tuple: (P, 3) positions and velocities
+        """
+        if not self.times[0] <= t <= self.times[-1] + 1e-9 * self.dt:
+            raise ValueError(f"Time {t} s is outside the ephemeris, which covers 0 to {self.times[-1]} s.")
+        if len(self.times) == 1:
+            return self.position[0].copy(), self.velocity[0].copy()
+        k = min(int(t / self.dt), len(self.times) - 2)
+        s = (t - self.times[k]) / self.dt
+        return integrators.hermite(self.position[k], self.velocity[k], self.position[k + 1], self.velocity[k + 1], self.dt, s)
+
+
+    def follows(self, position, velocity, mass, t):
+        """Whether planets with the given values at time t are on this ephemeris.
+
+        Args:
+            position (np.ndarray): (P, 3) planet positions
+            velocity (np.ndarray): (P, 3) planet velocities
+            mass (np.ndarray): (P,) planet masses
+            t (float): Time of the values in seconds
+
+        Returns:
+            bool: False if they differ or t is outside the ephemeris
+        """
+        if np.shape(mass) != self.mass.shape or not np.array_equal(mass, self.mass):
+            return False
+        if not self.times[0] <= t <= self.times[-1] + 1e-9 * self.dt:
+            return False
+        expected_position, expected_velocity = self.at(t)
+        return (np.allclose(position, expected_position, rtol=FOLLOW_RTOL, atol=0)
+                and np.allclose(velocity, expected_velocity, rtol=FOLLOW_RTOL, atol=0))
+
+
+    def accelerations(self, position, targets=None):
+        """Acceleration of test particles due to the planets. The last row of position is the
+        clock row, which gives the time to place the planets at and has zero acceleration.
+
+        Args:
+            position (np.ndarray): (N + 1, 3) particle positions followed by the clock row
+            targets (np.ndarray, optional): Rows to evaluate. Defaults to every row.
+
+        Returns:
+            np.ndarray: acceleration vectors of the target rows
+        """
+        if targets is None and self._acc_cache is not None and np.array_equal(self._acc_cache[0], position):
+            return self._acc_cache[1].copy()
+        planets, _ = self.at(position[-1, 0])
+        rows = np.arange(len(position)) if targets is None else np.asarray(targets)
+        acc = np.zeros((len(rows), 3))
+        particles = rows != len(position) - 1
+        acc[particles] = gravity.accelerations(planets, self.mass, points=position[rows[particles]])
+        if targets is None:
+            self._acc_cache = (np.copy(position), acc.copy())
+        return acc
+
+
+    def dynamical_times(self, position, targets=None):
+        """Shortest two-body dynamical time of test particles around the planets, used by block
+        timestep integrators. The clock row gets an infinite time and stays in the coarsest bin.
+
+        Args:
+            position (np.ndarray): (N + 1, 3) particle positions followed by the clock row
+            targets (np.ndarray, optional): Rows to evaluate. Defaults to every row.
+
+        Returns:
+            np.ndarray: dynamical time in seconds of the target rows
+        """
+        planets, _ = self.at(position[-1, 0])
+        rows = np.arange(len(position)) if targets is None else np.asarray(targets)
+        r = planets[None, :, :] - position[rows, None, :]
+        dist2 = np.einsum('ijk,ijk->ij', r, r)
+        with np.errstate(divide='ignore'):
+            t2 = dist2**1.5 / (gravity.G * self.mass[None, :])
+        t2[(dist2 == 0) | (self.mass[None, :] == 0)] = np.inf
+        times = np.sqrt(t2.min(axis=1, initial=np.inf))
+        times[rows == len(position) - 1] = np.inf
+        return times
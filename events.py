@@ -0,0 +1,64 @@
+"""
+Event detection within a step.
+
+Events such as an asteroid coming within dart_distance of Earth happen at some time
+inside a step, not at its end. The relative motion of each pair over the step is
+reconstructed with cubic Hermite interpolation from the start and end positions and
+velocities, the first time the separation drops below the threshold is bracketed by
+sampling and then located by bisection, all vectorized over the pairs.
+"""
+import numpy as np
+from integrators import hermite
+
+EVENT_SAMPLES = 8 # samples per step used to bracket a crossing, catches dips shorter than a step
+EVENT_ITERATIONS = 40 # bisection halvings, locates the crossing to dt / 2**40
+
+
+def threshold_crossings(r0, v0, r1, v1, dt, threshold, samples=EVENT_SAMPLES, iterations=EVENT_ITERATIONS):
+    """Finds the first time within a step at which each separation vector becomes shorter than a threshold.
+
+    Args:
+        r0 (np.ndarray): (n, 3) separations at the start of the step
+        v0 (np.ndarray): (n, 3) rates of change of the separations at the start of the step
+        r1 (np.ndarray): (n, 3) separations at the end of the step
+        v1 (np.ndarray): (n, 3) rates of change of the separations at the end of the step
+        dt (float): Length of the step in seconds
+        threshold (float): Distance in meters
+        samples (int, optional): Points per step used to bracket the crossing
+        iterations (int, optional): Bisection iterations
+
+    Returns:
+        np.ndarray: (n,) fraction of the step at the crossing, 0 for separations already
+                    inside at the start and nan where there is no crossing
+    """
+    def inside(s, rows):
+        r, _ = hermite(r0[rows], v0[rows], r1[rows], v1[rows], dt, s[:, None])
+        return np.einsum('ij,ij->i', r, r) < threshold**2
+
+    n = len(r0)
+    crossing = np.full(n, np.nan)
+    if n == 0:
+        return crossing
+    # A point of the step is within max speed * dt / 2 of an end point, twice that leaves room for the cubic
+    reach = dt * np.maximum(np.linalg.norm(v0, axis=1), np.linalg.norm(v1, axis=1))
+    near = np.minimum(np.linalg.norm(r0, axis=1), np.linalg.norm(r1, axis=1)) < threshold + reach
+    candidates = np.nonzero(near)[0]
+    if len(candidates) == 0:
+        return crossing
+
+    grid = np.linspace(0, 1, samples + 1)
+    hits = np.array([inside(np.full(len(candidates), s), candidates) for s in grid]) # (samples + 1, candidates)
+    found = hits.any(axis=0)
+    first = np.argmax(hits, axis=0)
+    crossing[candidates[found & (first == 0)]] = 0.0
+
+    bracketed = found & (first > 0)
+    rows = candidates[bracketed]
+    lo, hi = grid[first[bracketed] - 1], grid[first[bracketed]] # outside at lo, inside at hi
+    for _ in range(iterations if len(rows) else 0):
+        mid = (lo + hi) / 2
+        now_inside = inside(mid, rows)
+        hi = np.where(now_inside, mid, hi)
+        lo = np.where(now_inside, lo, mid)
+    crossing[rows] = hi
+    return crossing
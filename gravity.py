@@ -0,0 +1,218 @@
+"""
+Vectorized Newtonian gravity kernels.
+
+Accelerations are computed with NumPy broadcasting over the pairwise block between
+target points and source bodies. The block is processed in chunks of target rows so
+memory stays bounded no matter how many bodies are in the system.
+"""
+import numpy as np
+from octree import Octree, THETA
+
+G = 6.674*(10**(-11)) # Gravitational Constant
+MAX_PAIRS = 2**20 # pairwise entries evaluated at once, about 24 MB per (c, N, 3) array
+
+
+def accelerations(position, mass, points=None, exclude=None, sources=None, max_pairs=MAX_PAIRS):
+    """Calculates the gravitational acceleration at each point due to every body.
+    Pairs at zero distance are skipped, which also removes self-attraction when the
+    points are the body positions themselves.
+
+    Args:
+        position (np.ndarray): (N, 3) positions of the bodies
+        mass (np.ndarray): (N,) masses of the bodies
+        points (np.ndarray, optional): (P, 3) points to evaluate at. Defaults to position.
+        exclude (np.ndarray, optional): (P,) body row to ignore for each point, -1 for none.
+                                        Used when a body is evaluated away from its own row.
+        sources (np.ndarray, optional): Rows that attract. Defaults to every body. Bodies left out
+                                        are test particles, cost scales with the number of sources.
+        max_pairs (int, optional): Maximum number of point-source pairs held in memory at once.
+
+    Returns:
+        np.ndarray: (P, 3) acceleration vectors
+    """
+    position = np.asarray(position, dtype=float)
+    mass = np.asarray(mass, dtype=float)
+    points = position if points is None else np.asarray(points, dtype=float)
+    if sources is not None:
+        if exclude is not None:
+            source_of = np.full(len(position), -1)
+            source_of[sources] = np.arange(len(sources))
+            exclude = np.where(np.asarray(exclude) >= 0, source_of[exclude], -1)
+        position = position[sources]
+        mass = mass[sources]
+    acc = np.zeros(points.shape)
+    if len(position) == 0:
+        return acc
+
+    chunk = max(1, max_pairs // len(position))
+    for start in range(0, len(points), chunk):
+        stop = min(start + chunk, len(points))
+        r = position[None, :, :] - points[start:stop, None, :] # (c, N, 3)
+        dist2 = np.einsum('ijk,ijk->ij', r, r)
+        zero = dist2 == 0
+        dist2[zero] = 1.0
+        weight = mass / dist2**1.5 # G * m / |r|^3 without G
+        weight[zero] = 0.0
+        if exclude is not None:
+            rows = np.arange(stop - start)
+            cols = np.asarray(exclude[start:stop])
+            keep = cols >= 0
+            weight[rows[keep], cols[keep]] = 0.0
+        acc[start:stop] = G * np.einsum('ij,ijk->ik', weight, r)
+    return acc
+
+
+def barnes_hut_accelerations(position, mass, points=None, exclude=None, sources=None, theta=THETA):
+    """Calculates the gravitational acceleration at each point with a Barnes-Hut octree.
+    Takes the same arguments as accelerations and approximates groups of distant bodies by
+    their center of mass, so the cost grows as N log N instead of N^2. The tree is rebuilt
+    on every call.
+
+    Args:
+        position (np.ndarray): (N, 3) positions of the bodies
+        mass (np.ndarray): (N,) masses of the bodies
+        points (np.ndarray, optional): (P, 3) points to evaluate at. Defaults to position.
+        exclude (np.ndarray, optional): (P,) body row to ignore for each point, -1 for none.
+        sources (np.ndarray, optional): Rows that attract. Defaults to every body.
+        theta (float, optional): Opening angle, larger is faster and less accurate. 0 is exact.
+
+    Returns:
+        np.ndarray: (P, 3) acceleration vectors
+    """
+    position = np.asarray(position, dtype=float)
+    mass = np.asarray(mass, dtype=float)
+    points = position if points is None else np.asarray(points, dtype=float)
+    if sources is not None:
+        if exclude is not None:
+            source_of = np.full(len(position), -1)
+            source_of[sources] = np.arange(len(sources))
+            exclude = np.where(np.asarray(exclude) >= 0, source_of[exclude], -1)
+        position = position[sources]
+        mass = mass[sources]
+    return G * Octree(position, mass).field(points, theta=theta, exclude=exclude)
+
+
+# Force solvers selectable by name from the Model constructor
+SOLVERS = {
+    "direct": accelerations,
+    "barnes_hut": barnes_hut_accelerations,
+}
+
+
+def get_solver(name):
+    """Looks up a force solver by name.
+
+    Args:
+        name (str): Key in SOLVERS
+
+    Returns:
+        callable: the solver, with the signature of accelerations
+    """
+    if name not in SOLVERS:
+        raise ValueError(f"Unknown force solver '{name}'. Valid solvers: {', '.join(SOLVERS)}.")
+    return SOLVERS[name]
+
+
+def batched_accelerations(position, mass, max_pairs=MAX_PAIRS):
+    """Calculates the gravitational acceleration of every body in a batch of independent systems.
+    Systems with fewer bodies are padded with zero mass rows, which attract nothing.
+
+    Args:
+        position (np.ndarray): (M, N, 3) positions of the bodies of each system
+        mass (np.ndarray): (M, N) masses of the bodies of each system
+        max_pairs (int, optional): Maximum number of body pairs held in memory at once.
+
+    Returns:
+        np.ndarray: (M, N, 3) acceleration vectors
+    """
+    position = np.asarray(position, dtype=float)
+    mass = np.asarray(mass, dtype=float)
+    acc = np.zeros(position.shape)
+    n = position.shape[1]
+    if n == 0:
+        return acc
+
+    rows = max(1, min(n, max_pairs // n)) # target rows per block
+    systems = max(1, max_pairs // (rows * n)) # systems per block
+    for m in range(0, len(position), systems):
+        p = position[m:m + systems]
+        for start in range(0, n, rows):
+            r = p[:, None, :, :] - p[:, start:start + rows, None, :] # (c, rows, N, 3)
+            dist2 = np.einsum('mijk,mijk->mij', r, r)
+            zero = dist2 == 0
+            dist2[zero] = 1.0
+            weight = mass[m:m + systems, None, :] / dist2**1.5
+            weight[zero] = 0.0
+            acc[m:m + systems, start:start + rows] = G * np.einsum('mij,mijk->mik', weight, r)
+    return acc
+
+
+def dynamical_times(position, mass, targets=None, max_pairs=MAX_PAIRS):
+    """Calculates the shortest two-body dynamical time of each target body,
+    min over other bodies j of sqrt(|r_ij|^3 / (G (m_i + m_j))), which is the orbital period
+    over 2 pi for a circular orbit. Used to choose per-body timesteps.
+
+    Args:
+        position (np.ndarray): (N, 3) positions of all bodies
+        mass (np.ndarray): (N,) masses of all bodies
+        targets (np.ndarray, optional): Rows to evaluate. Defaults to every body.
+        max_pairs (int, optional): Maximum number of pairs held in memory at once.
+
+    Returns:
+        np.ndarray: dynamical time in seconds of each target, inf for a body with no partners
+    """
+    position = np.asarray(position, dtype=float)
+    mass = np.asarray(mass, dtype=float)
+    targets = np.arange(len(position)) if targets is None else np.asarray(targets)
+    times = np.full(len(targets), np.inf)
+    if len(position) == 0:
+        return times
+
+    chunk = max(1, max_pairs // len(position))
+    for start in range(0, len(targets), chunk):
+        rows = targets[start:start + chunk]
+        r = position[None, :, :] - position[rows, None, :]
+        dist2 = np.einsum('ijk,ijk->ij', r, r)
+        total_mass = mass[rows, None] + mass[None, :]
+        with np.errstate(divide='ignore'):
+            t2 = dist2**1.5 / (G * total_mass)
+        t2[(dist2 == 0) | (total_mass == 0)] = np.inf
+        times[start:start + chunk] = np.sqrt(t2.min(axis=1))
+    return times
+
+
+def potential_energy(position, mass, sources=None, max_pairs=MAX_PAIRS):
+    """Calculates the total gravitational potential energy, -G m_i m_j / |r_ij| summed over
+    every pair of bodies. Pairs at zero distance and bodies without mass are skipped.
+
+    Args:
+        position (np.ndarray): (N, 3) positions of the bodies
+        mass (np.ndarray): (N,) masses of the bodies
+        sources (np.ndarray, optional): Rows that attract. Defaults to every body. Only pairs with
+                                        at least one source count, cost scales with the number of sources.
+        max_pairs (int, optional): Maximum number of pairs held in memory at once.
+
+    Returns:
+        float: potential energy in joules
+    """
+    position = np.asarray(position, dtype=float)
+    mass = np.asarray(mass, dtype=float)
+    sources = np.arange(len(mass)) if sources is None else np.asarray(sources, dtype=int)
+    sources = sources[mass[sources] != 0]
+    if len(sources) == 0:
+        return 0.0
+    # pairs between two sources are seen from both ends, pairs with a test particle from one
+    weight = np.ones(len(mass))
+    weight[sources] = 0.5
+
+    energy = 0.0
+    chunk = max(1, max_pairs // len(position))
+    for start in range(0, len(sources), chunk):
+        rows = sources[start:start + chunk]
+        r = position[None, :, :] - position[rows, None, :]
+        dist = np.sqrt(np.einsum('ijk,ijk->ij', r, r))
+        with np.errstate(divide='ignore'):
+            inverse = 1.0 / dist
+        inverse[dist == 0] = 0.0
+        energy += mass[rows] @ inverse @ (weight * mass)
+    return -G * energy
@@ -0,0 +1,259 @@
+"""
+Trajectory history of a Model run.
+
+Recorded steps are written in place into a preallocated (T, N, 6) float64 array of
+position and velocity per body, so recording costs one array copy per step. Each body
+keeps a fixed column for the whole run and the column is NaN at steps where the body is
+no longer in the simulation. The list-of-bodies format that Analysis and Animation use
+is materialized lazily from the array by HistoryView.
+
+Retention policies limit what is kept: every k-th step, a subset of bodies, a rolling
+window of the last K recorded steps, or only the final state of a run.
+"""
+import numpy as np
+
+
+class TrajectoryBuffer:
+    """Preallocated trajectory array that grows by doubling when it runs out of room.
+
+    Attributes:
+        data (np.ndarray): (capacity, columns, 6) positions and velocities in storage order
+        times (np.ndarray): (capacity,) simulation time of each stored step
+        length (int): Number of steps currently held
+        total (int): Steps written since the storage was last put in time order, locates the oldest
+                     step once a rolling window wraps
+        bodies (list): Body recorded in each column, used for labels, masses, radii and classes
+        every (int): Record every k-th step offered by the Model
+        selection (set): Bodies to record, None for all
+        keep_last (int): Size of the rolling window, None to keep every recorded step
+        final_only (bool): Only record the final state of a run
+    """
+
+    def __init__(self, frames=0, columns=0, every=1, bodies=None, keep_last=None, final_only=False):
+        self.data = np.full((frames, columns, 6), np.nan)
+        self.times = np.zeros(frames)
+        self.length = 0
+        self.total = 0
+        self.steps_seen = 0
+        self.bodies = []
+        self.column_of = {} # Body -> column
+        self._layout_key = None
+        self._rows = None
+        self._columns = None
+        self._order_cache = (None, None, None) # (length, total, order) of the last _order
+        self.set_policy(every, bodies, keep_last, final_only)
+
+
+    def set_policy(self, every=1, bodies=None, keep_last=None, final_only=False):
+        """Sets which steps and bodies are kept.
+
+        Args:
+            every (int, optional): Record every k-th step. Defaults to 1.
+            bodies (list, optional): Bodies to record. Defaults to all.
+            keep_last (int, optional): Keep only the last K recorded steps. Defaults to all.
+            final_only (bool, optional): Only keep the final state of each run. Defaults to False.
+        """
+        if every < 1 or (keep_last is not None and keep_last < 1):
+            raise ValueError("every and keep_last must be at least 1.")
+        if keep_last is not None and self.length > keep_last:
+            raise ValueError("keep_last is smaller than the history already recorded.")
+        self.every = every
+        self.selection = None if bodies is None else set(bodies)
+        self.keep_last = keep_last
+        self.final_only = final_only
+        self._layout_key = None
+        if keep_last is not None and self.data.shape[0] > keep_last:
+            self._resize(keep_last, self.data.shape[1])
+
+
+    def reserve(self, frames, columns=0):
+        """Grows the buffer to hold at least the given number of steps and columns.
+
+        Args:
+            frames (int): Number of steps to hold
+            columns (int, optional): Number of bodies to hold
+        """
+        if self.keep_last is not None:
+            frames = min(frames, self.keep_last)
+        capacity, width, _ = self.data.shape
+        if frames > capacity or columns > width:
+            self._resize(max(frames, capacity), max(columns, width))
+
+
+    def _resize(self, frames, columns):
+        """Moves the held steps, in time order, into new storage of the given size."""
+        data, times = self._allocate(frames, columns)
+        data[:self.length, :self.data.shape[1]] = self.trajectory()
+        times[:self.length] = self.timestamps()
+        self._adopt(data, times)
+        self.total = self.length # storage is in order again
+
+
+    def _allocate(self, frames, columns):
+        """New, empty (data, times) storage."""
+        return np.full((frames, columns, 6), np.nan), np.zeros(frames)
+
+
+    def _adopt(self, data, times):
+        """Switches to storage returned by _allocate once the held steps are copied in."""
+        self.data, self.times = data, times
+
+
+    def flush(self, info=None):
+        """Writes pending steps to permanent storage. Nothing to do for an in-memory buffer.
+
+        Args:
+            info (dict, optional): Run summary to store alongside the trajectory
+        """
+        pass
+
+
+    def reserve_steps(self, steps, columns=0):
+        """Grows the buffer for a run of the given number of Model steps under the current policy.
+
+        Args:
+            steps (int): Number of steps the Model will take
+            columns (int, optional): Number of bodies to hold
+        """
+        frames = 1 if self.final_only else steps // self.every + 1
+        if self.selection is not None:
+            columns = len(self.selection)
+        self.reserve(self.length + frames, columns)
+
+
+    def columns_for(self, state):
+        """Rows of a SystemState to record and their columns. Bodies seen for the first time get new columns.
+
+        Args:
+            state (SystemState): State about to be recorded
+
+        Returns:
+            tuple: (rows, columns) index arrays
+        """
+        if self._layout_key is None or self._layout_key[0] is not state or self._layout_key[1] != state.layout:
+            rows = [i for i, body in enumerate(state.bodies) if self.selection is None or body in self.selection]
+            for i in rows:
+                body = state.bodies[i]
+                if body not in self.column_of:
+                    self.column_of[body] = len(self.bodies)
+                    self.bodies.append(body)
+            self._rows = np.array(rows, dtype=int)
+            self._columns = np.array([self.column_of[state.bodies[i]] for i in rows], dtype=int)
+            self._layout_key = (state, state.layout)
+        return self._rows, self._columns
+
+
+    def offer(self, state, time):
+        """Called by the Model after every step, records the step if the policy keeps it.
+
+        Args:
+            state (SystemState): State after the step
+            time (float): Simulation time in seconds
+        """
+        self.steps_seen += 1
+        if not self.final_only and self.steps_seen % self.every == 0:
+            self.record(state, time)
+
+
+    def finish(self, state, time):
+        """Called at the end of a run, records the final state if it was not recorded already.
+
+        Args:
+            state (SystemState): Final state
+            time (float): Simulation time in seconds
+        """
+        if self.length == 0 or self.timestamps()[-1] != time:
+            self.record(state, time)
+
+
+    def record(self, state, time):
+        """Copies the positions and velocities of a SystemState into the next step of the buffer.
+
+        Args:
+            state (SystemState): State to record
+            time (float): Simulation time in seconds
+        """
+        rows, columns = self.columns_for(state)
+        if len(self.bodies) > self.data.shape[1] or (self.length == self.data.shape[0] and self.length != self.keep_last):
+            self.reserve(max(2 * self.data.shape[0], 1), len(self.bodies))
+        slot = self.total % self.data.shape[0] if self.length == self.keep_last else self.length
+        frame = self.data[slot]
+        frame[:] = np.nan
+        frame[columns, :3] = state.position[rows]
+        frame[columns, 3:] = state.velocity[rows]
+        self.times[slot] = time
+        self.total += 1
+        self.length = min(self.length + 1, self.data.shape[0])
+
+
+    def _order(self):
+        """Storage slot of each held step, oldest first. Rebuilt only when a step is recorded."""
+        length, total, order = self._order_cache
+        if length != self.length or total != self.total:
+            if self.total > self.length: # rolling window has wrapped
+                order = (self.total + np.arange(self.length)) % self.length
+            else:
+                order = np.arange(self.length)
+            self._order_cache = (self.length, self.total, order)
+        return order
+
+
+    def trajectory(self):
+        """Held steps in time order.
+
+        Returns:
+            np.ndarray: (length, columns, 6) positions and velocities
+        """
+        if self.total > self.length:
+            return self.data[self._order()]
+        return self.data[:self.length]
+
+
+    def timestamps(self):
+        """Simulation time of the held steps in time order.
+
+        Returns:
+            np.ndarray: (length,) times in seconds
+        """
+        if self.total > self.length:
+            return self.times[self._order()]
+        return self.times[:self.length]
+
+
+    def frame(self, step):
+        """Materializes one held step as detached copies of the bodies present at that step.
+
+        Args:
+            step (int): Index of the step among the held steps, oldest first
+
+        Returns:
+            list: Body copies in column order
+        """
+        values = self.data[self._order()[step], :len(self.bodies)]
+        present = np.nonzero(~np.isnan(values[:, 0]))[0]
+        return [self.bodies[c].snapshot(values[c, :3], values[c, 3:]) for c in present]
+
+
+class HistoryView:
+    """Read-only list-like view of a TrajectoryBuffer as [[bodies at step 0], [bodies at step 1], ...].
+    Frames are built from the array on access and not kept.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return self.buffer.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.buffer.frame(i) for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("history index out of range")
+        return self.buffer.frame(item)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.buffer.frame(i)
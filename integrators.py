@@ -0,0 +1,456 @@
+"""
+Integrators that advance the whole system state at once.
+
+Each integrator takes the (N, 3) position and velocity arrays, the timestep and an
+acceleration function that maps a full (N, 3) position array to the (N, 3)
+accelerations of the system in that configuration. It returns the new position and
+velocity arrays and leaves the inputs untouched.
+
+Adaptive integrators additionally take a tolerance and return an error estimate,
+adaptive_step drives them and picks the step size. Block integrators evaluate forces on
+a subset of bodies and also take a function giving each body's dynamical time.
+Heliocentric integrators split the motion around a central body into exact Kepler orbits
+and kicks, their acceleration function leaves out the central body and they also take
+the attracting masses and the row of the central body.
+"""
+import numpy as np
+from gravity import G
+
+
+def rk4(position, velocity, dt, acceleration):
+    """Classic fourth order Runge-Kutta step of the full system.
+    Every stage moves all bodies together, so one step costs four force evaluations.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Timestep length in seconds
+        acceleration (callable): acceleration(position) -> (N, 3) accelerations
+
+    Returns:
+        tuple: new (position, velocity)
+    """
+    k1x, k1v = dt * velocity, dt * acceleration(position)
+    k2x, k2v = dt * (velocity + k1v/2), dt * acceleration(position + k1x/2)
+    k3x, k3v = dt * (velocity + k2v/2), dt * acceleration(position + k2x/2)
+    k4x, k4v = dt * (velocity + k3v), dt * acceleration(position + k3x)
+    
+    # Calculate weighted average.
+    new_position = position + 1/6 * (k1x + 2*k2x + 2*k3x + k4x)
+    new_velocity = velocity + 1/6 * (k1v + 2*k2v + 2*k3v + k4v)
+    return new_position, new_velocity
+
+
+def leapfrog(position, velocity, dt, acceleration):
+    """Kick-drift-kick leapfrog step. Symplectic and second order.
+    The closing kick is evaluated at the new positions, so with a caching acceleration
+    function the opening kick of the next step is free and a step costs one force evaluation.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Timestep length in seconds
+        acceleration (callable): acceleration(position) -> (N, 3) accelerations
+
+    Returns:
+        tuple: new (position, velocity)
+    """
+    half_velocity = velocity + dt/2 * acceleration(position)
+    new_position = position + dt * half_velocity
+    new_velocity = half_velocity + dt/2 * acceleration(new_position)
+    return new_position, new_velocity
+
+
+def velocity_verlet(position, velocity, dt, acceleration):
+    """Velocity Verlet step, the position-velocity form of kick-drift-kick leapfrog.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Timestep length in seconds
+        acceleration (callable): acceleration(position) -> (N, 3) accelerations
+
+    Returns:
+        tuple: new (position, velocity)
+    """
+    acc = acceleration(position)
+    new_position = position + dt * velocity + dt**2/2 * acc
+    new_velocity = velocity + dt/2 * (acc + acceleration(new_position))
+    return new_position, new_velocity
+
+
+# Yoshida (1990) fourth order composition of three leapfrog steps
+YOSHIDA_W1 = 1 / (2 - 2**(1/3))
+YOSHIDA_W0 = -2**(1/3) / (2 - 2**(1/3))
+YOSHIDA_DRIFTS = (YOSHIDA_W1/2, (YOSHIDA_W0 + YOSHIDA_W1)/2, (YOSHIDA_W0 + YOSHIDA_W1)/2, YOSHIDA_W1/2)
+YOSHIDA_KICKS = (YOSHIDA_W1, YOSHIDA_W0, YOSHIDA_W1)
+
+
+def yoshida4(position, velocity, dt, acceleration):
+    """Fourth order Yoshida step, drift-kick-drift composition with three force evaluations.
+    Symplectic, so the energy error stays bounded over long runs.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Timestep length in seconds
+        acceleration (callable): acceleration(position) -> (N, 3) accelerations
+
+    Returns:
+        tuple: new (position, velocity)
+    """
+    position = position + YOSHIDA_DRIFTS[0] * dt * velocity
+    for kick, drift in zip(YOSHIDA_KICKS, YOSHIDA_DRIFTS[1:]):
+        velocity = velocity + kick * dt * acceleration(position)
+        position = position + drift * dt * velocity
+    return position, velocity
+
+
+# Dormand-Prince 5(4) tableau
+DOPRI_C = (0, 1/5, 3/10, 4/5, 8/9, 1, 1)
+DOPRI_A = (
+    (),
+    (1/5,),
+    (3/40, 9/40),
+    (44/45, -56/15, 32/9),
+    (19372/6561, -25360/2187, 64448/6561, -212/729),
+    (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+    (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84),
+)
+DOPRI_B5 = (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0)
+DOPRI_B4 = (5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40)
+DOPRI_ABS_POSITION = 1.0 # m, error floor for bodies at rest near the origin
+DOPRI_ABS_VELOCITY = 1e-6 # m/s
+
+
+def dopri5(position, velocity, dt, acceleration, tolerance):
+    """Dormand-Prince 5(4) step with an embedded fourth order error estimate.
+    The last stage is evaluated at the new positions, so with a caching acceleration
+    function it is reused as the first stage of the next step.
+
+    The error of each body is measured against tolerance * (|x| + |v| dt) for position and
+    tolerance * (|v| + |a| dt) for velocity, plus a small absolute floor, and the largest
+    ratio over all bodies is returned.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Timestep length in seconds
+        acceleration (callable): acceleration(position) -> (N, 3) accelerations
+        tolerance (float): Relative error tolerance
+
+    Returns:
+        tuple: new (position, velocity) and the error norm, the step is acceptable when it is <= 1
+    """
+    kx, kv = [], []
+    for a in DOPRI_A:
+        stage_x = position + dt * sum(w * k for w, k in zip(a, kx) if w)
+        stage_v = velocity + dt * sum(w * k for w, k in zip(a, kv) if w)
+        kx.append(stage_v)
+        kv.append(acceleration(stage_x))
+    
+    new_position = position + dt * sum(w * k for w, k in zip(DOPRI_B5, kx) if w)
+    new_velocity = velocity + dt * sum(w * k for w, k in zip(DOPRI_B5, kv) if w)
+    err_x = dt * sum((b5 - b4) * k for b5, b4, k in zip(DOPRI_B5, DOPRI_B4, kx))
+    err_v = dt * sum((b5 - b4) * k for b5, b4, k in zip(DOPRI_B5, DOPRI_B4, kv))
+    
+    speed = np.linalg.norm(velocity, axis=-1)
+    scale_x = tolerance * (np.linalg.norm(position, axis=-1) + speed * dt) + DOPRI_ABS_POSITION
+    scale_v = tolerance * (speed + np.linalg.norm(kv[0], axis=-1) * dt) + DOPRI_ABS_VELOCITY
+    ratio = np.maximum(np.linalg.norm(err_x, axis=-1) / scale_x, np.linalg.norm(err_v, axis=-1) / scale_v)
+    return new_position, new_velocity, np.max(ratio, initial=0.0)
+
+
+ADAPTIVE_MIN_DT = 1e-6 # s, smallest step adaptive_step tries before giving up
+
+
+def adaptive_step(stepper, position, velocity, dt, acceleration, tolerance,
+                  safety=0.9, min_factor=0.2, max_factor=5.0, min_dt=ADAPTIVE_MIN_DT):
+    """Takes one accepted step of an embedded integrator, shrinking dt until the error is within tolerance.
+
+    Args:
+        stepper (callable): Embedded integrator such as dopri5
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Trial timestep length in seconds
+        acceleration (callable): acceleration(position) -> (N, 3) accelerations
+        tolerance (float): Relative error tolerance
+        safety (float, optional): Safety factor on the step size proposal
+        min_factor (float, optional): Smallest allowed change of dt between attempts
+        max_factor (float, optional): Largest allowed change of dt between attempts
+        min_dt (float, optional): Smallest timestep in seconds, a step that needs less raises
+
+    Returns:
+        tuple: new (position, velocity), the dt that was taken and the proposed next dt
+    """
+    order = 5
+    while True:
+        new_position, new_velocity, error = stepper(position, velocity, dt, acceleration, tolerance)
+        if not np.isfinite(error):
+            raise ValueError(f"Adaptive step error is {error} at dt = {dt:g} s, the state is no longer finite.")
+        if error == 0:
+            factor = max_factor
+        else:
+            factor = min(max_factor, max(min_factor, safety * error ** (-1/order)))
+        if error <= 1:
+            return new_position, new_velocity, dt, dt * factor
+        if dt <= min_dt:
+            raise ValueError(f"Adaptive step could not meet the tolerance with dt above {min_dt:g} s.")
+        dt = max(dt * factor, min_dt)
+
+
+BLOCK_ETA = 0.02 # timestep as a fraction of a body's dynamical time
+BLOCK_MAX_LEVEL = 16 # finest bin is dt / 2**16
+
+
+def block_leapfrog(position, velocity, dt, acceleration, timescale, eta=BLOCK_ETA, max_level=BLOCK_MAX_LEVEL):
+    """Kick-drift-kick leapfrog with hierarchical individual timesteps.
+    Each body is placed in a power-of-two bin with step dt / 2**level, the coarsest bin that
+    resolves eta times its dynamical time. Every body is drifted to each time at which some
+    bin is due, which predicts the positions of slow bodies when fast ones need them, but
+    only the bodies that are due get their forces evaluated and are kicked. All bodies are
+    synchronized again at the end of the step.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Timestep length of the coarsest bin in seconds
+        acceleration (callable): acceleration(position, targets=None) -> accelerations of the target rows
+        timescale (callable): timescale(position, targets) -> dynamical time of the target rows
+        eta (float, optional): Fraction of the dynamical time used as the timestep
+        max_level (int, optional): Deepest bin, the smallest step is dt / 2**max_level
+
+    Returns:
+        tuple: new (position, velocity)
+    """
+    n_ticks = 2**max_level # finest steps per dt
+    tick_dt = dt / n_ticks
+    position = np.copy(position)
+    velocity = np.copy(velocity)
+
+    def choose_levels(targets, tick):
+        with np.errstate(divide='ignore'):
+            wanted = np.log2(dt / (eta * timescale(position, targets)))
+        level = np.clip(np.ceil(wanted), 0, max_level).astype(int)
+        # a body can only join a bin whose steps line up with the current time
+        misaligned = tick % 2**(max_level - level) != 0
+        while np.any(misaligned):
+            level[misaligned] += 1
+            misaligned = tick % 2**(max_level - level) != 0
+        return level
+
+    acc = acceleration(position)
+    level = choose_levels(np.arange(len(position)), 0)
+    velocity += (dt / 2**level)[:, None] / 2 * acc # opening half kick
+    tick = 0
+    while tick < n_ticks:
+        stride = 2**(max_level - level)
+        next_tick = np.min((tick // stride + 1) * stride, initial=n_ticks)
+        position += (next_tick - tick) * tick_dt * velocity # drift everyone
+        tick = next_tick
+
+        active = np.nonzero(tick % stride == 0)[0]
+        acc = acceleration(position, targets=None if len(active) == len(position) else active)
+        velocity[active] += (dt / 2**level[active])[:, None] / 2 * acc # closing half kick
+        if tick < n_ticks:
+            level[active] = choose_levels(active, tick)
+            velocity[active] += (dt / 2**level[active])[:, None] / 2 * acc # opening half kick
+    return position, velocity
+
+
+STUMPFF_SERIES = 1.0 # |z| below which the Stumpff functions are summed as series
+STUMPFF_TERMS = 12 # series terms, the error at |z| = 1 is below 1e-25
+KEPLER_ITERATIONS = 50 # most Laguerre iterations of the universal Kepler equation
+KEPLER_TOLERANCE = 1e-15 # relative change of the universal anomaly at convergence
+
+
+def stumpff(z):
+    """Stumpff functions c2 and c3 of the universal variable formulation.
+
+    Args:
+        z (np.ndarray): alpha * chi**2, positive for ellipses and negative for hyperbolas
+
+    Returns:
+        tuple: (c2, c3) arrays shaped like z
+    """
+    z = np.asarray(z, dtype=float)
+    c2, c3 = np.empty(z.shape), np.empty(z.shape)
+    small = np.abs(z) < STUMPFF_SERIES
+    k = np.arange(STUMPFF_TERMS)
+    factorial = np.cumprod(np.arange(1, 2 * STUMPFF_TERMS + 4, dtype=float)) # factorial[n - 1] = n!
+    powers = (-z[small, None])**k
+    c2[small] = powers @ (1 / factorial[2 * k + 1]) # sum (-z)^k / (2k + 2)!
+    c3[small] = powers @ (1 / factorial[2 * k + 2]) # sum (-z)^k / (2k + 3)!
+
+    ellipse = ~small & (z > 0)
+    root = np.sqrt(z[ellipse])
+    c2[ellipse] = (1 - np.cos(root)) / z[ellipse]
+    c3[ellipse] = (root - np.sin(root)) / root**3
+    hyperbola = ~small & (z < 0)
+    root = np.sqrt(-z[hyperbola])
+    c2[hyperbola] = (np.cosh(root) - 1) / -z[hyperbola]
+    c3[hyperbola] = (np.sinh(root) - root) / root**3
+    return c2, c3
+
+
+def kepler_drift(position, velocity, mu, dt):
+    """Moves bodies along their two-body orbits around a fixed center for dt seconds.
+    Solves the universal Kepler equation for every body at once with Laguerre's method,
+    so elliptic, parabolic and hyperbolic orbits are handled alike.
+
+    Args:
+        position (np.ndarray): (n, 3) positions relative to the center
+        velocity (np.ndarray): (n, 3) velocities
+        mu (float): G times the central mass
+        dt (float): Time to drift in seconds
+
+    Returns:
+        tuple: new (position, velocity)
+    """
+    r0 = np.linalg.norm(position, axis=1)
+    sigma = np.einsum('ij,ij->i', position, velocity) / np.sqrt(mu) # r0 * radial velocity / sqrt(mu)
+    alpha = 2 / r0 - np.einsum('ij,ij->i', velocity, velocity) / mu # inverse semi-major axis
+    sqrt_mu = np.sqrt(mu)
+
+    chi = sqrt_mu * dt / r0 # universal anomaly, exact for a short step
+    n = 5 # Laguerre order
+    active = np.ones(len(r0), dtype=bool)
+    for _ in range(KEPLER_ITERATIONS):
+        if not np.any(active):
+            break
+        x, a, s, r = chi[active], alpha[active], sigma[active], r0[active]
+        c2, c3 = stumpff(a * x**2)
+        f = s * x**2 * c2 + (1 - a * r) * x**3 * c3 + r * x - sqrt_mu * dt
+        df = s * x * (1 - a * x**2 * c3) + (1 - a * r) * x**2 * c2 + r # the distance at chi
+        d2f = s * (1 - a * x**2 * c2) + (1 - a * r) * x * (1 - a * x**2 * c3)
+        root = np.sqrt(np.abs((n - 1)**2 * df**2 - n * (n - 1) * f * d2f))
+        delta = n * f / (df + np.copysign(root, df))
+        chi[active] = x - delta
+        active[active] = np.abs(delta) > KEPLER_TOLERANCE * np.maximum(np.abs(x), 1e-300)
+
+    c2, c3 = stumpff(alpha * chi**2)
+    f = 1 - chi**2 / r0 * c2
+    g = dt - chi**3 / sqrt_mu * c3
+    new_position = f[:, None] * position + g[:, None] * velocity
+    r = np.linalg.norm(new_position, axis=1)
+    df = sqrt_mu / (r * r0) * chi * (alpha * chi**2 * c3 - 1)
+    dg = 1 - chi**2 / r * c2
+    new_velocity = df[:, None] * position + dg[:, None] * velocity
+    return new_position, new_velocity
+
+
+def wisdom_holman(position, velocity, dt, acceleration, mass, central=0):
+    """Wisdom-Holman step in democratic heliocentric coordinates: heliocentric positions
+    and barycentric velocities. Every body drifts on an exact Kepler orbit around the
+    central body, and the interactions between the other bodies are applied as kicks. The
+    central body's motion enters through a linear drift of the positions by the total
+    momentum. The error is of order (mass ratio) * dt**2, so steps of days stay accurate
+    and the energy error stays bounded.
+
+    Kick, jump, Kepler drift, jump, kick. The kicks conserve the momentum the jumps
+    depend on, so the two commute, but the Kepler drift changes it.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+        velocity (np.ndarray): (N, 3) velocities
+        dt (float): Timestep length in seconds
+        acceleration (callable): acceleration(position) -> (N, 3) accelerations due to
+                                 every attracting body except the central one
+        mass (np.ndarray): (N,) attracting masses, zero for test particles
+        central (int, optional): Row of the central body. Defaults to 0.
+
+    Returns:
+        tuple: new (position, velocity)
+    """
+    total = mass.sum()
+    com = mass @ position / total
+    com_velocity = mass @ velocity / total
+    others = np.arange(len(position)) != central
+    m = mass[others, None]
+
+    q = position[others] - position[central] # heliocentric positions
+    v = velocity[others] - com_velocity # barycentric velocities
+
+    def kick(q, v):
+        placed = np.zeros(position.shape)
+        placed[others] = q
+        return v + dt/2 * acceleration(placed)[others]
+
+    def jump(q, v):
+        return q + dt/2 * (m * v).sum(axis=0) / mass[central] # the central body's share of the momentum
+
+    v = kick(q, v)
+    q = jump(q, v)
+    q, v = kepler_drift(q, v, G * mass[central], dt)
+    q = jump(q, v)
+    v = kick(q, v)
+
+    # back to the frame of the caller, the center of mass moves in a straight line
+    com = com + dt * com_velocity
+    new_position, new_velocity = np.empty(position.shape), np.empty(velocity.shape)
+    new_position[central] = com - (m * q).sum(axis=0) / total
+    new_position[others] = q + new_position[central]
+    new_velocity[central] = com_velocity - (m * v).sum(axis=0) / mass[central]
+    new_velocity[others] = v + com_velocity
+    return new_position, new_velocity
+
+
+def hermite(p0, v0, p1, v1, dt, s):
+    """Cubic Hermite interpolation of a step from its end point positions and velocities.
+    Used for dense output between steps, it is exact for motion with constant acceleration.
+
+    Args:
+        p0 (np.ndarray): Positions at the start of the step
+        v0 (np.ndarray): Velocities at the start of the step
+        p1 (np.ndarray): Positions at the end of the step
+        v1 (np.ndarray): Velocities at the end of the step
+        dt (float): Length of the step in seconds
+        s (float or np.ndarray): Fraction of the step, broadcast against the positions
+
+    Returns:
+        tuple: interpolated (position, velocity)
+    """
+    position = (2*s**3 - 3*s**2 + 1) * p0 + (s**3 - 2*s**2 + s) * dt * v0 \
+             + (-2*s**3 + 3*s**2) * p1 + (s**3 - s**2) * dt * v1
+    velocity = ((6*s**2 - 6*s) * p0 + (3*s**2 - 4*s + 1) * dt * v0
+             + (-6*s**2 + 6*s) * p1 + (3*s**2 - 2*s) * dt * v1) / dt
+    return position, velocity
+
+
+# Integrators selectable by name from the Model constructor
+INTEGRATORS = {
+    "rk4": rk4,
+    "leapfrog": leapfrog,
+    "verlet": velocity_verlet,
+    "yoshida4": yoshida4,
+}
+
+# Embedded integrators, run through adaptive_step with a per-step dt
+ADAPTIVE_INTEGRATORS = {
+    "dopri5": dopri5,
+}
+
+# Individual timestep integrators, also given per-body dynamical times
+BLOCK_INTEGRATORS = {
+    "block": block_leapfrog,
+}
+
+# Mixed variable integrators, given the attracting masses and the central body row
+HELIOCENTRIC_INTEGRATORS = {
+    "wh": wisdom_holman,
+}
+
+
+def get_integrator(name):
+    """Looks up an integrator by name.
+
+    Args:
+        name (str): Key in INTEGRATORS, ADAPTIVE_INTEGRATORS, BLOCK_INTEGRATORS or HELIOCENTRIC_INTEGRATORS
+
+    Returns:
+        callable: the integrator function
+    """
+    registry = {**INTEGRATORS, **ADAPTIVE_INTEGRATORS, **BLOCK_INTEGRATORS, **HELIOCENTRIC_INTEGRATORS}
+    if name not in registry:
+        raise ValueError(f"Unknown integrator '{name}'. Valid integrators: {', '.join(registry)}.")
+    return registry[name]
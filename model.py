@@ -3,11 +3,22 @@ from body import Body
 from planet import Planet
 from dart import Dart
 from asteroid import Asteroid
+from state import SystemState
+from history import TrajectoryBuffer, HistoryView
+from store import TrajectoryStore
+from ephemeris import PlanetEphemeris, with_clock, CACHE_DIR
+from octree import THETA
 import numpy as np
 import matplotlib.pyplot as plt
-import copy
 import data
 import animation
+import gravity
+import integrators
+import collisions
+import events
+import encounters
+import checkpoint
+import diagnostics
 
 AU = 149_597_900_000 # Astronomical Unit in meters
 
@@ -42,8 +53,6 @@ class Model:
     # End Tunable Parameters
     
     
-    all_timestep_bodies = [] # [bodies at time 1, bodies at time 2...]
-    
     # Tracked Data
     num_intercepted = 0
     num_asteroids_collided = 0
@@ -58,10 +67,13 @@ class Model:
     asteroid_radius_medium = 1000, asteroid_mass_medium = 10e11,
     asteroid_radius_large = 10000, asteroid_mass_large = 10e13, 
     small_detection = 0.5, medium_detection=.75, large_detection=1.0,
-    duration=3600*24*365, seed=0):
-        self.bodies = []
-        self.planets = []
-        self.asteroids = []
+    duration=3600*24*365, seed=0, mass_multi=1, vel_multi=1, integrator="rk4", tolerance=1e-10,
+    timestep_eta=integrators.BLOCK_ETA, max_timestep_level=integrators.BLOCK_MAX_LEVEL,
+    history_path=None, swept_collisions=True, test_particles=False, ephemeris=False, ephemeris_dir=CACHE_DIR,
+    force_solver="direct", opening_angle=THETA,
+    encounter_radius=encounters.ENCOUNTER_HILL_RADII, encounter_eta=encounters.ENCOUNTER_ETA,
+    diagnostics_every=None):
+        self.parameters = {k: v for k, v in locals().items() if k != "self"} # constructor arguments, used by checkpoints
         self.dt = dt
         self.collision_elasticity = collision_elasticity
         self.dart_mass = dart_mass
@@ -95,64 +107,248 @@ class Model:
         self.duration = duration
         self.mass_multi = mass_multi
         self.vel_multi = vel_multi
+        self.integrator = integrator
+        self.integrate = integrators.get_integrator(integrator)
+        if ephemeris and integrator in integrators.HELIOCENTRIC_INTEGRATORS:
+            raise ValueError(f"The '{integrator}' integrator moves the planets itself and cannot follow an ephemeris.")
+        self.adaptive = integrator in integrators.ADAPTIVE_INTEGRATORS
+        self.tolerance = tolerance # relative error per step for adaptive integrators
+        self.time = 0.0 # seconds since the start of the run
+        self.steps_taken = 0
+        self.next_dt = dt # trial timestep of the next adaptive step
+        self.timestep_eta = timestep_eta # block timesteps: fraction of each body's dynamical time
+        self.max_timestep_level = max_timestep_level # block timesteps: finest bin is dt / 2**level
+        self._acc_cache = None # (position, mass, acceleration) of the last force evaluation
+        self.force_solver = force_solver
+        self.solve = gravity.get_solver(force_solver)
+        self.opening_angle = opening_angle # Barnes-Hut: nodes with size / distance below this are point masses
 
-        self.bodies = []
+        self.state = SystemState()
         self.planets = []
         self.asteroids = []
-        self.all_timestep_bodies = []
-        if seed != 0: 
-            np.random.seed(seed)
+        # Recorded steps go to a memory-mapped file when history_path is given
+        self.history = TrajectoryStore(history_path) if history_path else TrajectoryBuffer()
+        self.swept_collisions = swept_collisions # test each body's path over the step, not only its end position
+        self.impacts = [] # (time of impact in seconds, body1, body2) of every resolved collision
+        self.test_particles = test_particles # asteroids feel gravity but do not attract anything
+        self._massive_rows = (None, None, None) # (state, layout, rows) cache for test particle mode
+        self.dart_launches = [] # (launch time in seconds, asteroid) of every DART
+        self._pending_rows = (None, None, None, None) # (state, layout, launches, rows) cache for handle_dart
+        self.encounter_radius = encounter_radius # asteroids within this many Hill radii of Earth get substeps, 0 turns it off
+        self.encounter_eta = encounter_eta # encounter substep as a fraction of the encounter timescale
+        self.encounters = [] # (time at the end of the step, asteroid, substeps) of every refined step
+        self._asteroid_rows = (None, None, None) # (state, layout, rows) cache for close encounters
+        self._ephemeris_rows = (None, None, None) # (state, layout, (planet rows, free rows)) cache for ephemeris mode
+        self._refined = None # (rows, sources, impacts) of the encounters refined in the current step
+        self.halt_before_launch = False # stop the run just before the first DART launch, see branch.py
+        self.halted_step = None # (start position, start velocity, dt) of the step stopped before its launch
+        # Every Model draws from its own stream, seed 0 asks the OS for fresh entropy.
+        # A SeedSequence can be passed instead of an int, e.g. one of SeedSequence(n).spawn(k).
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed or None)
+        self.rng = np.random.default_rng(self.seed_sequence)
         
         self.init_bodies()
+        # Planets follow a cached ephemeris and only the other bodies are integrated, as test particles
+        self.ephemeris = None
+        self.ephemeris_dir = ephemeris_dir
+        if ephemeris:
+            self.ephemeris = self.load_ephemeris()
+        # Energy and momentum every k steps, 0 turns it off. By default off for large systems, see diagnostics.py
+        if diagnostics_every is None:
+            sources = self.attracting_rows()
+            diagnostics_every = diagnostics.default_every(len(self.state), len(self.state) if sources is None else len(sources))
+        self.diagnostics = diagnostics.Diagnostics(diagnostics_every)
 
     def init_bodies(self):
         """Initialize all Body objects and add to bodies list
         """
         self.init_planets(mass_multi=self.mass_multi, vel_multi=self.vel_multi)
-        # self.init_asteroids()
+        self.init_asteroids()
         self.bodies = self.planets + self.asteroids
+
+
+    @property
+    def all_timestep_bodies(self):
+        """HistoryView: [bodies at time 1, bodies at time 2...], built from self.history on access."""
+        return HistoryView(self.history)
+
+    @property
+    def times(self):
+        """np.ndarray: simulation time in seconds of each entry in all_timestep_bodies."""
+        return self.history.timestamps()
+
+
+    @property
+    def bodies(self):
+        """list: Body views onto the rows of self.state, in row order.
+        Assigning a list of bodies rebuilds the state from their current values. Bodies of
+        another Model or of none, e.g. the data.py constants, are copied first. planets,
+        asteroids, sun and earth are refreshed from the new bodies, the Sun and the Earth by label.
+        """
+        return self.state.bodies
+
+    @bodies.setter
+    def bodies(self, bodies):
+        bodies = [body if body.model is self else body.snapshot() for body in bodies]
+        for body in bodies:
+            body.model = self
+        self.state = SystemState.from_bodies(bodies, self.state.registry)
+        self.planets = [b for b in bodies if not isinstance(b, Asteroid)]
+        self.asteroids = [b for b in bodies if isinstance(b, Asteroid)]
+        labelled = {b.label: b for b in reversed(bodies)} # first body with a label wins
+        self.sun = labelled.get(data.SUN.label)
+        self.earth = labelled.get(data.EARTH.label)
+
+
+    def summary(self):
+        """Tracked data of the run so far.
+
+        Returns:
+            dict: counters, dt and simulation time
+        """
+        return {
+            "num_asteroids": self.num_asteroids,
+            "num_intercepted": self.num_intercepted,
+            "num_asteroids_collided": self.num_asteroids_collided,
+            "num_intercepted_collided": self.num_intercepted_collided,
+            "dt": self.dt,
+            "time": self.time,
+        }
+
+
+    def find_body(self, label):
+        """Finds a body in the simulation by its label.
+
+        Args:
+            label (str): Label of the body
+
+        Returns:
+            Body: the first body with the label
+        """
+        for body in self.bodies:
+            if body.label == label:
+                return body
+        raise ValueError(f"No body labelled '{label}'.")
+
+
+    def find_by_id(self, id):
+        """Finds a body by its permanent ID, including bodies that were removed.
+
+        Args:
+            id (int): ID of the body, see SystemState
+
+        Returns:
+            Body: the body with the ID, check self.state.alive[id] to see if it is still simulated
+        """
+        if not 0 <= id < len(self.state.registry):
+            raise ValueError(f"No body with ID {id}.")
+        return self.state.registry[id]
+
+
+    def add_body(self, body):
+        """Adds a body to the simulation as a new row of the state.
+
+        Args:
+            body (Body): Body to add
+        """
+        body.model = self
+        self.state.add(body)
+
+
+    def remove_body(self, body):
+        """Removes a body from the simulation. The Body keeps its last values and its ID,
+        which is no longer alive, see SystemState.
+
+        Args:
+            body (Body): Body to remove
+        """
+        self.state.remove(body)
     
     
     def init_planets(self, mass_multi=1, vel_multi=1):
         """Initialize planets list from data.py
         """
         # Sun treated as planet for simplicity
-        self.planets = [data.SUN, data.MERCURY, data.VENUS, data.EARTH, data.MARS, data.JUPITER, data.SATURN, data.URANUS, data.NEPTUNE]
-        self.planets = [copy.deepcopy(p) for p in self.planets]
+        planets = [data.SUN, data.MERCURY, data.VENUS, data.EARTH, data.MARS, data.JUPITER, data.SATURN, data.URANUS, data.NEPTUNE]
+        self.planets = [Planet(p.position, p.velocity * vel_multi, p.mass * mass_multi, p.radius, self, label=p.label)
+                        for p in planets]
         self.sun = self.planets[0]
-        self.earth = self.planets[2]
-        for planet in self.planets:
-            planet.model = self
+        self.earth = self.planets[3]
             
     
     def init_asteroids(self):
         """Initialize all asteroids with parameters based on Model parameters
         """
-        distances = np.random.normal(self.asteroid_distance_mean, self.asteroid_distance_SD, self.num_asteroids)
-        angles = np.random.uniform(0, 2*np.pi, self.num_asteroids)
+        n = self.num_asteroids
+        distances = self.rng.normal(self.asteroid_distance_mean, self.asteroid_distance_SD, n)
+        angles = self.rng.uniform(0, 2*np.pi, n)
         positions = np.column_stack((distances * np.cos(angles), distances * np.sin(angles), distances * 0)) + self.earth.position
         
-        speeds = np.random.normal(self.asteroid_speed_mean, self.asteroid_speed_SD, self.num_asteroids)
+        speeds = self.rng.normal(self.asteroid_speed_mean, self.asteroid_speed_SD, n)
         directions = self.earth.position - positions
         directions /= np.linalg.norm(directions, axis=1, keepdims=True) # normalize directions
         velocities = directions * speeds[:, None]
         
-        masses = [self.asteroid_mass_small] * self.num_small \
-               + [self.asteroid_mass_medium] * self.num_medium \
-               + [self.asteroid_mass_large] * self.num_large
-               
-        radii = [self.asteroid_radius_small] * self.num_small \
-               + [self.asteroid_radius_medium] * self.num_medium \
-               + [self.asteroid_radius_large] * self.num_large
+        # size class 0, 1, 2 = small, medium, large
+        size = np.repeat([0, 1, 2], [self.num_small, self.num_medium, self.num_large])
+        masses = np.array([self.asteroid_mass_small, self.asteroid_mass_medium, self.asteroid_mass_large])[size]
+        radii = np.array([self.asteroid_radius_small, self.asteroid_radius_medium, self.asteroid_radius_large])[size]
+        detection = np.array([self.small_detection, self.medium_detection, self.large_detection])[size]
+        will_be_intercepted = self.rng.random(n) < detection
         
-        for pos, vel, mass, radius in zip(positions, velocities, masses, radii):
-            a = Asteroid(pos, vel, mass, radius, model=self)
-            self.asteroids.append(a)
+        self.asteroids = Asteroid.population(positions, velocities, masses, radii, self, will_be_intercepted)
     
     
-    def run(self, animate=False, zoom=3):
-        for t in range(int(self.duration / self.dt)):
+    def run(self, animate=False, zoom=3, record_every=1, record_bodies=None, record_last=None, record_final_only=False,
+            checkpoint_path=None, checkpoint_every=None):
+        """Runs the simulation for self.duration seconds. Fixed step integrators take
+        duration / dt steps, adaptive integrators step until the simulation time reaches duration.
+        Steps already taken, e.g. by a Model resumed from a checkpoint, count towards the run.
+        The final state is always recorded. Energy and momentum are sampled every diagnostics_every
+        steps whatever the recording options, see diagnostics.py.
+
+        Args:
+            animate (bool, optional): Show an animation of the run. Defaults to False.
+            zoom (float, optional): Animation window size in AU. Defaults to 3.
+            record_every (int, optional): Record every k-th step. Defaults to 1.
+            record_bodies (list, optional): Bodies or labels to record. Defaults to all bodies.
+            record_last (int, optional): Only keep the last K recorded steps. Defaults to all.
+            record_final_only (bool, optional): Only record the final state. Defaults to False.
+            checkpoint_path (str, optional): File to keep a checkpoint of the run in, see Model.resume.
+            checkpoint_every (int, optional): Steps between checkpoints. Defaults to 1000 with a checkpoint_path.
+
+        Returns:
+            HistoryView: bodies at every recorded timestep
+        """
+        if self.sun is None or self.earth is None:
+            raise ValueError("Model.bodies must include the Sun and the Earth to run.")
+        self.sync_ephemeris()
+        if record_bodies is not None:
+            record_bodies = [self.find_body(b) if isinstance(b, str) else b for b in record_bodies]
+        self.history.set_policy(record_every, record_bodies, record_last, record_final_only)
+        
+        checkpoint_every = checkpoint_every or 1000
+        if self.steps_taken == 0:
+            self.diagnostics.offer(self.state, self.time, 0, self.attracting_rows())
+        def step():
             self.step()
+            if checkpoint_path is not None and self.steps_taken % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path)
+        
+        if self.adaptive:
+            while self.time < self.duration and self.halted_step is None:
+                step()
+        else:
+            steps = int(self.duration / self.dt) - self.steps_taken
+            self.history.reserve_steps(steps, len(self.state))
+            for t in range(steps):
+                step()
+                if self.halted_step is not None: break
+        if self.halted_step is not None: # stopped in the middle of a step, see halt_before_launch
+            return self.all_timestep_bodies
+        self.history.finish(self.state, self.time)
+        self.history.flush(self.summary())
+        self.diagnostics.finish(self.state, self.time, self.attracting_rows())
 
         # self.verification_check()
         
@@ -163,53 +359,485 @@ class Model:
         return self.all_timestep_bodies
 
     
+    def save_checkpoint(self, path):
+        """Writes the complete state of the run to a checkpoint file, see checkpoint.py.
+
+        Args:
+            path (str): Checkpoint file, .npz is appended if missing
+        """
+        checkpoint.save(self, path)
+
+
+    @classmethod
+    def resume(cls, path):
+        """Rebuilds a Model from a checkpoint. Calling run with the recording options of the
+        original run finishes it exactly as if it had never stopped.
+
+        Args:
+            path (str): Checkpoint file written by save_checkpoint
+
+        Returns:
+            Model: the Model at the checkpointed step
+        """
+        meta, arrays = checkpoint.read(path if path.endswith(".npz") else path + ".npz")
+        model = cls(**meta["parameters"])
+        checkpoint.restore(model, meta, arrays)
+        return model
+
+
     def step(self):
         """Runs one timestep of the simulation.
         """
-        op_bodies = copy.deepcopy(self.bodies)
-        for body in op_bodies:
-            body.step()
-            self.handle_dart(body)
+        start_position, start_velocity = self.state.position.copy(), self.state.velocity.copy()
+        if self.ephemeris is None:
+            self.state.position, self.state.velocity, dt = self.advance(
+                self.state.position, self.state.velocity, self.accelerations, self.dynamical_times)
+        else:
+            planet_rows, free_rows = self.ephemeris_rows()
+            position, velocity = with_clock(self.state.position[free_rows], self.state.velocity[free_rows], self.time)
+            position, velocity, dt = self.advance(
+                position, velocity, self.ephemeris.accelerations, self.ephemeris.dynamical_times)
+            self.state.position[free_rows], self.state.velocity[free_rows] = position[:-1], velocity[:-1]
+            self.state.position[planet_rows], self.state.velocity[planet_rows] = self.ephemeris.at(self.time + dt)
+        self.complete_step(start_position, start_velocity, dt)
+
+
+    def complete_step(self, start_position, start_velocity, dt):
+        """Bookkeeping after the bodies were moved by one step: advances the clock, launches
+        darts, resolves collisions and records the step.
+
+        Args:
+            start_position (np.ndarray): (N, 3) positions at the start of the step
+            start_velocity (np.ndarray): (N, 3) velocities at the start of the step
+            dt (float): Length of the step in seconds
+        """
+        self._refined = None
+        if self.encounter_radius > 0:
+            self.handle_encounters(start_position, start_velocity, dt)
+        self.time += dt
+        self.steps_taken += 1
+        if self.halt_before_launch and self.halted_step is None:
+            _, crossing = self.launch_crossings(start_position, start_velocity, dt)
+            if np.any(~np.isnan(crossing)):
+                self.halted_step = (start_position, start_velocity, dt)
+                return
+        self.finish_step(start_position, start_velocity, dt)
+
+
+    def finish_step(self, start_position, start_velocity, dt):
+        """Launches darts, resolves collisions and records the step, the part of complete_step
+        that runs after the clock was advanced.
+
+        Args:
+            start_position (np.ndarray): (N, 3) positions at the start of the step
+            start_velocity (np.ndarray): (N, 3) velocities at the start of the step
+            dt (float): Length of the step in seconds
+        """
+        self.handle_dart(start_position, start_velocity, dt)
+        if self.swept_collisions:
+            self.handle_collisions(start_position, dt)
+        else:
+            self.handle_collisions()
+        
+        self.history.offer(self.state, self.time)
+        self.diagnostics.offer(self.state, self.time, self.steps_taken, self.attracting_rows())
+
+
+    def finish_halted_step(self):
+        """Finishes the step a run stopped in before its first DART launch. run() can then
+        carry on with the rest of the run.
+        """
+        start_position, start_velocity, dt = self.halted_step
+        self.halted_step = None
+        self.halt_before_launch = False
+        self.finish_step(start_position, start_velocity, dt)
+
+
+    def advance(self, position, velocity, acceleration, timescale):
+        """Advances position and velocity arrays by one step of the Model's integrator.
+
+        Args:
+            position (np.ndarray): (N, 3) positions
+            velocity (np.ndarray): (N, 3) velocities
+            acceleration (callable): acceleration(position, targets=None) -> accelerations of the target rows
+            timescale (callable): timescale(position, targets) -> dynamical time of the target rows
+
+        Returns:
+            tuple: new (position, velocity) and the dt that was taken
+        """
+        if self.adaptive:
+            remaining = self.duration - self.time
+            clipped = 0 < remaining < self.next_dt # land exactly on the end of the run
+            trial_dt = remaining if clipped else self.next_dt
+            position, velocity, dt, next_dt = integrators.adaptive_step(
+                self.integrate, position, velocity, trial_dt, acceleration, self.tolerance)
+            if not clipped or dt < trial_dt:
+                self.next_dt = next_dt
+            return position, velocity, dt
+        if self.integrator in integrators.HELIOCENTRIC_INTEGRATORS:
+            mass = self.attracting_mass()
+            sources = np.setdiff1d(np.nonzero(mass)[0], [self.sun.index]) # kicks leave out the Sun
+            kick = lambda p: self.solve(p, mass, sources=sources, **self.solver_options())
+            position, velocity = self.integrate(position, velocity, self.dt, kick, mass, central=self.sun.index)
+            return position, velocity, self.dt
+        if self.integrator in integrators.BLOCK_INTEGRATORS:
+            position, velocity = self.integrate(position, velocity, self.dt, acceleration, timescale,
+                                                eta=self.timestep_eta, max_level=self.max_timestep_level)
+            return position, velocity, self.dt
+        position, velocity = self.integrate(position, velocity, self.dt, acceleration)
+        return position, velocity, self.dt
+
+
+    def accelerations(self, position, targets=None):
+        """Gravitational acceleration of bodies with the system placed at the given positions.
+
+        Args:
+            position (np.ndarray): (N, 3) positions of all bodies, in row order
+            targets (np.ndarray, optional): Rows to evaluate. Defaults to every body.
+
+        Returns:
+            np.ndarray: acceleration vectors of the target rows
+        """
+        sources = self.massive_rows() if self.test_particles else None
+        options = self.solver_options()
+        if targets is not None:
+            return self.solve(position, self.state.mass, points=position[targets], sources=sources, **options)
+        
+        # Reuse the last evaluation when nothing changed, e.g. the closing kick of a leapfrog step
+        if self._acc_cache is not None:
+            cached_pos, cached_mass, cached_acc = self._acc_cache
+            if np.array_equal(cached_pos, position) and np.array_equal(cached_mass, self.state.mass):
+                return cached_acc.copy()
+        acc = self.solve(position, self.state.mass, sources=sources, **options)
+        self._acc_cache = (np.copy(position), np.copy(self.state.mass), acc.copy())
+        return acc
+
+
+    def solver_options(self):
+        """Keyword arguments of the force solver besides positions, masses and rows.
+
+        Returns:
+            dict: options for self.solve
+        """
+        return {"theta": self.opening_angle} if self.force_solver == "barnes_hut" else {}
+
+
+    def attracting_mass(self):
+        """Mass of every body as a source of gravity, zero for test particles.
+
+        Returns:
+            np.ndarray: (N,) masses in row order
+        """
+        if not self.test_particles:
+            return self.state.mass
+        mass = np.zeros(len(self.state))
+        rows = self.massive_rows()
+        mass[rows] = self.state.mass[rows]
+        return mass
+
+
+    def massive_rows(self):
+        """Rows of the bodies that attract in test particle mode, everything except asteroids.
+
+        Returns:
+            np.ndarray: row indices into self.state
+        """
+        state, layout, rows = self._massive_rows
+        if state is not self.state or layout != self.state.layout:
+            rows = np.array([i for i, b in enumerate(self.bodies) if not isinstance(b, Asteroid)], dtype=int)
+            self._massive_rows = (self.state, self.state.layout, rows)
+        return rows
+
+
+    def load_ephemeris(self):
+        """Looks up or builds the ephemeris of the planets as they are now, see PlanetEphemeris.load_or_build.
+
+        Returns:
+            PlanetEphemeris: the ephemeris
+        """
+        return PlanetEphemeris.load_or_build(
+            self.planets, self.dt, self.duration, self.mass_multi, self.vel_multi,
+            self.integrator if self.integrator in integrators.INTEGRATORS else "rk4", cache_dir=self.ephemeris_dir)
+
+
+    def sync_ephemeris(self):
+        """Makes sure the ephemeris follows the current planets, which a setup may have changed
+        after construction. Before the first step a mismatched ephemeris is replaced by the one
+        of the current planets, dt and duration. Later the planets must still be on it.
+        """
+        if self.ephemeris is None:
+            return
+        planets, _ = self.ephemeris_rows()
+        if self.ephemeris.follows(self.state.position[planets], self.state.velocity[planets],
+                                  self.state.mass[planets], self.time):
+            if self.steps_taken > 0 or (self.ephemeris.dt == self.dt and self.ephemeris.times[-1] + 1e-9 * self.dt >= self.duration):
+                return
+        if self.steps_taken > 0:
+            raise ValueError("The planets were changed during an ephemeris run, they can only be changed before the first step.")
+        self.ephemeris = self.load_ephemeris()
+
+
+    def ephemeris_rows(self):
+        """Rows of the planets, which follow the ephemeris, and of the bodies integrated against it.
+
+        Returns:
+            tuple: (planet rows, free rows), row indices into self.state
+        """
+        state, layout, rows = self._ephemeris_rows
+        if state is not self.state or layout != self.state.layout:
+            planets = np.array([p.index for p in self.planets], dtype=int)
+            rows = (planets, np.setdiff1d(np.arange(len(self.state)), planets))
+            self._ephemeris_rows = (self.state, self.state.layout, rows)
+        return rows
+
+
+    def attracting_rows(self):
+        """Rows of the bodies that attract, None when every body does.
+
+        Returns:
+            np.ndarray: row indices into self.state, or None
+        """
+        if self.test_particles or self.ephemeris is not None:
+            return self.massive_rows()
+        return None
+
+
+    def dynamical_times(self, position, targets=None):
+        """Shortest two-body dynamical time of bodies with the system placed at the given positions.
+        Used by block timestep integrators to bin the bodies.
+
+        Args:
+            position (np.ndarray): (N, 3) positions of all bodies, in row order
+            targets (np.ndarray, optional): Rows to evaluate. Defaults to every body.
+
+        Returns:
+            np.ndarray: dynamical time in seconds of the target rows
+        """
+        return gravity.dynamical_times(position, self.state.mass, targets=targets)
+
+
+    def asteroid_rows(self):
+        """Rows of the asteroids still in the simulation.
+
+        Returns:
+            np.ndarray: row indices into self.state
+        """
+        state, layout, rows = self._asteroid_rows
+        if state is not self.state or layout != self.state.layout:
+            rows = np.array([i for i, b in enumerate(self.bodies) if isinstance(b, Asteroid)], dtype=int)
+            self._asteroid_rows = (self.state, self.state.layout, rows)
+        return rows
+
 
-        self.handle_collisions()
+    def handle_encounters(self, start_position, start_velocity, dt):
+        """Integrates asteroids that came within encounter_radius Hill radii of Earth during the
+        step again with substeps, see encounters.py. The rest of the system keeps its global step.
+        Contacts found along the substeps are kept for handle_collisions.
+
+        Args:
+            start_position (np.ndarray): (N, 3) positions at the start of the step
+            start_velocity (np.ndarray): (N, 3) velocities at the start of the step
+            dt (float): Length of the step in seconds
+        """
+        rows = self.asteroid_rows()
+        if len(rows) == 0:
+            return
+        earth, sun = self.earth.index, self.sun.index
+        zone = self.encounter_radius * encounters.hill_radius(
+            np.linalg.norm(start_position[earth] - start_position[sun]), self.earth.mass, self.sun.mass)
+        r0 = start_position[rows] - start_position[earth]
+        v0 = start_velocity[rows] - start_velocity[earth]
+        r1 = self.state.position[rows] - self.state.position[earth]
+        v1 = self.state.velocity[rows] - self.state.velocity[earth]
+        entered = ~np.isnan(events.threshold_crossings(r0, v0, r1, v1, dt, zone))
+        if not np.any(entered):
+            return
         
-        self.all_timestep_bodies.append(op_bodies)
-        self.bodies = copy.deepcopy(op_bodies)
+        rows = rows[entered]
+        n = encounters.substeps(r0[entered], v0[entered], r1[entered], v1[entered], dt,
+                                self.earth.mass, self.earth.radius, self.encounter_eta)
+        attracting = self.massive_rows() if self.test_particles or self.ephemeris is not None else np.arange(len(self.state))
+        sources = np.setdiff1d(attracting, rows)
+        end_position, end_velocity = self.state.position.copy(), self.state.velocity.copy()
+        self.state.position[rows], self.state.velocity[rows], hit, when = encounters.refine(
+            start_position, start_velocity, end_position, end_velocity,
+            self.state.mass, self.state.radius, rows, sources, dt, n)
+        self.encounters.extend((self.time + dt, self.bodies[row], n) for row in rows)
 
+        # (fraction of the step, row, source, contact point of the row, contact point of the source)
+        impacts = []
+        for row, source, s in zip(rows[hit >= 0], hit[hit >= 0], when[hit >= 0]):
+            source_contact, _ = integrators.hermite(start_position[source], start_velocity[source],
+                                                    end_position[source], end_velocity[source], dt, s)
+            row_contact = self.state.position[row] - end_position[source] + source_contact
+            impacts.append((s, row, source, row_contact, source_contact))
+        self._refined = (rows, sources, impacts)
 
-    def handle_collisions(self):
+
+    def handle_collisions(self, start_position=None, dt=None):
         """Check and resolve all collisions between bodies.
+        Without start positions only the current positions are tested. With them every body is
+        swept along a straight line from its start to its current position, and colliding pairs
+        are resolved at their time of impact: the pair is moved back to the point of contact,
+        collided, and the velocity change is carried over the rest of the step.
+        Asteroids refined by handle_encounters followed a curved path, their contacts with the
+        attracting bodies come from the substeps instead of the straight line.
+
+        Args:
+            start_position (np.ndarray, optional): (N, 3) positions at the start of the step
+            dt (float, optional): Length of the step in seconds, needed with start_position
         """
-        for i, body1 in enumerate(self.bodies):
-            for body2 in self.bodies[i+1:]:
-                if body1.is_collided(body2):
-                    body1.collide(body2)
+        if start_position is None:
+            pairs = [tuple(pair) for pair in collisions.colliding_pairs(self.state.position, self.state.radius)]
+            if self._refined is not None: # contacts found along the substeps end exactly touching
+                pairs += [pair for pair in sorted((min(r, k), max(r, k)) for _, r, k, _, _ in self._refined[2])
+                          if pair not in pairs]
+            for body1, body2 in [(self.bodies[i], self.bodies[j]) for i, j in pairs]:
+                if body1.state is None or body2.state is None: continue # removed by an earlier collision
+                self.impacts.append((self.time, body1, body2))
+                body1.collide(body2)
+            return
+        
+        end_position = self.state.position.copy()
+        pairs, impact = collisions.swept_pairs(start_position, end_position, self.state.radius)
+        if self._refined is not None:
+            rows, sources, refined_impacts = self._refined
+            refined, attracting = np.zeros(len(self.state), bool), np.zeros(len(self.state), bool)
+            refined[rows], attracting[sources] = True, True
+            i, j = pairs[:, 0], pairs[:, 1]
+            chord = ~((refined[i] & attracting[j]) | (refined[j] & attracting[i]))
+            pairs, impact = pairs[chord], impact[chord]
+        else:
+            refined_impacts = []
+
+        # (fraction of the step, row i, row j, contact point of i, contact point of j) in order of impact
+        contacts = [(s, i, j, start_position[i] + s * (end_position[i] - start_position[i]),
+                   start_position[j] + s * (end_position[j] - start_position[j])) for (i, j), s in zip(pairs, impact)]
+        for s, row, source, row_contact, source_contact in refined_impacts:
+            contacts.append((s, source, row, source_contact, row_contact) if source < row else
+                          (s, row, source, row_contact, source_contact))
+        contacts.sort(key=lambda contact: contact[0])
 
-    def handle_dart(self, body):
-        """Checks if a body is an asteroid that meets the criteria to launch a dart.
+        collided = set()
+        # bodies are looked up before resolving anything, removals shift the rows of later ones
+        for body1, body2, i, j, s, contact in [(self.bodies[i], self.bodies[j], i, j, s, [ci, cj])
+                                               for s, i, j, ci, cj in contacts]:
+            if body1 in collided or body2 in collided: continue # only the first bounce of a body per step is resolved
+            if body1.state is None or body2.state is None: continue # removed by an earlier collision
+            
+            before = [np.copy(body1.velocity), np.copy(body2.velocity)]
+            body1.position, body2.position = contact
+            self.impacts.append((self.time - (1 - s) * dt, body1, body2))
+            body1.collide(body2)
+            
+            # carry the change over the rest of the step on top of the integrated path
+            for body, k, old_vel, at_contact in zip((body1, body2), (i, j), before, contact):
+                if body.state is None: continue # removed by the collision
+                correction = body.position - at_contact
+                body.position = end_position[k] + correction + (1 - s) * dt * (body.velocity - old_vel)
+            if body1.state is not None and body2.state is not None: # bounced, the rest of both paths changed
+                collided.update((body1, body2))
+
+    def handle_dart(self, start_position=None, start_velocity=None, dt=None):
+        """Launches a dart at every asteroid that meets the criteria.
         - Hasn't been hit yet
         - Marked to be hit (decided when asteroid is initialized)
+        - Within dart_distance of Earth
+        
+        With the state at the start of the step the threshold crossing is located within the
+        step and the dart is launched at that time, so the launch geometry does not depend on dt.
+        Without it only the current distance is checked.
 
         Args:
-            body (Body): The body to check
+            start_position (np.ndarray, optional): (N, 3) positions at the start of the step
+            start_velocity (np.ndarray, optional): (N, 3) velocities at the start of the step
+            dt (float, optional): Length of the step in seconds, needed with start_position
         """
-        if (type(body) != Asteroid):
+        if start_position is None:
+            rows = self.pending_rows()
+            dist = np.linalg.norm(self.state.position[rows] - self.state.position[self.earth.index], axis=1)
+            for row in rows[dist < self.dart_distance]:
+                self.launch_dart(self.bodies[row])
             return
-        if body.will_be_intercepted and not body.intercepted and body.distance_to(self.earth) < self.dart_distance:
-            self.launch_dart(body)
+        
+        rows, crossing = self.launch_crossings(start_position, start_velocity, dt)
+        launched = ~np.isnan(crossing)
+        for row, s in zip(rows[launched], crossing[launched]):
+            self.launch_dart_within_step(self.bodies[row], s, start_position, start_velocity, dt)
+
+    def launch_crossings(self, start_position, start_velocity, dt):
+        """Finds where in the step each asteroid waiting for a dart crossed dart_distance of Earth.
+
+        Args:
+            start_position (np.ndarray): (N, 3) positions at the start of the step
+            start_velocity (np.ndarray): (N, 3) velocities at the start of the step
+            dt (float): Length of the step in seconds
+
+        Returns:
+            tuple: rows of the waiting asteroids and the fraction of the step at their crossing, nan for none
+        """
+        rows = self.pending_rows()
+        earth = self.earth.index
+        r0 = start_position[rows] - start_position[earth]
+        v0 = start_velocity[rows] - start_velocity[earth]
+        r1 = self.state.position[rows] - self.state.position[earth]
+        v1 = self.state.velocity[rows] - self.state.velocity[earth]
+        return rows, events.threshold_crossings(r0, v0, r1, v1, dt, self.dart_distance)
+
+    def pending_rows(self):
+        """Rows of asteroids that will be intercepted and have not been yet.
+
+        Returns:
+            np.ndarray: row indices into self.state
+        """
+        state, layout, launches, rows = self._pending_rows
+        if state is not self.state or layout != self.state.layout or launches != len(self.dart_launches):
+            rows = np.array([a.index for a in self.asteroids
+                             if a.state is self.state and a.will_be_intercepted and not a.intercepted], dtype=int)
+            self._pending_rows = (self.state, self.state.layout, len(self.dart_launches), rows)
+        return rows
+
+    def launch_dart_within_step(self, asteroid, s, start_position, start_velocity, dt):
+        """Launches a DART at the point of a step where the asteroid crossed dart_distance.
+        The asteroid and Earth are placed on their interpolated paths at that time for the
+        impact, and the asteroid's change in velocity is carried over the rest of the step.
+
+        Args:
+            asteroid (Asteroid): Asteroid the DART will collide with
+            s (float): Fraction of the step at the crossing
+            start_position (np.ndarray): (N, 3) positions at the start of the step
+            start_velocity (np.ndarray): (N, 3) velocities at the start of the step
+            dt (float): Length of the step in seconds
+        """
+        rows = [asteroid.index, self.earth.index]
+        end_position = self.state.position[rows].copy()
+        end_velocity = self.state.velocity[rows].copy()
+        position, velocity = integrators.hermite(start_position[rows], start_velocity[rows],
+                                                 end_position, end_velocity, dt, s)
+        asteroid.position, asteroid.velocity = position[0], velocity[0]
+        self.launch_dart(asteroid, earth_position=position[1], time=self.time - (1 - s) * dt)
+        
+        dv = asteroid.velocity - velocity[0]
+        correction = asteroid.position - position[0]
+        asteroid.position = end_position[0] + correction + (1 - s) * dt * dv
+        asteroid.velocity = end_velocity[0] + dv
 
-    def launch_dart(self, asteroid):
+    def launch_dart(self, asteroid, earth_position=None, time=None):
         """Launches a DART at a given Asteroid
 
         Args:
             asteroid (Asteroid): Asteroid body the DART will collide with.
+            earth_position (np.ndarray, optional): Where the DART starts from. Defaults to Earth's position.
+            time (float, optional): Launch time in seconds. Defaults to the current time.
         """
+        earth_position = self.earth.position if earth_position is None else earth_position
         # normal vector where dart is coming from
         dart_radius = 10
-        dir = (asteroid.position - self.earth.position) / asteroid.distance_to(self.earth)
+        dir = (asteroid.position - earth_position) / np.linalg.norm(asteroid.position - earth_position)
         pos = asteroid.position - dir * (asteroid.radius + dart_radius) # spawn dart colliding with asteroid
         vel = dir * self.dart_speed
         dart = Dart(pos, vel, self.dart_mass, dart_radius, self)
+        self.dart_launches.append((self.time if time is None else time, asteroid))
         
         # Immediately calculate collision
         asteroid.collide(dart)
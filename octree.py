@@ -0,0 +1,243 @@
+"""
+Barnes-Hut octree for O(N log N) gravity.
+
+The tree is stored in flat arrays rather than node objects. Bodies are sorted by their
+Morton code, the interleaved bits of their quantized coordinates, so every node covers a
+contiguous range of the sorted bodies and the children of a node are the runs of equal
+code prefixes inside its range. The tree is built one level at a time with whole-array
+operations, and the children of every node are stored next to each other.
+
+The field is evaluated by walking the tree for all target points at once. A frontier of
+(point, node) pairs is kept: a node that is far enough away, size / distance < theta with
+the distance reduced by the offset of the center of mass from the box center,
+acts as a point mass at its center of mass, a leaf is summed directly and any other node
+is replaced by its children. theta = 0 opens every node and reproduces direct summation.
+"""
+import numpy as np
+
+BITS = 21 # bits per axis of the Morton code, the deepest level of the tree
+LEAF_SIZE = 8 # most bodies in a node that is not split further
+THETA = 0.5 # default opening angle
+MAX_FRONTIER = 2**18 # (point, node) pairs walked at once
+
+
+def spread_bits(q):
+    """Spreads the low 21 bits of each integer so two zero bits separate neighbours.
+
+    Args:
+        q (np.ndarray): unsigned 64 bit integers
+
+    Returns:
+        np.ndarray: the spread integers
+    """
+    q = q & np.uint64(0x1fffff)
+    q = (q | q << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    q = (q | q << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    q = (q | q << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    q = (q | q << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    q = (q | q << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return q
+
+
+def morton_codes(position):
+    """Morton codes of points quantized on a 2**21 grid over their bounding cube.
+
+    Args:
+        position (np.ndarray): (N, 3) positions
+
+    Returns:
+        np.ndarray: (N,) unsigned 64 bit codes
+    """
+    lo = position.min(axis=0)
+    span = max(np.ptp(position, axis=0).max(), np.finfo(float).tiny)
+    q = np.minimum((position - lo) / span * 2**BITS, 2**BITS - 1).astype(np.uint64)
+    return spread_bits(q[:, 0]) << np.uint64(2) | spread_bits(q[:, 1]) << np.uint64(1) | spread_bits(q[:, 2])
+
+
+def ranges(start, stop):
+    """Concatenation of np.arange(start[i], stop[i]) for every i, without a Python loop.
+
+    Args:
+        start (np.ndarray): (K,) range starts
+        stop (np.ndarray): (K,) range ends, exclusive
+
+    Returns:
+        tuple: (indices, owner) where owner[j] is the range index j came from
+    """
+    counts = stop - start
+    owner = np.repeat(np.arange(len(start)), counts)
+    offsets = np.cumsum(counts) - counts
+    return start[owner] + np.arange(counts.sum()) - offsets[owner], owner
+
+
+def segment_reduce(ufunc, values, start, stop):
+    """Reduces values[start[i]:stop[i]] for every i with a ufunc, the ranges may overlap.
+
+    Args:
+        ufunc (np.ufunc): e.g. np.add, np.minimum
+        values (np.ndarray): (N, ...) values
+        start (np.ndarray): (K,) range starts
+        stop (np.ndarray): (K,) range ends, exclusive, each range must be non-empty
+
+    Returns:
+        np.ndarray: (K, ...) reductions
+    """
+    padded = np.concatenate((values, values[:1])) # lets a range end at N
+    bounds = np.column_stack((start, stop)).ravel()
+    return ufunc.reduceat(padded, bounds, axis=0)[::2]
+
+
+class Octree:
+    """Array-backed octree over a set of point masses.
+
+    Attributes:
+        order (np.ndarray): (N,) body rows in Morton order
+        rank (np.ndarray): (N,) position of each body row in Morton order
+        start (np.ndarray): (K,) first sorted body of each node, node 0 is the root
+        stop (np.ndarray): (K,) one past the last sorted body of each node
+        child_start (np.ndarray): (K,) first child of each node
+        child_stop (np.ndarray): (K,) one past the last child, equal to child_start for leaves
+        mass (np.ndarray): (K,) total mass of each node
+        com (np.ndarray): (K, 3) center of mass of each node
+        lo (np.ndarray): (K, 3) lower corner of the bounding box of each node's bodies
+        hi (np.ndarray): (K, 3) upper corner of the bounding box of each node's bodies
+        size (np.ndarray): (K,) longest side of each node's bounding box
+        offset (np.ndarray): (K,) distance from each node's center of mass to its box center
+    """
+    def __init__(self, position, mass, leaf_size=LEAF_SIZE):
+        position = np.asarray(position, dtype=float)
+        mass = np.asarray(mass, dtype=float)
+        n = len(position)
+        codes = morton_codes(position) if n else np.zeros(0, dtype=np.uint64)
+        self.order = np.argsort(codes, kind="stable")
+        self.rank = np.empty(n, dtype=int)
+        self.rank[self.order] = np.arange(n)
+        codes = codes[self.order]
+        self.position = position[self.order]
+        self.body_mass = mass[self.order]
+
+        starts, stops, links = [np.array([0])], [np.array([n])], []
+        level_ids, level_start, level_stop = np.array([0]), starts[0], stops[0]
+        count = 1
+        for level in range(1, BITS + 1):
+            split = level_stop - level_start > leaf_size
+            if not np.any(split):
+                break
+            parent_stop = level_stop[split]
+            rows, owner = ranges(level_start[split], parent_stop)
+            prefix = codes[rows] >> np.uint64(3 * (BITS - level))
+            first = np.ones(len(rows), dtype=bool)
+            first[1:] = (prefix[1:] != prefix[:-1]) | (owner[1:] != owner[:-1])
+            child_owner = owner[first]
+            child_start = rows[first]
+            child_stop = np.append(child_start[1:], 0)
+            last = np.append(child_owner[1:] != child_owner[:-1], True) # last child of its parent
+            child_stop[last] = parent_stop[child_owner[last]]
+
+            per_parent = np.bincount(child_owner, minlength=len(parent_stop))
+            first_child = count + np.cumsum(per_parent) - per_parent
+            links.append((level_ids[split], first_child, first_child + per_parent))
+            level_ids = count + np.arange(len(child_start))
+            count += len(child_start)
+            starts.append(child_start)
+            stops.append(child_stop)
+            level_start, level_stop = child_start, child_stop
+
+        self.start = np.concatenate(starts)
+        self.stop = np.concatenate(stops)
+        self.child_start = np.zeros(count, dtype=int)
+        self.child_stop = np.zeros(count, dtype=int)
+        for parents, first_child, last_child in links:
+            self.child_start[parents] = first_child
+            self.child_stop[parents] = last_child
+
+        if n == 0:
+            self.mass, self.com = np.zeros(count), np.zeros((count, 3))
+            self.lo, self.hi = np.zeros((count, 3)), np.zeros((count, 3))
+            self.size, self.offset = np.zeros(count), np.zeros(count)
+            return
+        self.mass = segment_reduce(np.add, self.body_mass, self.start, self.stop)
+        moment = segment_reduce(np.add, self.body_mass[:, None] * self.position, self.start, self.stop)
+        centroid = segment_reduce(np.add, self.position, self.start, self.stop) / (self.stop - self.start)[:, None]
+        massive = self.mass > 0
+        self.com = np.where(massive[:, None], moment / np.where(massive, self.mass, 1.0)[:, None], centroid)
+        self.lo = segment_reduce(np.minimum, self.position, self.start, self.stop)
+        self.hi = segment_reduce(np.maximum, self.position, self.start, self.stop)
+        self.size = (self.hi - self.lo).max(axis=1)
+        self.offset = np.linalg.norm(self.com - (self.lo + self.hi) / 2, axis=1) # center of mass to box center
+
+
+    def field(self, points, theta=THETA, exclude=None, max_frontier=MAX_FRONTIER):
+        """Sum over bodies of m r / |r|^3 at each point, the acceleration without G.
+        Bodies at zero distance from a point are skipped.
+
+        Args:
+            points (np.ndarray): (P, 3) points to evaluate at
+            theta (float, optional): Opening angle, nodes with size / distance below it are
+                                     treated as point masses. 0 gives direct summation.
+            exclude (np.ndarray, optional): (P,) body row to ignore for each point, -1 for none
+            max_frontier (int, optional): Maximum number of (point, node) pairs walked at once
+
+        Returns:
+            np.ndarray: (P, 3) field vectors
+        """
+        points = np.asarray(points, dtype=float)
+        field = np.zeros(points.shape)
+        if len(self.order) == 0:
+            return field
+        excluded_rank = None
+        if exclude is not None:
+            exclude = np.asarray(exclude)
+            excluded_rank = np.where(exclude >= 0, self.rank[np.maximum(exclude, 0)], -1)
+
+        # (point, node) batches still to walk. Opened nodes are pushed back in pieces of at most
+        # max_frontier pairs and walked depth first, which keeps memory bounded for small theta.
+        everyone = np.arange(len(points))
+        stack = [(everyone[i:i + max_frontier], np.zeros(len(everyone[i:i + max_frontier]), dtype=int))
+                 for i in range(0, len(points), max_frontier)]
+        while stack:
+            point, node = stack.pop()
+            p = points[point]
+            r = self.com[node] - p
+            dist2 = np.einsum('ij,ij->i', r, r)
+            inside = np.all((p >= self.lo[node]) & (p <= self.hi[node]), axis=1)
+            if excluded_rank is not None: # never lump the excluded body into a point mass
+                k = excluded_rank[point]
+                inside |= (k >= self.start[node]) & (k < self.stop[node])
+            reach = np.sqrt(dist2) - self.offset[node] # guards against a center of mass near the box edge
+            far = (self.size[node] < theta * reach) & ~inside
+            leaf = self.child_start[node] == self.child_stop[node]
+
+            # distant nodes act as point masses
+            if np.any(far):
+                weight = self.mass[node[far]] / dist2[far]**1.5
+                self._accumulate(field, point[far], weight[:, None] * r[far])
+
+            # nearby leaves are summed body by body
+            direct = leaf & ~far
+            if np.any(direct):
+                rows, owner = ranges(self.start[node[direct]], self.stop[node[direct]])
+                target = point[direct][owner]
+                rb = self.position[rows] - points[target]
+                d2 = np.einsum('ij,ij->i', rb, rb)
+                keep = d2 > 0
+                if excluded_rank is not None:
+                    keep &= rows != excluded_rank[target]
+                weight = np.zeros(len(rows))
+                weight[keep] = self.body_mass[rows[keep]] / d2[keep]**1.5
+                self._accumulate(field, target, weight[:, None] * rb)
+
+            # everything else is opened
+            opened = ~leaf & ~far
+            children, owner = ranges(self.child_start[node[opened]], self.child_stop[node[opened]])
+            parents = point[opened][owner]
+            for i in range(0, len(children), max_frontier):
+                stack.append((parents[i:i + max_frontier], children[i:i + max_frontier]))
+        return field
+
+
+    @staticmethod
+    def _accumulate(out, point, values):
+        """Adds values[j] to out[point[j]], with repeated points summed."""
+        for axis in range(3):
+            out[:, axis] += np.bincount(point, weights=values[:, axis], minlength=len(out))
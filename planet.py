@@ -1,5 +1,5 @@
 from body import Body
 
 class Planet(Body):
-    def __init__(self, pos, vel, mass, radius, model):
-        super().__init__(pos, vel, mass, radius, model)
\ No newline at end of file
+    def __init__(self, pos, vel, mass, radius, model, label=""):
+        super().__init__(pos, vel, mass, radius, model, label)
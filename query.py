@@ -0,0 +1,182 @@
+"""
+Whole-run queries over array-backed histories.
+
+A TrajectoryBuffer or TrajectoryStore keeps a run as a (T, columns, 6) array with one
+fixed column per body, NaN where the body was not in the simulation. Questions about a
+whole run, e.g. how close two bodies came or how many asteroids were left at each step,
+are answered here with one NumPy operation over a column or a set of columns instead of
+materializing every frame as Body objects. Only the columns a query needs are read, so
+memory-mapped stores stay mostly on disk.
+
+Steps are indices into the held steps of the history, oldest first, the same indices as
+Model.all_timestep_bodies and Model.times. Bodies are given by label, by Body or by their
+permanent ID, see SystemState, which also identifies asteroids without labels. DARTs never
+get a row in the state, so they have no ID and are not recorded.
+"""
+import numpy as np
+from store import BODY_CLASSES
+
+
+class TrajectoryQuery:
+    """Queries over the held steps of a history.
+
+    Attributes:
+        history (TrajectoryBuffer): History to query, a TrajectoryStore works as well
+        columns (dict): label -> column of the first body recorded with that label
+        id_columns (dict): body ID -> column
+    """
+    def __init__(self, history):
+        self.history = history
+        self.columns = {}
+        self.id_columns = {}
+        for c, body in enumerate(history.bodies):
+            self.columns.setdefault(body.label, c)
+            if body.id is not None:
+                self.id_columns[body.id] = c
+
+
+    def column(self, body):
+        """Column of a body given by its label, the Body itself or its ID.
+
+        Args:
+            body (str, Body or int): Body to look up
+
+        Returns:
+            int: column in the history
+        """
+        if isinstance(body, str):
+            if body not in self.columns:
+                raise ValueError(f"No body labelled '{body}' in the history.")
+            return self.columns[body]
+        if isinstance(body, (int, np.integer)):
+            if body not in self.id_columns:
+                raise ValueError(f"No body with ID {body} in the history.")
+            return self.id_columns[body]
+        if body not in self.history.column_of:
+            raise ValueError(f"Body '{body.label}' is not recorded in the history.")
+        return self.history.column_of[body]
+
+
+    def find(self, label, step=-1):
+        """Body with a label at one step, like Analysis.find_by_label on a frame.
+
+        Args:
+            label (str): Label of the body
+            step (int, optional): Held step, negative counts from the end. Defaults to the last.
+
+        Returns:
+            Body: detached copy of the body at the step, None if it was not in the simulation
+        """
+        if label not in self.columns:
+            return None
+        c = self.columns[label]
+        values = self.values(c)[step]
+        if np.isnan(values[0]):
+            return None
+        return self.history.bodies[c].snapshot(values[:3], values[3:])
+
+
+    def values(self, columns):
+        """Positions and velocities of some columns at every held step.
+
+        Args:
+            columns (int or list): Column or columns to read
+
+        Returns:
+            np.ndarray: (T, 6) or (T, len(columns), 6), NaN where a body was not present
+        """
+        data, length = self.history.data, self.history.length
+        if self.history.total > length: # rolling window has wrapped
+            return data[:, columns][self.history._order()]
+        return data[:length, columns]
+
+
+    def present(self, bodies):
+        """Whether each of some bodies was in the simulation at every held step.
+
+        Args:
+            bodies (list): Bodies to look up, see column
+
+        Returns:
+            np.ndarray: (T, len(bodies)) bool mask
+        """
+        return ~np.isnan(self.values([self.column(b) for b in bodies])[:, :, 0])
+
+
+    def positions(self, body):
+        """Position of a body at every held step.
+
+        Args:
+            body (str, Body or int): Body to look up, see column
+
+        Returns:
+            np.ndarray: (T, 3) positions, NaN where the body was not present
+        """
+        return self.values(self.column(body))[:, :3]
+
+
+    def distances(self, body_1, body_2):
+        """Distance between the centers of two bodies at every held step.
+
+        Args:
+            body_1 (str, Body or int): First body, see column
+            body_2 (str, Body or int): Second body, see column
+
+        Returns:
+            np.ndarray: (T,) distances in meters, NaN where either body was not present
+        """
+        return np.linalg.norm(self.positions(body_1) - self.positions(body_2), axis=1)
+
+
+    def min_separation(self, body_1, body_2):
+        """Closest recorded approach of two bodies.
+
+        Args:
+            body_1 (str, Body or int): First body, see column
+            body_2 (str, Body or int): Second body, see column
+
+        Returns:
+            tuple: (distance in meters, held step), (nan, None) if they never were present together
+        """
+        distance = self.distances(body_1, body_2)
+        if np.all(np.isnan(distance)):
+            return np.nan, None
+        step = int(np.nanargmin(distance))
+        return distance[step], step
+
+
+    def first_contact(self, body_1, body_2):
+        """First held step where two bodies overlap, distance below the sum of their radii.
+
+        Args:
+            body_1 (str, Body or int): First body, see column
+            body_2 (str, Body or int): Second body, see column
+
+        Returns:
+            int: held step, None if they never overlap
+        """
+        c1, c2 = self.column(body_1), self.column(body_2)
+        reach = self.history.bodies[c1].radius + self.history.bodies[c2].radius
+        position = self.values([c1, c2])[:, :, :3]
+        with np.errstate(invalid='ignore'):
+            contact = np.nonzero(np.linalg.norm(position[:, 0] - position[:, 1], axis=1) < reach)[0]
+        return int(contact[0]) if len(contact) else None
+
+
+    def counts(self, body_class):
+        """Number of bodies of a class present at every held step.
+
+        Args:
+            body_class (type or str): Body class or its name, e.g. Asteroid or "Asteroid"
+
+        Returns:
+            np.ndarray: (T,) counts
+        """
+        if isinstance(body_class, str):
+            if body_class not in BODY_CLASSES:
+                raise ValueError(f"Unknown body class '{body_class}'. Valid classes: {', '.join(BODY_CLASSES)}.")
+            body_class = BODY_CLASSES[body_class]
+        columns = [c for c, body in enumerate(self.history.bodies) if isinstance(body, body_class)]
+        if not columns:
+            return np.zeros(self.history.length, dtype=int)
+        return np.count_nonzero(~np.isnan(self.values(columns)[:, :, 0]), axis=1)
@@ -0,0 +1,146 @@
+"""
+Structure-of-arrays storage for the bodies of a Model.
+
+Every body's position, velocity, mass and radius live in contiguous arrays so the
+hot paths of the simulation (gravity, collisions, DART checks, history recording)
+can work on whole columns at once. Body objects become thin views onto one row.
+
+Rows are packed, removing a body shifts the rows after it. Every body that gets a row is
+also given a permanent integer ID, its position in the registry, which never changes and
+is never reused. The ID -> row index and the alive mask over all IDs follow the rows, so
+bodies can be referred to by ID across removals, history frames and checkpoints.
+"""
+import numpy as np
+
+
+class SystemState:
+    """Central state of all bodies in a Model.
+
+    Attributes:
+        position (np.ndarray): (N, 3) positions in meters
+        velocity (np.ndarray): (N, 3) velocities in m/s
+        mass (np.ndarray): (N,) masses in kg
+        radius (np.ndarray): (N,) radii in meters
+        bodies (list): Body views, bodies[i] is the view onto row i
+        ids (np.ndarray): (N,) permanent ID of the body in each row
+        registry (list): Every body that was ever given a row, registry[id] is the body with that ID
+    """
+    COLUMNS = ("position", "velocity", "mass", "radius")
+
+    def __init__(self):
+        self.position = np.zeros((0, 3))
+        self.velocity = np.zeros((0, 3))
+        self.mass = np.zeros(0)
+        self.radius = np.zeros(0)
+        self.bodies = []
+        self.ids = np.zeros(0, dtype=int)
+        self.registry = []
+        self.layout = 0 # incremented whenever rows are added or removed
+        self._row_of = (None, None) # (layout, ID -> row array) cache
+
+
+    @classmethod
+    def from_bodies(cls, bodies, registry=None):
+        """Builds a state holding the current values of the given bodies and attaches
+        every body to its row.
+
+        Args:
+            bodies (list): Bodies to store, in row order
+            registry (list, optional): Registry to carry on from, e.g. of the state being replaced.
+                                       Bodies not in it get new IDs.
+
+        Returns:
+            SystemState: the new state
+        """
+        state = cls()
+        state.registry = list(registry or [])
+        state.ids = np.array([state.register(b) for b in bodies], dtype=int)
+        state.position = np.array([b.position for b in bodies], dtype=float).reshape(-1, 3)
+        state.velocity = np.array([b.velocity for b in bodies], dtype=float).reshape(-1, 3)
+        state.mass = np.array([b.mass for b in bodies], dtype=float)
+        state.radius = np.array([b.radius for b in bodies], dtype=float)
+        state.bodies = list(bodies)
+        for i, body in enumerate(state.bodies):
+            body.attach(state, i)
+        return state
+
+
+    def __len__(self):
+        return len(self.bodies)
+
+
+    def add(self, body):
+        """Appends a body as a new row and attaches it.
+
+        Args:
+            body (Body): Body to add
+
+        Returns:
+            int: row index of the body
+        """
+        self.position = np.vstack((self.position, np.asarray(body.position, dtype=float)))
+        self.velocity = np.vstack((self.velocity, np.asarray(body.velocity, dtype=float)))
+        self.mass = np.append(self.mass, body.mass)
+        self.radius = np.append(self.radius, body.radius)
+        self.ids = np.append(self.ids, self.register(body))
+        self.bodies.append(body)
+        body.attach(self, len(self.bodies) - 1)
+        self.layout += 1
+        return body.index
+
+
+    def remove(self, body):
+        """Removes a body's row. The body is detached and keeps its last values and its ID,
+        which stays in the registry and is no longer alive.
+
+        Args:
+            body (Body): Body to remove
+        """
+        index = body.index
+        body.detach()
+        for name in self.COLUMNS:
+            setattr(self, name, np.delete(getattr(self, name), index, axis=0))
+        self.ids = np.delete(self.ids, index)
+        del self.bodies[index]
+        for b in self.bodies[index:]:
+            b.index -= 1
+        self.layout += 1
+
+
+
+    def register(self, body):
+        """Gives a body a permanent ID if it has none in this registry.
+
+        Args:
+            body (Body): Body to register
+
+        Returns:
+            int: the body's ID
+        """
+        if body.id is None or body.id >= len(self.registry) or self.registry[body.id] is not body:
+            body.id = len(self.registry)
+            self.registry.append(body)
+        return body.id
+
+
+    def row_of(self, ids):
+        """Current rows of bodies given by ID.
+
+        Args:
+            ids (int or np.ndarray): IDs to look up
+
+        Returns:
+            int or np.ndarray: row of each ID, -1 for a body that was removed
+        """
+        layout, rows = self._row_of
+        if layout != self.layout or len(rows) != len(self.registry):
+            rows = np.full(len(self.registry), -1, dtype=int)
+            rows[self.ids] = np.arange(len(self.ids))
+            self._row_of = (self.layout, rows)
+        return rows[ids]
+
+
+    @property
+    def alive(self):
+        """np.ndarray: (len(registry),) whether the body with each ID still has a row."""
+        return self.row_of(slice(None)) >= 0
@@ -0,0 +1,177 @@
+"""
+Memory-mapped on-disk trajectory store.
+
+A TrajectoryStore is a TrajectoryBuffer whose arrays live in files instead of RAM, so a
+run is bounded by disk rather than memory. Recorded steps are written into a
+memory-mapped .npy file and flushed to disk every flush_every steps. Two sidecars sit
+next to it: <name>.times.npy with the timestamps and <name>.json with the body labels,
+classes, masses, radii and IDs, the number of held steps and the run summary.
+
+TrajectoryStore.open maps an existing store read-only, so Analysis and Animation only
+read the steps and bodies they touch and a run can be re-analysed without re-simulating.
+"""
+import json
+import os
+import struct
+import numpy as np
+from history import TrajectoryBuffer
+from body import Body
+from planet import Planet
+from asteroid import Asteroid
+from dart import Dart
+
+HEADER_SIZE = 128 # bytes reserved for the .npy header so the shape can be rewritten in place
+BODY_CLASSES = {cls.__name__: cls for cls in (Body, Planet, Asteroid, Dart)}
+
+
+def store_paths(path):
+    """Data, timestamp and metadata file paths of a store.
+
+    Args:
+        path (str): Path of the .npy data file
+
+    Returns:
+        tuple: (data path, times path, metadata path)
+    """
+    base = path[:-4] if path.endswith(".npy") else path
+    return base + ".npy", base + ".times.npy", base + ".json"
+
+
+def write_npy_header(f, shape):
+    """Writes a version 1.0 float64 .npy header padded to HEADER_SIZE bytes.
+
+    Args:
+        f (file): File opened for binary writing
+        shape (tuple): Array shape to declare
+    """
+    header = "{'descr': '<f8', 'fortran_order': False, 'shape': %r, }" % (tuple(shape),)
+    header = header.ljust(HEADER_SIZE - 10 - 1) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+
+def create_npy(path, shape):
+    """Creates a float64 .npy file of the given shape and maps it read-write.
+
+    Args:
+        path (str): File to create
+        shape (tuple): Array shape
+
+    Returns:
+        np.ndarray: memory map of the file, or an in-memory array when the shape is empty
+    """
+    with open(path, "w+b") as f:
+        write_npy_header(f, shape)
+        f.truncate(HEADER_SIZE + int(np.prod(shape)) * 8)
+    if np.prod(shape) == 0:
+        return np.zeros(shape)
+    return np.memmap(path, dtype="<f8", mode="r+", offset=HEADER_SIZE, shape=tuple(shape))
+
+
+class TrajectoryStore(TrajectoryBuffer):
+    """TrajectoryBuffer backed by memory-mapped files.
+
+    Attributes:
+        path (str): Path of the .npy data file
+        flush_every (int): Steps recorded between flushes to disk
+        info (dict): Run summary stored in the metadata sidecar
+    """
+
+    def __init__(self, path, frames=0, columns=0, flush_every=1024, **policy):
+        self.path, self.times_path, self.meta_path = store_paths(path)
+        self.flush_every = flush_every
+        self.info = {}
+        super().__init__(0, 0, **policy)
+        self._adopt(*self._allocate(frames, columns))
+        self.flush()
+
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """Maps an existing store. Only the steps and bodies that are accessed are read from disk.
+
+        Args:
+            path (str): Path of the .npy data file
+            mode (str, optional): "r" for read-only, "r+" to keep recording into it. Defaults to "r".
+
+        Returns:
+            TrajectoryStore: the opened store
+        """
+        store = cls.__new__(cls)
+        store.path, store.times_path, store.meta_path = store_paths(path)
+        with open(store.meta_path) as f:
+            meta = json.load(f)
+        TrajectoryBuffer.__init__(store, 0, 0, every=meta["every"], keep_last=meta["keep_last"],
+                                  final_only=meta["final_only"])
+        store.flush_every = meta["flush_every"]
+        store.info = meta["info"]
+        store.data = np.load(store.path, mmap_mode=mode)
+        store.times = np.load(store.times_path, mmap_mode=mode)
+        store.length = meta["length"]
+        store.total = meta["total"]
+        store.steps_seen = meta["steps_seen"]
+        ids = meta.get("ids", [None] * len(meta["labels"])) # stores written before IDs have none
+        for label, cls_name, mass, radius, id in zip(meta["labels"], meta["classes"], meta["masses"], meta["radii"], ids):
+            body = BODY_CLASSES[cls_name].__new__(BODY_CLASSES[cls_name])
+            Body.__init__(body, np.zeros(3), np.zeros(3), mass, radius, label=label)
+            body.id = id
+            store.column_of[body] = len(store.bodies)
+            store.bodies.append(body)
+        return store
+
+
+    def _allocate(self, frames, columns):
+        """New storage files, created next to the store and moved into place by _adopt."""
+        data = create_npy(self.path + ".tmp", (frames, columns, 6))
+        times = create_npy(self.times_path + ".tmp", (frames,))
+        return data, times
+
+
+    def _adopt(self, data, times):
+        """Moves newly allocated files into place. Open memory maps stay valid across the rename."""
+        os.replace(self.path + ".tmp", self.path)
+        os.replace(self.times_path + ".tmp", self.times_path)
+        self.data, self.times = data, times
+
+
+    def record(self, state, time):
+        """Copies a SystemState into the next step of the store, flushing every flush_every steps.
+
+        Args:
+            state (SystemState): State to record
+            time (float): Simulation time in seconds
+        """
+        super().record(state, time)
+        if self.total % self.flush_every == 0:
+            self.flush()
+
+
+    def flush(self, info=None):
+        """Writes recorded steps to disk and updates the metadata sidecar.
+
+        Args:
+            info (dict, optional): Run summary to store, e.g. Model.summary()
+        """
+        if info is not None:
+            self.info = dict(info)
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        if isinstance(self.times, np.memmap):
+            self.times.flush()
+        meta = {
+            "labels": [b.label for b in self.bodies],
+            "classes": [type(b).__name__ for b in self.bodies],
+            "masses": [float(b.mass) for b in self.bodies],
+            "radii": [float(b.radius) for b in self.bodies],
+            "ids": [b.id for b in self.bodies],
+            "length": self.length,
+            "total": self.total,
+            "steps_seen": self.steps_seen,
+            "every": self.every,
+            "keep_last": self.keep_last,
+            "final_only": self.final_only,
+            "flush_every": self.flush_every,
+            "info": self.info,
+        }
+        with open(self.meta_path, "w") as f:
+            json.dump(meta, f)
@@ -0,0 +1,166 @@
+"""
+Process-pool parameter sweeps.
+
+A sweep runs one Model for every combination of a parameter grid and a list of seeds,
+spread over a pool of worker processes. Workers only send back the requested metrics,
+never histories, so the parent stays small no matter how long the runs are.
+
+Tasks are numbered in grid-then-seed order and results come back in that order. Every
+task builds its Model from its own seed, so the results do not depend on the number of
+workers or on which worker ran which task. Compatible tasks handed to the same worker
+are advanced together as an Ensemble, which gives the same results as separate runs.
+"""
+import inspect
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from model import Model
+from ensemble import Ensemble
+import integrators
+
+MODEL_PARAMETERS = set(inspect.signature(Model.__init__).parameters) - {"self"}
+
+
+def num_asteroids(m):
+    """Number of asteroids the run started with."""
+    return m.num_asteroids
+
+def num_intercepted(m):
+    """Number of asteroids hit by a DART."""
+    return m.num_intercepted
+
+def num_asteroids_collided(m):
+    """Number of asteroids that hit Earth."""
+    return m.num_asteroids_collided
+
+def num_intercepted_collided(m):
+    """Number of asteroids hit by a DART that still hit Earth."""
+    return m.num_intercepted_collided
+
+def interception_rate(m):
+    """Percent of asteroids hit by a DART."""
+    return m.num_intercepted / m.num_asteroids * 100 if m.num_asteroids else 0
+
+def failed_interception_rate(m):
+    """Percent of asteroids that were hit by a DART and still hit Earth."""
+    return m.num_intercepted_collided / m.num_asteroids * 100 if m.num_asteroids else 0
+
+def protection_rate(m):
+    """Percent of asteroids that did not hit Earth."""
+    return (m.num_asteroids - m.num_asteroids_collided) / m.num_asteroids * 100 if m.num_asteroids else 0
+
+def earth_sun_distance(m):
+    """Final distance between Earth and the Sun in meters."""
+    return m.earth.distance_to(m.sun)
+
+
+# Metrics selectable by name
+METRICS = {f.__name__: f for f in (
+    num_asteroids, num_intercepted, num_asteroids_collided, num_intercepted_collided,
+    interception_rate, failed_interception_rate, protection_rate, earth_sun_distance,
+)}
+
+
+def expand_grid(grid):
+    """Every combination of the values of a parameter grid.
+
+    Args:
+        grid (dict): parameter name -> list of values
+
+    Returns:
+        list: dicts of parameter name -> value, the last parameter varying fastest
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+
+
+def run_tasks(tasks):
+    """Runs a batch of sweep tasks in the current process. Tasks whose Models can share an
+    Ensemble are advanced together.
+
+    Args:
+        tasks (list): (params, seed, base, setup, metrics) tuples, see sweep
+
+    Returns:
+        list: dicts of metric name -> value, in task order
+    """
+    models = []
+    for params, seed, base, setup, _ in tasks:
+        kwargs = {**base, **{k: v for k, v in params.items() if k in MODEL_PARAMETERS}}
+        m = Model(**{**kwargs, "seed": seed})
+        if setup is not None:
+            setup(m, **{k: v for k, v in params.items() if k not in MODEL_PARAMETERS})
+        m.sync_ephemeris() # members are grouped by ephemeris below
+        models.append(m)
+
+    groups = {}
+    for m in models:
+        key = (m.integrator, m.dt, m.duration, id(m.ephemeris))
+        groups.setdefault(key, []).append(m)
+    for (integrator, _, _, _), group in groups.items():
+        if integrator in integrators.INTEGRATORS:
+            Ensemble(group).run(record_final_only=True)
+        else:
+            for m in group:
+                m.run(record_final_only=True)
+
+    return [{name: metric(m) for name, metric in task[4]} for m, task in zip(models, tasks)]
+
+
+def sweep(grid, seeds, metrics=("interception_rate", "failed_interception_rate", "protection_rate"),
+          base=None, setup=None, workers=None, batch=None):
+    """Runs a Model for every combination of grid values and seeds across a process pool.
+
+    Args:
+        grid (dict or list): parameter name -> list of values, or a list of parameter dicts to
+                             run as given. Model parameters are passed to the constructor,
+                             anything else is passed to setup.
+        seeds (list): Seeds to run every combination with. Must be non-zero, seed 0 leaves a
+                      Model unseeded and its results could not be reproduced.
+        metrics (list, optional): Names in METRICS or module level functions of a finished Model.
+        base (dict, optional): Model parameters shared by every run.
+        setup (callable, optional): Module level setup(model, **params) called before running,
+                                    with the grid entries that are not Model parameters.
+        workers (int, optional): Number of worker processes. Defaults to the CPU count,
+                                 1 runs everything in this process.
+        batch (int, optional): Tasks sent to a worker at once and run as one Ensemble.
+                               Defaults to an even split of the tasks over the workers.
+
+    Returns:
+        list: one dict per task with its parameters, seed and metrics, in grid-then-seed order
+    """
+    if any(seed == 0 for seed in seeds):
+        raise ValueError("Sweep seeds must be non-zero, seed 0 leaves the Model unseeded.")
+    combinations = expand_grid(grid) if isinstance(grid, dict) else [dict(p) for p in grid]
+    unknown = {k for p in combinations for k in p if k not in MODEL_PARAMETERS} if setup is None else set()
+    if unknown:
+        raise ValueError(f"Unknown Model parameters {sorted(unknown)} and no setup function to take them.")
+    metrics = [(m, METRICS[m]) if isinstance(m, str) else (m.__name__, m) for m in metrics]
+    base = base or {}
+
+    tasks = [(params, seed, base, setup, metrics) for params in combinations for seed in seeds]
+    workers = workers or os.cpu_count() or 1
+    batch = batch or max(1, -(-len(tasks) // workers))
+    batches = [tasks[i:i + batch] for i in range(0, len(tasks), batch)]
+    if workers == 1 or len(batches) == 1:
+        results = [run_tasks(b) for b in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+            results = list(pool.map(run_tasks, batches)) # map keeps task order
+    values = itertools.chain.from_iterable(results)
+    return [{**params, "seed": seed, **v} for (params, seed, *_), v in zip(tasks, values)]
+
+
+def mean_over_seeds(rows, metric, seeds):
+    """Averages a metric over the seeds of each parameter combination.
+
+    Args:
+        rows (list): Result of sweep
+        metric (str): Metric to average
+        seeds (list): Seeds the sweep was run with
+
+    Returns:
+        np.ndarray: mean value of each combination, in grid order
+    """
+    return np.mean(np.reshape([row[metric] for row in rows], (-1, len(seeds))), axis=1)